@@ -1,12 +1,21 @@
-__import__("pkg_resources").declare_namespace(__name__)
-
 from .utils import enum
 
 from .service import SERVICE_STATUS, ServiceState, ServiceControlsAccepted, Service
+from .service import ServiceStatusRecord, ServiceConfigRecord
+from .optional_config import ServiceConfigInfoLevel, SCActionType, ServiceSidType, OptionalConfigSnapshot
 from .common import *
-from .service_runner import ServiceCtrl, ServiceRunner
+from .service_runner import ServiceCtrl, ServiceRunner, ServiceHost, RestartPolicy, StartupTimeline
+from .service_runner import STARTUP_MILESTONES
+from .event_data import EventData, PowerEventType, SessionChangeEventType, DeviceEventType
 
 from .service_control_manager import ServiceManagerAccess, SC_ACTIVE_DATABASE, ServiceStartType
 from .service_control_manager import ServiceErrorControl, ServiceAccess
+from .service_control_manager import ServiceEnumState, EnumServiceStatus, SERVICE_WIN32, SERVICE_DRIVER
 from .service_control_manager import ServiceControlManagerContext, ServiceControlManager
+from .service_control_manager import PooledServiceControlManager, close_pooled_managers
+from .handle_pool import ServiceHandlePool, PooledService
+from .catalog import ServiceCatalog, CatalogEntry, CatalogEvent
+from .snapshot import StatusSnapshot, SnapshotRow, SnapshotDiff
 
+# sampler, watch (and its metrics exporter), fleet, provisioning and orchestrator are imported from their own modules,
+# so that importing the package does not pay for what only some callers need
@@ -0,0 +1,195 @@
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+import asyncio
+import functools
+import six
+
+from .service import SETTLED_STATES, NO_ERROR, PollBackoff
+from .service_control_manager import ServiceManagerAccess, ServiceAccess, ServiceControlManager, open_sc_manager
+from .common import ERROR_SERVICE_NOTIFY_CLIENT_LAGGING
+from .notifier import get_notifier
+from .utils import monotonic
+from .bindings import WinError
+
+EXECUTOR_MAX_WORKERS = 4
+
+_executor = None
+_executor_lock = Lock()
+
+# asyncio.get_running_loop() is new in Python 3.7; before that, get_event_loop() is what a coroutine has
+_get_running_loop = getattr(asyncio, "get_running_loop", asyncio.get_event_loop)
+
+
+def get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=EXECUTOR_MAX_WORKERS, thread_name_prefix="win32service")
+        return _executor
+
+
+class _AsyncBase(object):
+    def __init__(self, executor, notifier):
+        super(_AsyncBase, self).__init__()
+        self._executor = executor or get_executor()
+        self._notifier = notifier
+
+    def _call(self, func, *args, **kwargs):
+        loop = _get_running_loop()
+        return loop.run_in_executor(self._executor, functools.partial(func, *args, **kwargs))
+
+    def _get_notifier(self):
+        if self._notifier is None:
+            return get_notifier()
+        return self._notifier if self._notifier.available else None
+
+
+class AsyncServiceControlManager(_AsyncBase):
+    """
+    The asyncio counterpart of ServiceControlManagerContext and ServiceControlManager. Short blocking calls run on a
+    small dedicated executor, while waits for state changes are served by the shared StatusNotifier thread and
+    complete an asyncio future, so a pending wait does not hold a thread. notifier is the StatusNotifier to use
+    instead of the process-wide one:
+
+    >>> async with AsyncServiceControlManager() as scm:
+    ...     service = await scm.open_service("VSS")
+    ...     await service.safe_start()
+    ...     await service.wait_for_status(ServiceState.RUNNING)
+    ...     await service.close()
+    """
+    def __init__(self, machine=None, database=None, access=ServiceManagerAccess.ALL, executor=None, notifier=None):
+        super(AsyncServiceControlManager, self).__init__(executor, notifier)
+        self.machine = machine
+        self.database = database
+        self.access = access
+        self.scm = None
+
+    async def open(self):
+        handle = await self._call(open_sc_manager, self.machine, self.database, self.access)
+        self.scm = ServiceControlManager(handle)
+        return self
+
+    async def close(self):
+        if self.scm is not None:
+            await self._call(self.scm.close)
+            self.scm = None
+
+    async def open_service(self, name, access=ServiceAccess.ALL):
+        return AsyncService(await self._call(self.scm.open_service, name, access), self._executor, self._notifier)
+
+    async def create_service(self, *args, **kwargs):
+        return AsyncService(await self._call(self.scm.create_service, *args, **kwargs), self._executor,
+                            self._notifier)
+
+    async def is_service_exist(self, name):
+        return await self._call(self.scm.is_service_exist, name)
+
+    async def enumerate_services(self, *args, **kwargs):
+        return await self._call(lambda: list(self.scm.enumerate_services(*args, **kwargs)))
+
+    async def __aenter__(self):
+        return await self.open()
+
+    async def __aexit__(self, type, value, traceback):
+        await self.close()
+
+
+class AsyncService(_AsyncBase):
+    def __init__(self, service, executor=None, notifier=None):
+        super(AsyncService, self).__init__(executor, notifier)
+        self.service = service
+        self._subscribed = False
+
+    async def start(self, *args):
+        await self._call(self.service.start, *args)
+
+    async def stop(self):
+        await self._call(self.service.stop)
+
+    async def safe_start(self):
+        await self._call(self.service.safe_start)
+
+    async def safe_stop(self):
+        await self._call(self.service.safe_stop)
+
+    async def get_status(self):
+        return await self._call(self.service.get_status)
+
+    async def is_running(self):
+        return await self._call(self.service.is_running)
+
+    async def query_config(self):
+        return await self._call(self.service.query_config)
+
+    async def query_status_ex(self):
+        return await self._call(self.service.query_status_ex)
+
+    async def change_service_config(self, start_type):
+        await self._call(self.service.change_service_config, start_type)
+
+    async def delete(self):
+        await self._call(self.service.delete)
+
+    async def wait_on_pending(self, timeout_in_seconds=60):
+        await self._wait_for_status(SETTLED_STATES, timeout_in_seconds, "wait_on_pending")
+
+    async def wait_for_status(self, states, timeout_in_seconds=60):
+        if isinstance(states, six.integer_types):
+            states = (states, )
+        return await self._wait_for_status(tuple(states), timeout_in_seconds, "wait_for_status")
+
+    async def close(self):
+        if self._subscribed:
+            # our handle may still have a registration pending, so it has to be closed by the notifier
+            done = self._get_notifier().close(self.service)
+            await self._call(done.wait)
+        else:
+            await self._call(self.service.close)
+
+    async def _wait_for_status(self, states, timeout_in_seconds, caller):
+        notifier = self._get_notifier()
+        if notifier is None or not self.service._notifications_supported:
+            return await self._poll_for_status(states, timeout_in_seconds, caller)
+        deadline = None if timeout_in_seconds is None else monotonic() + timeout_in_seconds
+        loop = _get_running_loop()
+        future = loop.create_future()
+
+        def resolve(notification):
+            if future.done():
+                return
+            if notification.error == ERROR_SERVICE_NOTIFY_CLIENT_LAGGING:
+                future.set_result(None)
+            elif notification.error != NO_ERROR:
+                future.set_exception(WinError(notification.error))
+            elif notification.state in states:
+                future.set_result(notification.state)
+
+        self._subscribed = True
+        subscription = notifier.subscribe(self.service.handle,
+                                          lambda notification: loop.call_soon_threadsafe(resolve, notification))
+        try:
+            state = await asyncio.wait_for(future, timeout_in_seconds)
+        except asyncio.TimeoutError:
+            raise RuntimeError("{} timed out, status is: {}".format(caller, await self.get_status()))
+        finally:
+            notifier.unsubscribe(subscription)
+        if state is None:
+            # the SCM gave up on notifying this handle
+            self.service._notifications_supported = False
+            # polling only for what is left of the timeout
+            remaining = None if deadline is None else max(deadline - monotonic(), 0)
+            return await self._poll_for_status(states, remaining, caller)
+        return state
+
+    async def _poll_for_status(self, states, timeout_in_seconds, caller):
+        deadline = None if timeout_in_seconds is None else monotonic() + timeout_in_seconds
+        backoff = PollBackoff()
+        while True:
+            status = await self._call(self.service.query_status_ex)
+            if status.current_state in states:
+                return status.current_state
+            remaining = None if deadline is None else deadline - monotonic()
+            if remaining is not None and remaining <= 0:
+                raise RuntimeError("{} timed out, status is: {}".format(caller, status.current_state))
+            interval = backoff.next_interval(status.check_point, status.wait_hint)
+            await asyncio.sleep(interval if remaining is None else min(interval, remaining))
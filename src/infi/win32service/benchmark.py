@@ -0,0 +1,186 @@
+from collections import OrderedDict
+import argparse
+import json
+import platform
+import sys
+
+from .utils import monotonic
+from .service import ServiceState
+from .service_control_manager import ServiceControlManagerContext, ServiceAccess
+from .simulation import SimulatedAdvapi32, SimulatedService, SIMULATED_APIS
+
+REPORT_VERSION = 1
+PERCENTILES = (50, 90, 99, 99.9)
+
+
+def _percentile(sorted_values, percentile):
+    # nearest rank, so the figure is always one of the measured values
+    index = max(int(round(percentile / 100.0 * len(sorted_values) + 0.5)) - 1, 0)
+    return sorted_values[min(index, len(sorted_values) - 1)]
+
+
+def summarize(latencies, elapsed):
+    """ Returns ops/sec and latency figures (in microseconds) of one benchmark """
+    values = sorted(latencies)
+    summary = OrderedDict(operations=len(values), ops_per_second=len(values) / elapsed if elapsed else 0.0)
+    summary["mean_us"] = sum(values) / len(values) * 1e6 if values else 0.0
+    for percentile in PERCENTILES:
+        summary["p{}_us".format(percentile)] = _percentile(values, percentile) * 1e6 if values else 0.0
+    summary["max_us"] = values[-1] * 1e6 if values else 0.0
+    return summary
+
+
+def _timed(iterations, operation):
+    latencies = []
+    for index in range(iterations):
+        start = monotonic()
+        operation(index)
+        latencies.append(monotonic() - start)
+    return latencies
+
+
+def _names(config):
+    return [u"Service{:04d}".format(index) for index in range(config["services"])]
+
+
+def bench_open_close(scm, simulation, config):
+    names = _names(config)
+    return _timed(config["iterations"],
+                  lambda index: scm.open_service(names[index % len(names)], ServiceAccess.QUERY_STATUS).close())
+
+
+def bench_query_status(scm, simulation, config):
+    with scm.open_service(_names(config)[0], ServiceAccess.QUERY_STATUS) as service:
+        return _timed(config["iterations"], lambda index: service.query_status_ex())
+
+
+def bench_query_config(scm, simulation, config):
+    with scm.open_service(_names(config)[0], ServiceAccess.QUERY_CONFIG) as service:
+        return _timed(config["iterations"], lambda index: service.query_config_record())
+
+
+def bench_query_optional_config(scm, simulation, config):
+    with scm.open_service(_names(config)[0], ServiceAccess.QUERY_CONFIG) as service:
+        return _timed(config["iterations"], lambda index: service.query_optional_config())
+
+
+def bench_enumerate(scm, simulation, config):
+    # a full sweep is a lot heavier than the other operations, so it gets fewer rounds
+    return _timed(max(config["iterations"] // 100, 1), lambda index: list(scm.enumerate_services()))
+
+
+def bench_start_stop(scm, simulation, config):
+    def start_stop(index):
+        service.start()
+        service.wait_for_status(ServiceState.RUNNING)
+        service.stop()
+        service.wait_for_status(ServiceState.STOPPED)
+    with scm.open_service(_names(config)[0]) as service:
+        return _timed(config["iterations"], start_stop)
+
+
+def bench_wait(scm, simulation, config):
+    # how late a waiter learns that a pending service settled, on top of the time it actually took
+    delay = config["transition_delay"]
+    simulated = simulation.get_service(_names(config)[0])
+    simulated.start_delay = simulated.stop_delay = delay
+    latencies = []
+    with scm.open_service(_names(config)[0]) as service:
+        for index in range(max(config["iterations"] // 10, 1)):
+            for action, state in ((service.start, ServiceState.RUNNING), (service.stop, ServiceState.STOPPED)):
+                start = monotonic()
+                action()
+                service.wait_for_status(state)
+                latencies.append(max(monotonic() - start - delay, 0.0))
+    return latencies
+
+BENCHMARKS = OrderedDict([
+    ("open_close", bench_open_close),
+    ("query_status", bench_query_status),
+    ("query_config", bench_query_config),
+    ("query_optional_config", bench_query_optional_config),
+    ("enumerate", bench_enumerate),
+    ("start_stop", bench_start_stop),
+    ("wait", bench_wait),
+])
+
+
+def run_benchmarks(names=None, iterations=1000, services=200, latency=0.0, jitter=0.0, transition_delay=0.005,
+                   seed=0):
+    """
+    Runs the benchmarks (all of them by default) against a fresh SimulatedAdvapi32 each, where every simulated call
+    takes latency seconds plus up to jitter more, and returns a report dict that can be dumped as JSON.
+    """
+    config = OrderedDict([("iterations", iterations), ("services", services), ("latency", latency),
+                          ("jitter", jitter), ("transition_delay", transition_delay), ("seed", seed)])
+    results = OrderedDict()
+    for name in names or BENCHMARKS:
+        latencies = dict((api, (latency, jitter)) for api in SIMULATED_APIS)
+        with SimulatedAdvapi32(latencies, seed) as simulation:
+            for service_name in _names(config):
+                simulation.add_service(SimulatedService(service_name))
+            with ServiceControlManagerContext() as scm:
+                start = monotonic()
+                measured = BENCHMARKS[name](scm, simulation, config)
+                results[name] = summarize(measured, monotonic() - start)
+    return OrderedDict([("version", REPORT_VERSION),
+                        ("python", platform.python_version()),
+                        ("implementation", platform.python_implementation()),
+                        ("config", config),
+                        ("results", results)])
+
+
+def compare(baseline, current, tolerance=0.2):
+    """
+    Returns a list of regressions of current against baseline (both reports): benchmarks whose throughput dropped,
+    or whose p99 latency grew, by more than tolerance.
+    """
+    regressions = []
+    for name, result in current["results"].items():
+        before = baseline["results"].get(name)
+        if before is None:
+            continue
+        if result["ops_per_second"] < before["ops_per_second"] * (1 - tolerance):
+            regressions.append("{}: {:.0f} ops/sec, was {:.0f}".format(name, result["ops_per_second"],
+                                                                      before["ops_per_second"]))
+        if result["p99_us"] > before["p99_us"] * (1 + tolerance):
+            regressions.append("{}: p99 {:.1f}us, was {:.1f}us".format(name, result["p99_us"], before["p99_us"]))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="benchmarks infi.win32service against a simulated SCM")
+    parser.add_argument("benchmarks", nargs="*", metavar="benchmark",
+                        help="any of: {} (all of them by default)".format(", ".join(BENCHMARKS)))
+    parser.add_argument("--iterations", type=int, default=1000)
+    parser.add_argument("--services", type=int, default=200)
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds every simulated call takes")
+    parser.add_argument("--jitter", type=float, default=0.0, help="up to this many more seconds, at random")
+    parser.add_argument("--transition-delay", type=float, default=0.005)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="write the JSON report here instead of stdout")
+    parser.add_argument("--baseline", help="a JSON report to compare against; regressions fail the run")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    args = parser.parse_args(argv)
+    unknown = sorted(set(args.benchmarks) - set(BENCHMARKS))
+    if unknown:
+        parser.error("unknown benchmarks: {}".format(", ".join(unknown)))
+    report = run_benchmarks(args.benchmarks, args.iterations, args.services, args.latency, args.jitter,
+                            args.transition_delay, args.seed)
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as output:
+            output.write(text + "\n")
+    else:
+        print(text)
+    if args.baseline:
+        with open(args.baseline) as baseline:
+            regressions = compare(json.load(baseline), report, args.tolerance)
+        for regression in regressions:
+            sys.stderr.write("regression: {}\n".format(regression))
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,117 @@
+import ctypes
+from ctypes import wintypes
+from threading import Lock
+
+# Callbacks the system calls are stdcall on 32-bit Windows; elsewhere (say, against a simulated backend on a Linux
+# box) there is only the one calling convention.
+WINFUNCTYPE = getattr(ctypes, "WINFUNCTYPE", ctypes.CFUNCTYPE)
+
+try:
+    WindowsError = WindowsError
+except NameError:
+    class WindowsError(OSError):
+        """ What ctypes.WinError() raises, for platforms that do not have one """
+        def __init__(self, winerror, strerror=None):
+            super(WindowsError, self).__init__(None, strerror or "Windows Error {:#x}".format(winerror))
+            self.winerror = winerror
+
+
+class _WindowsBackend(object):
+    """ The system DLLs, loaded on first use """
+    def __getattr__(self, library):
+        return getattr(ctypes.windll, library)
+
+
+_backend = _WindowsBackend()
+_functions = []
+_functions_lock = Lock()
+
+
+def set_backend(backend):
+    """
+    Makes every binding resolve its function from backend from now on, and returns the backend used until now.
+    A backend has an attribute per library (advapi32, kernel32), which in turn has an attribute per exported
+    function, like ctypes.windll does; a backend of None goes back to the system DLLs.
+    """
+    global _backend
+    with _functions_lock:
+        previous, _backend = _backend, backend or _WindowsBackend()
+        for function in _functions:
+            function.reset()
+    return previous
+
+
+class LazyFunction(object):
+    """
+    A function of a DLL, looked up (and given its argtypes and restype) on its first call instead of at import.
+    """
+    __slots__ = ("library", "name", "argtypes", "restype", "optional", "_function", "_available")
+
+    def __init__(self, library, name, argtypes, restype, optional=False):
+        self.library = library
+        self.name = name
+        self.argtypes = argtypes
+        self.restype = restype
+        self.optional = optional
+        self.reset()
+
+    def reset(self):
+        self._function = None
+        self._available = None
+
+    @property
+    def available(self):
+        """ False if the function does not exist, which only optional functions tolerate """
+        if self._available is None:
+            try:
+                self.resolve()
+            except AttributeError:
+                if not self.optional:
+                    raise
+                self._available = False
+        return self._available
+
+    def resolve(self):
+        function = getattr(getattr(_backend, self.library), self.name)
+        if isinstance(function, ctypes._CFuncPtr):
+            function.argtypes = self.argtypes
+            function.restype = self.restype
+        self._function = function
+        self._available = True
+        return function
+
+    def __call__(self, *args):
+        function = self._function
+        if function is None:
+            function = self.resolve()
+        return function(*args)
+
+    def __repr__(self):
+        return "<LazyFunction {}!{}>".format(self.library, self.name)
+
+
+def bind(library, name, argtypes, restype, optional=False):
+    function = LazyFunction(library, name, argtypes, restype, optional)
+    with _functions_lock:
+        _functions.append(function)
+    return function
+
+
+def is_available(function):
+    """ Tells whether a binding (possibly wrapped, or replaced by a stand-in) can be called """
+    while hasattr(function, "instrumented_function"):
+        function = function.instrumented_function
+    return getattr(function, "available", True)
+
+
+GetLastError = bind("kernel32", "GetLastError", (), wintypes.DWORD)
+SetLastError = bind("kernel32", "SetLastError", (wintypes.DWORD, ), None)
+
+
+def WinError(code=None, descr=None):
+    """ Like ctypes.WinError, but takes the last error from the current backend """
+    if code is None:
+        code = GetLastError()
+    if hasattr(ctypes, "WinError"):
+        return ctypes.WinError(code, descr)
+    return WindowsError(code, descr)
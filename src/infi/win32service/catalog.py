@@ -0,0 +1,349 @@
+from collections import namedtuple
+from threading import RLock
+import logging
+
+from .utils import enum
+from .common import ERROR_SERVICE_DOES_NOT_EXIST, ERROR_SERVICE_MARKED_FOR_DELETE
+from .service_control_manager import (ServiceControlManager, ServiceManagerAccess, ServiceAccess, SERVICE_WIN32,
+                                      open_sc_manager)
+from .service import NO_ERROR
+from .notifier import get_notifier
+from .bindings import WindowsError
+
+logger = logging.getLogger(__name__)
+
+CATALOG_SCM_ACCESS = ServiceManagerAccess.CONNECT | ServiceManagerAccess.ENUMERATE_SERVICE
+CATALOG_SERVICE_ACCESS = ServiceAccess.QUERY_STATUS | ServiceAccess.QUERY_CONFIG
+
+CatalogEntry = namedtuple("CatalogEntry", ["service_name", "display_name", "service_type", "current_state",
+                                           "process_id", "start_type", "dependencies"])
+
+# What happened to an entry, as told to ServiceCatalog listeners
+CatalogEvent = enum(CREATED=1, DELETED=2, CHANGED=3)
+
+
+class ServiceCatalog(object):
+    """
+    An in-memory index of the services of an SCM, for answering questions like "which service owns PID 4312" or
+    "which auto-start services are stopped" without asking the SCM about every service.
+
+    start() (or the with statement) takes one full sweep and from then on keeps the index current through status
+    change notifications: state changes of every service, and services created or deleted. Configuration changes are
+    not notified by the SCM, so refresh_config() rereads the configuration of a service, and refresh() sweeps again.
+    Without notification support (before Vista) the index only changes on refresh().
+
+    Entries are CatalogEntry tuples and are replaced, never modified, so a caller can hold on to one. Listeners added
+    with add_listener() are called on the notifier thread with a CatalogEvent and the new (or, for DELETED, last)
+    entry, and must be quick.
+    """
+    def __init__(self, machine=None, type=SERVICE_WIN32, notifier=None):
+        super(ServiceCatalog, self).__init__()
+        self.machine = machine
+        self.type = type
+        self._notifier = notifier
+        self._scm = None
+        self._lock = RLock()
+        self._listeners = []
+        self._clear()
+
+    def _clear(self):
+        self._entries = dict()
+        self._services = dict()
+        self._subscriptions = dict()
+        self._by_display_name = dict()
+        self._by_pid = dict()
+        self._by_state = dict()
+        self._by_start_type = dict()
+        self._dependents = dict()
+        self._reopened = set()
+
+    def start(self):
+        if self._scm is not None:
+            return self
+        if self._notifier is None:
+            self._notifier = get_notifier()
+        self._scm = ServiceControlManager(open_sc_manager(self.machine, None, CATALOG_SCM_ACCESS))
+        if self._notifier is not None:
+            # registered before the sweep, so that services created while we sweep are not missed
+            self._notifier.subscribe_scm(self._scm.handle, self._on_scm_change)
+            self._notifier.flush()
+        self.refresh()
+        return self
+
+    def close(self):
+        if self._scm is None:
+            return
+        with self._lock:
+            names = list(self._services)
+        for name in names:
+            self._forget_service(name)
+        self._close(self._scm)
+        self._scm = None
+        with self._lock:
+            self._clear()
+
+    def refresh(self):
+        """ Sweeps the SCM again, adding and dropping services the index does not know about """
+        seen = set()
+        for status in self._scm.enumerate_services(self.type):
+            seen.add(status.service_name.lower())
+            self._add(status.service_name, status)
+        with self._lock:
+            gone = [name for name in self._entries if name not in seen]
+        for name in gone:
+            self._remove(name)
+
+    def refresh_config(self, name):
+        """ Rereads the start type, display name and dependencies of a service """
+        service = self._services.get(name.lower())
+        if service is None:
+            return self._add(name)
+        config = service.query_config_record()
+        return self._change(name.lower(), start_type=config.start_type, dependencies=tuple(config.dependencies),
+                            **({"display_name": config.display_name} if config.display_name else {}))
+
+    def add_listener(self, listener):
+        self._listeners = self._listeners + [listener]
+
+    def remove_listener(self, listener):
+        self._listeners = [item for item in self._listeners if item is not listener]
+
+    # Queries
+
+    def get(self, name):
+        """ Returns the entry of the service called name (case insensitive), or None """
+        return self._entries.get(name.lower())
+
+    def __contains__(self, name):
+        return name.lower() in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __iter__(self):
+        return iter(list(self._entries.values()))
+
+    def find_by_display_name(self, display_name):
+        return self._entry_of(self._by_display_name.get(display_name.lower()))
+
+    def find_by_pid(self, process_id):
+        """ Returns the entries of the services running in process process_id (more than one for a shared host) """
+        return self._entries_of(self._by_pid.get(process_id, ()))
+
+    def find_by_state(self, state):
+        return self._entries_of(self._by_state.get(state, ()))
+
+    def find_by_start_type(self, start_type):
+        return self._entries_of(self._by_start_type.get(start_type, ()))
+
+    def find(self, state=None, start_type=None):
+        """ Returns the entries in state and of start_type (either of them may be None, for any) """
+        with self._lock:
+            keys = None
+            for index, value in ((self._by_state, state), (self._by_start_type, start_type)):
+                if value is not None:
+                    names = index.get(value, set())
+                    keys = names if keys is None else keys & names
+            return self._entries_of(self._entries if keys is None else keys)
+
+    def find_dependents(self, name):
+        """ Returns the entries of the services that depend on the service called name """
+        return self._entries_of(self._dependents.get(name.lower(), ()))
+
+    def _entry_of(self, key):
+        return None if key is None else self._entries.get(key)
+
+    def _entries_of(self, keys):
+        with self._lock:
+            return [self._entries[key] for key in keys if key in self._entries]
+
+    # Keeping the index current
+
+    def _add(self, name, status=None):
+        # opens the service, reads what the sweep (or the notification) did not tell us, and starts watching it
+        key = name.lower()
+        if key in self._services:
+            if status is None:
+                return self._entries.get(key)
+            return self._change(key, current_state=status.current_state, process_id=status.process_id)
+        try:
+            service = self._scm.open_service(name, CATALOG_SERVICE_ACCESS)
+        except WindowsError as error:
+            if error.winerror != ERROR_SERVICE_DOES_NOT_EXIST:
+                logger.exception("failed to open service %s", name)
+            return None
+        try:
+            config = service.query_config_record()
+            if status is None:
+                status = service.query_status_ex()
+        except WindowsError:
+            logger.exception("failed to query service %s", name)
+            self._close(service)
+            return None
+        entry = CatalogEntry(name, config.display_name or getattr(status, "display_name", name), config.service_type,
+                             status.current_state, status.process_id, config.start_type, tuple(config.dependencies))
+        with self._lock:
+            added = key not in self._services
+            if added:
+                self._services[key] = service
+                self._index(key, entry)
+        if not added:
+            # added by the notifier thread while we were querying
+            service.close()
+            return self._entries.get(key)
+        self._notify_listeners(CatalogEvent.CREATED, entry)
+        self._subscribe(key, service)
+        return entry
+
+    def _subscribe(self, key, service):
+        if self._notifier is None:
+            return
+        subscription = self._notifier.subscribe(service.handle, lambda notification: self._on_change(key, notification))
+        with self._lock:
+            if self._services.get(key) is service:
+                self._subscriptions[key] = subscription
+                return
+        # removed (or reopened) by the notifier thread while we were subscribing
+        self._notifier.unsubscribe(subscription)
+
+    def _reopen(self, key):
+        # the SCM stopped notifying us through the handle we have (e.g. ERROR_SERVICE_NOTIFY_CLIENT_LAGGING); a new
+        # handle gets a new registration, and tells us where the service is now
+        entry = self._entries.get(key)
+        if entry is None:
+            return
+        try:
+            service = self._scm.open_service(entry.service_name, CATALOG_SERVICE_ACCESS)
+        except WindowsError as error:
+            if error.winerror == ERROR_SERVICE_DOES_NOT_EXIST:
+                self._remove(key)
+            else:
+                logger.exception("failed to reopen service %s, refresh() to catch up", entry.service_name)
+            return
+        try:
+            status = service.query_status_ex()
+        except WindowsError:
+            logger.exception("failed to query service %s, refresh() to catch up", entry.service_name)
+            self._close(service)
+            return
+        with self._lock:
+            previous = self._services.get(key)
+            if previous is not None:
+                self._services[key] = service
+                subscription = self._subscriptions.pop(key, None)
+        if previous is None:
+            self._close(service)
+            return
+        if subscription is not None:
+            self._notifier.unsubscribe(subscription)
+        self._close(previous)
+        self._subscribe(key, service)
+        self._change(key, current_state=status.current_state, process_id=status.process_id)
+
+    def _remove(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self._unindex(key, entry)
+        self._forget_service(key)
+        if entry is not None:
+            self._notify_listeners(CatalogEvent.DELETED, entry)
+
+    def _forget_service(self, key):
+        with self._lock:
+            service = self._services.pop(key, None)
+            subscription = self._subscriptions.pop(key, None)
+            self._reopened.discard(key)
+        if subscription is not None:
+            self._notifier.unsubscribe(subscription)
+        if service is not None:
+            # an open handle keeps a deleted service around, so we let go of it right away
+            self._close(service)
+
+    def _close(self, handle_owner):
+        if self._notifier is not None:
+            self._notifier.close(handle_owner)
+        else:
+            handle_owner.close()
+
+    def _change(self, key, **fields):
+        # replaces the entry of key with one where fields changed, and returns the current entry
+        with self._lock:
+            previous = self._entries.get(key)
+            if previous is None:
+                return None
+            entry = previous._replace(**fields)
+            if entry == previous:
+                return previous
+            self._unindex(key, previous)
+            self._index(key, entry)
+        self._notify_listeners(CatalogEvent.CHANGED, entry)
+        return entry
+
+    def _index(self, key, entry):
+        self._entries[key] = entry
+        self._by_display_name[entry.display_name.lower()] = key
+        if entry.process_id:
+            self._by_pid.setdefault(entry.process_id, set()).add(key)
+        self._by_state.setdefault(entry.current_state, set()).add(key)
+        self._by_start_type.setdefault(entry.start_type, set()).add(key)
+        for dependency in entry.dependencies:
+            self._dependents.setdefault(dependency.lower(), set()).add(key)
+
+    def _unindex(self, key, entry):
+        if self._by_display_name.get(entry.display_name.lower()) == key:
+            del self._by_display_name[entry.display_name.lower()]
+        for index, value in ((self._by_pid, entry.process_id), (self._by_state, entry.current_state),
+                             (self._by_start_type, entry.start_type)):
+            _discard(index, value, key)
+        for dependency in entry.dependencies:
+            _discard(self._dependents, dependency.lower(), key)
+
+    def _notify_listeners(self, event, entry):
+        for listener in self._listeners:
+            try:
+                listener(event, entry)
+            except:
+                logger.exception("exception caught in service catalog listener")
+
+    def _on_change(self, key, notification):
+        if notification.error == ERROR_SERVICE_MARKED_FOR_DELETE:
+            self._remove(key)
+            return
+        if notification.error != NO_ERROR:
+            if key in self._reopened:
+                # a new handle did not help either; we keep the entry as it is
+                logger.error("notifications of service %s failed again with error %d, refresh() to catch up", key,
+                             notification.error)
+                return
+            logger.warning("notifications of service %s failed with error %d, reopening it", key, notification.error)
+            self._reopened.add(key)
+            self._reopen(key)
+            return
+        self._reopened.discard(key)
+        self._change(key, current_state=notification.state, process_id=notification.process_id)
+
+    def _on_scm_change(self, notification):
+        if notification.error != NO_ERROR:
+            logger.error("service creation and deletion notifications failed with error %d, refresh() to catch up",
+                         notification.error)
+            return
+        for name in notification.service_names:
+            if name.startswith(u"/"):
+                self._add(name[1:])
+            else:
+                self._remove(name.lower())
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+
+def _discard(index, value, key):
+    keys = index.get(value)
+    if keys is not None:
+        keys.discard(key)
+        if not keys:
+            del index[value]
@@ -36,3 +36,17 @@ ServiceType = enum(
     INTERACTIVE_PROCESS   = 0x00000100)
 
 ERROR_INVALID_HANDLE = 6
+ERROR_INVALID_PARAMETER = 87
+ERROR_INSUFFICIENT_BUFFER = 122
+ERROR_MORE_DATA = 234
+ERROR_INVALID_SERVICE_CONTROL = 1052
+ERROR_SERVICE_DATABASE_LOCKED = 1055
+ERROR_SERVICE_ALREADY_RUNNING = 1056
+ERROR_SERVICE_DISABLED = 1058
+ERROR_SERVICE_DOES_NOT_EXIST = 1060
+ERROR_SERVICE_CANNOT_ACCEPT_CTRL = 1061
+ERROR_SERVICE_NOT_ACTIVE = 1062
+ERROR_SERVICE_SPECIFIC_ERROR = 1066
+ERROR_SERVICE_MARKED_FOR_DELETE = 1072
+ERROR_SERVICE_EXISTS = 1073
+ERROR_SERVICE_NOTIFY_CLIENT_LAGGING = 1294
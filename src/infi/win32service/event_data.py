@@ -0,0 +1,164 @@
+import ctypes
+from ctypes import wintypes
+
+from .utils import enum
+from .common import ServiceControl
+
+# http://msdn.microsoft.com/en-us/library/windows/desktop/aa373247%28v=vs.85%29.aspx
+# -- HandlerEx.dwEventType for SERVICE_CONTROL_POWEREVENT:
+PowerEventType = enum(
+    APMPOWERSTATUSCHANGE = 0x000A,
+    APMRESUMEAUTOMATIC   = 0x0012,
+    APMRESUMESUSPEND     = 0x0007,
+    APMSUSPEND           = 0x0004,
+    POWERSETTINGCHANGE   = 0x8013)
+
+# http://msdn.microsoft.com/en-us/library/windows/desktop/aa383828%28v=vs.85%29.aspx
+# -- HandlerEx.dwEventType for SERVICE_CONTROL_SESSIONCHANGE:
+SessionChangeEventType = enum(
+    CONSOLE_CONNECT    = 0x1,
+    CONSOLE_DISCONNECT = 0x2,
+    REMOTE_CONNECT     = 0x3,
+    REMOTE_DISCONNECT  = 0x4,
+    SESSION_LOGON      = 0x5,
+    SESSION_LOGOFF     = 0x6,
+    SESSION_LOCK       = 0x7,
+    SESSION_UNLOCK     = 0x8,
+    SESSION_REMOTE_CONTROL = 0x9,
+    SESSION_CREATE     = 0xA,
+    SESSION_TERMINATE  = 0xB)
+
+# http://msdn.microsoft.com/en-us/library/windows/desktop/aa363205%28v=vs.85%29.aspx
+# -- HandlerEx.dwEventType for SERVICE_CONTROL_DEVICEEVENT:
+DeviceEventType = enum(
+    DEVICEARRIVAL        = 0x8000,
+    DEVICEQUERYREMOVE    = 0x8001,
+    DEVICEQUERYREMOVEFAILED = 0x8002,
+    DEVICEREMOVEPENDING  = 0x8003,
+    DEVICEREMOVECOMPLETE = 0x8004,
+    CUSTOMEVENT          = 0x8006)
+
+# What a DEVICEQUERYREMOVE handler returns to veto the removal
+BROADCAST_QUERY_DENY = 0x424D5144
+
+
+# typedef struct _GUID {
+#   DWORD Data1;
+#   WORD  Data2;
+#   WORD  Data3;
+#   BYTE  Data4[8];
+# } GUID;
+class GUID(ctypes.Structure):
+    _fields_ = [("Data1", wintypes.DWORD),
+                ("Data2", wintypes.WORD),
+                ("Data3", wintypes.WORD),
+                ("Data4", ctypes.c_ubyte * 8)]
+
+    def __str__(self):
+        data4 = bytearray(self.Data4)
+        return "{{{:08X}-{:04X}-{:04X}-{}-{}}}".format(self.Data1, self.Data2, self.Data3,
+                                                       "".join("{:02X}".format(b) for b in data4[:2]),
+                                                       "".join("{:02X}".format(b) for b in data4[2:]))
+
+
+# http://msdn.microsoft.com/en-us/library/windows/desktop/aa383841%28v=vs.85%29.aspx
+# typedef struct tagWTSSESSION_NOTIFICATION {
+#   DWORD cbSize;
+#   DWORD dwSessionId;
+# } WTSSESSION_NOTIFICATION, *PWTSSESSION_NOTIFICATION;
+class WTSSESSION_NOTIFICATION(ctypes.Structure):
+    _fields_ = [("cbSize", wintypes.DWORD),
+                ("dwSessionId", wintypes.DWORD)]
+
+
+# http://msdn.microsoft.com/en-us/library/windows/desktop/aa372723%28v=vs.85%29.aspx
+# typedef struct {
+#   GUID  PowerSetting;
+#   DWORD DataLength;
+#   UCHAR Data[1];
+# } POWERBROADCAST_SETTING, *PPOWERBROADCAST_SETTING;
+class POWERBROADCAST_SETTING(ctypes.Structure):
+    _fields_ = [("PowerSetting", GUID),
+                ("DataLength", wintypes.DWORD),
+                ("Data", ctypes.c_ubyte * 1)]
+
+    def data_address(self):
+        return ctypes.addressof(self) + POWERBROADCAST_SETTING.Data.offset
+
+    def data(self):
+        """ Returns a copy of the DataLength bytes of Data """
+        return ctypes.string_at(self.data_address(), self.DataLength)
+
+    def dword(self):
+        """ Most power settings carry a single DWORD """
+        return wintypes.DWORD.from_address(self.data_address()).value
+
+
+# http://msdn.microsoft.com/en-us/library/windows/desktop/ms685930%28v=vs.85%29.aspx
+# typedef struct _SERVICE_TIMECHANGE_INFO {
+#   LARGE_INTEGER liNewTime;
+#   LARGE_INTEGER liOldTime;
+# } SERVICE_TIMECHANGE_INFO, *PSERVICE_TIMECHANGE_INFO;
+class SERVICE_TIMECHANGE_INFO(ctypes.Structure):
+    _fields_ = [("liNewTime", ctypes.c_longlong),
+                ("liOldTime", ctypes.c_longlong)]
+
+
+# http://msdn.microsoft.com/en-us/library/windows/desktop/aa363246%28v=vs.85%29.aspx
+# typedef struct _DEV_BROADCAST_HDR {
+#   DWORD dbch_size;
+#   DWORD dbch_devicetype;
+#   DWORD dbch_reserved;
+# } DEV_BROADCAST_HDR, *PDEV_BROADCAST_HDR;
+class DEV_BROADCAST_HDR(ctypes.Structure):
+    _fields_ = [("dbch_size", wintypes.DWORD),
+                ("dbch_devicetype", wintypes.DWORD),
+                ("dbch_reserved", wintypes.DWORD)]
+
+
+def _power_event_structure(event_type):
+    # only POWERSETTINGCHANGE carries data, the other power events come with lpEventData = NULL
+    return POWERBROADCAST_SETTING if event_type == PowerEventType.POWERSETTINGCHANGE else None
+
+# control -> function of the event type that returns the structure lpEventData points to, if any
+_EVENT_DATA_STRUCTURES = {
+    ServiceControl.SESSIONCHANGE: lambda event_type: WTSSESSION_NOTIFICATION,
+    ServiceControl.POWEREVENT: _power_event_structure,
+    ServiceControl.TIMECHANGE: lambda event_type: SERVICE_TIMECHANGE_INFO,
+    ServiceControl.DEVICEEVENT: lambda event_type: DEV_BROADCAST_HDR,
+}
+
+
+class EventData(object):
+    """
+    The event of a control request, as passed to HandlerEx. The payload is decoded only when data is first read, as
+    a ctypes view over the memory the SCM passed us (nothing is copied), so it is valid only while the handler runs;
+    copy out what has to outlive it.
+    """
+    __slots__ = ("control", "event_type", "address", "_data")
+
+    def __init__(self, control, event_type, address):
+        self.control = control
+        self.event_type = event_type
+        self.address = address
+        self._data = None
+
+    @property
+    def data(self):
+        """ The structure lpEventData points to, or None for controls that carry no (known) data """
+        if self._data is None and self.address:
+            get_structure = _EVENT_DATA_STRUCTURES.get(self.control)
+            structure = None if get_structure is None else get_structure(self.event_type)
+            if structure is not None:
+                self._data = structure.from_address(self.address)
+        return self._data
+
+    @property
+    def session_id(self):
+        """ The session of a SESSIONCHANGE event, or None for other events and events without data """
+        if self.control != ServiceControl.SESSIONCHANGE or self.data is None:
+            return None
+        return self.data.dwSessionId
+
+    def __repr__(self):
+        return "<EventData control={:#x} event_type={:#x}>".format(self.control, self.event_type)
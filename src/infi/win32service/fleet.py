@@ -0,0 +1,233 @@
+from concurrent.futures import ThreadPoolExecutor
+from collections import namedtuple
+from threading import Lock
+from six.moves import queue
+import logging
+
+from .utils import monotonic
+from .bindings import WindowsError
+from .service import ServiceState
+from .service_control_manager import (ServiceManagerAccess, ServiceAccess, PooledServiceControlManager,
+                                      open_sc_manager)
+
+logger = logging.getLogger(__name__)
+
+FLEET_SCM_ACCESS = ServiceManagerAccess.CONNECT | ServiceManagerAccess.ENUMERATE_SERVICE
+
+# value is what the operation returned, error the exception it raised (or a FleetTimeoutError); elapsed is counted
+# from the moment the operation started running on its host, so time spent queued behind other hosts is not included
+FleetResult = namedtuple("FleetResult", ["host", "value", "error", "elapsed"])
+
+
+class FleetTimeoutError(RuntimeError):
+    pass
+
+
+class FleetExecutor(object):
+    """
+    Runs service operations across many hosts with bounded concurrency. Each host gets one pooled SCM connection
+    (a PooledServiceControlManager, which also keeps its service handles), opened on first use and kept for the
+    following operations. Results are yielded as FleetResult tuples in completion order; a host that does not
+    answer within timeout_in_seconds is reported with a FleetTimeoutError and the sweep moves on without it.
+
+    A connection is only closed once no operation uses it: one abandoned by a timeout is closed when the stuck
+    operation returns, and close() leaves those still in use to be closed by their operations.
+
+    >>> with FleetExecutor(["node1", "node2"]) as fleet:
+    ...     for result in fleet.query_status("VSS"):
+    ...         print(result.host, result.error or result.value.current_state)
+    """
+    def __init__(self, hosts, max_workers=32, timeout_in_seconds=30, access=FLEET_SCM_ACCESS, pool_size=16):
+        super(FleetExecutor, self).__init__()
+        self.hosts = list(hosts)
+        self.timeout_in_seconds = timeout_in_seconds
+        self.access = access
+        self.pool_size = pool_size
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+        # host -> the connection the next operations on it use; id(scm) -> [scm, operations using it, retired]
+        self._managers = dict()
+        self._users = dict()
+        self._closed = False
+        self._lock = Lock()
+
+    def run(self, operation, *args, **kwargs):
+        """
+        Calls operation(scm, *args, **kwargs) for every host and yields a FleetResult per host as they complete.
+        """
+        results = queue.Queue()
+        started = dict()
+        for host in self.hosts:
+            self._executor.submit(self._run_one, host, started, results, operation, args, kwargs)
+        pending = set(self.hosts)
+        while pending:
+            timeout = self._next_timeout(pending, started)
+            try:
+                result = results.get(timeout=timeout)
+            except queue.Empty:
+                for result in self._expire(pending, started):
+                    yield result
+                continue
+            if result.host in pending:
+                pending.discard(result.host)
+                yield result
+
+    def query_status(self, name):
+        return self.run(_query_status, name)
+
+    def query_config(self, name):
+        return self.run(_query_config, name)
+
+    def query_optional_config(self, name, *info_levels):
+        return self.run(_query_optional_config, name, info_levels)
+
+    def start(self, name, wait_timeout_in_seconds=None):
+        """
+        Starts the service on every host; if wait_timeout_in_seconds is given, also waits for it to run.
+        """
+        return self.run(_start, name, wait_timeout_in_seconds)
+
+    def stop(self, name, wait_timeout_in_seconds=None):
+        """
+        Stops the service on every host; if wait_timeout_in_seconds is given, also waits for it to stop.
+        """
+        return self.run(_stop, name, wait_timeout_in_seconds)
+
+    def enumerate_services(self, *args, **kwargs):
+        return self.run(_enumerate_services, *args, **kwargs)
+
+    def close(self):
+        self._executor.shutdown(wait=False)
+        with self._lock:
+            self._closed = True
+            managers = list(self._managers.values())
+            self._managers.clear()
+            idle = [scm for scm in managers if self._retire(scm)]
+        for scm in idle:
+            self._close_manager(scm)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def _acquire_manager(self, host):
+        with self._lock:
+            scm = self._check_out(host)
+        if scm is not None:
+            return scm
+        # opening a remote SCM may take long (or hang on an unreachable host), so we do it without holding the lock
+        # and publish the connection only if no one else did meanwhile
+        opened = PooledServiceControlManager(open_sc_manager(host, None, self.access), self.pool_size)
+        with self._lock:
+            scm = self._check_out(host)
+            if scm is None and not self._closed:
+                self._managers[host] = opened
+                scm = self._check_out(host)
+        if scm is not opened:
+            self._close_manager(opened)
+        if scm is None:
+            raise RuntimeError("the fleet executor is closed")
+        return scm
+
+    def _check_out(self, host):
+        scm = self._managers.get(host)
+        if scm is None or scm.handle is None:
+            return None
+        self._users.setdefault(id(scm), [scm, 0, False])[1] += 1
+        return scm
+
+    def _release_manager(self, scm):
+        with self._lock:
+            users = self._users[id(scm)]
+            users[1] -= 1
+            if users[1] or not users[2]:
+                return
+            del self._users[id(scm)]
+        self._close_manager(scm)
+
+    def _retire(self, scm):
+        """ Marks scm to be closed by its last operation; returns True if none is running, so the caller closes it """
+        users = self._users.get(id(scm))
+        if users is None or users[1] == 0:
+            self._users.pop(id(scm), None)
+            return True
+        users[2] = True
+        return False
+
+    def _close_manager(self, scm):
+        try:
+            scm.close()
+        except WindowsError:
+            logger.debug("failed to close the SCM connection", exc_info=True)
+
+    def _run_one(self, host, started, results, operation, args, kwargs):
+        started[host] = start = monotonic()
+        try:
+            scm = self._acquire_manager(host)
+            try:
+                value = operation(scm, *args, **kwargs)
+            finally:
+                self._release_manager(scm)
+        except Exception as error:
+            results.put(FleetResult(host, None, error, monotonic() - start))
+        else:
+            results.put(FleetResult(host, value, None, monotonic() - start))
+
+    def _next_timeout(self, pending, started):
+        if self.timeout_in_seconds is None:
+            return None
+        deadlines = [started[host] + self.timeout_in_seconds for host in pending if host in started]
+        if not deadlines:
+            # nothing of ours is running yet, the pool is busy with an earlier sweep
+            return self.timeout_in_seconds
+        return max(min(deadlines) - monotonic(), 0)
+
+    def _expire(self, pending, started):
+        now = monotonic()
+        for host in sorted(pending):
+            if host in started and now - started[host] >= self.timeout_in_seconds:
+                pending.discard(host)
+                # the call may be stuck for a long while, so the next operation on this host opens a new connection
+                with self._lock:
+                    scm = self._managers.pop(host, None)
+                    idle = scm is not None and self._retire(scm)
+                if idle:
+                    self._close_manager(scm)
+                error = FleetTimeoutError("{} did not respond within {} seconds".format(host, self.timeout_in_seconds))
+                yield FleetResult(host, None, error, now - started[host])
+
+
+def _query_status(scm, name):
+    with scm.open_service(name, ServiceAccess.QUERY_STATUS) as service:
+        return service.query_status_ex()
+
+
+def _query_config(scm, name):
+    with scm.open_service(name, ServiceAccess.QUERY_CONFIG) as service:
+        return service.query_config_record()
+
+
+def _query_optional_config(scm, name, info_levels):
+    with scm.open_service(name, ServiceAccess.QUERY_CONFIG) as service:
+        return service.query_optional_config(*info_levels)
+
+
+def _start(scm, name, wait_timeout_in_seconds):
+    with scm.open_service(name, ServiceAccess.START | ServiceAccess.QUERY_STATUS) as service:
+        service.safe_start()
+        if wait_timeout_in_seconds is not None:
+            return service.wait_for_status(ServiceState.RUNNING, wait_timeout_in_seconds)
+        return service.get_status()
+
+
+def _stop(scm, name, wait_timeout_in_seconds):
+    with scm.open_service(name, ServiceAccess.STOP | ServiceAccess.QUERY_STATUS) as service:
+        service.safe_stop()
+        if wait_timeout_in_seconds is not None:
+            return service.wait_for_status(ServiceState.STOPPED, wait_timeout_in_seconds)
+        return service.get_status()
+
+
+def _enumerate_services(scm, *args, **kwargs):
+    return list(scm.enumerate_services(*args, **kwargs))
@@ -0,0 +1,203 @@
+from collections import OrderedDict
+from threading import RLock
+import functools
+
+from .utils import monotonic
+from .bindings import WindowsError
+from .common import ERROR_INVALID_HANDLE, ERROR_SERVICE_MARKED_FOR_DELETE
+
+# Errors after which a held service handle is useless and has to be reopened
+STALE_HANDLE_ERRORS = (ERROR_INVALID_HANDLE, ERROR_SERVICE_MARKED_FOR_DELETE)
+
+
+class _PoolEntry(object):
+    __slots__ = ("name", "access", "service", "opened_at", "users", "retired")
+
+    def __init__(self, name, access, service):
+        self.name = name
+        self.access = access
+        self.service = service
+        self.opened_at = monotonic()
+        # how many acquire()s were not released yet, and whether the entry left the pool while some were out
+        self.users = 0
+        self.retired = False
+
+
+class ServiceHandlePool(object):
+    """
+    Keeps open service handles keyed by (name, access rights), most recently used last. A request for a service is
+    satisfied by any held handle whose access rights are a superset of the requested ones. When the pool grows beyond
+    max_size the least recently used handle leaves the pool, and handles older than ttl seconds (if given) are
+    reopened.
+
+    Every acquire() has to be matched by a release(). A handle that leaves the pool (evicted, expired, invalidated or
+    cleared) while acquired is only closed once the last of its users released it, since the handle value of a closed
+    handle may be handed out again for another service.
+    """
+    def __init__(self, open_service, max_size=64, ttl=None):
+        super(ServiceHandlePool, self).__init__()
+        self._open_service = open_service
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._keys_by_name = dict()
+        # id(service) -> entry, for the entries that are acquired, in the pool or not
+        self._acquired = dict()
+        self._lock = RLock()
+
+    def acquire(self, name, access):
+        """
+        Returns an open Service for name that grants at least access.
+        """
+        with self._lock:
+            entry = self._find(name, access)
+            if entry is not None:
+                key = (entry.name, entry.access)
+                self._entries[key] = self._entries.pop(key)
+                return self._check_out(entry)
+        # opening may be slow (think remote SCMs), so we do not hold the lock while doing it
+        service = self._open_service(name, access)
+        with self._lock:
+            entry = self._find(name, access)
+            if entry is not None:
+                # someone else opened it while we were not looking
+                service.close()
+                return self._check_out(entry)
+            key = (name.lower(), access)
+            entry = self._entries[key] = _PoolEntry(key[0], access, service)
+            self._keys_by_name.setdefault(key[0], set()).add(key)
+            self._check_out(entry)
+            while len(self._entries) > self.max_size:
+                self._remove(next(iter(self._entries)))
+            return service
+
+    def release(self, service):
+        """
+        Hands back a Service returned by acquire(). It stays open in the pool, or is closed now if it left the pool
+        while acquired.
+        """
+        with self._lock:
+            entry = self._acquired.get(id(service))
+            if entry is None:
+                return
+            entry.users -= 1
+            if entry.users > 0:
+                return
+            del self._acquired[id(service)]
+            if entry.retired:
+                self._close(entry)
+
+    def invalidate(self, service):
+        """
+        Drops the pooled handle held by service, if it is still in the pool; it is closed once it is released.
+        """
+        with self._lock:
+            for key, entry in self._entries.items():
+                if entry.service is service:
+                    self._remove(key)
+                    return
+
+    def invalidate_name(self, name):
+        """
+        Drops all the pooled handles of a service, e.g. after it was deleted.
+        """
+        with self._lock:
+            for key in list(self._keys_by_name.get(name.lower(), ())):
+                self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            for key in list(self._entries):
+                self._remove(key)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _check_out(self, entry):
+        entry.users += 1
+        self._acquired[id(entry.service)] = entry
+        return entry.service
+
+    def _find(self, name, access):
+        keys = self._keys_by_name.get(name.lower())
+        if not keys:
+            return None
+        now = monotonic()
+        found = None
+        for key in list(keys):
+            entry = self._entries[key]
+            if self.ttl is not None and now - entry.opened_at > self.ttl:
+                self._remove(key)
+            elif found is None and entry.access & access == access:
+                found = entry
+        return found
+
+    def _remove(self, key):
+        entry = self._entries.pop(key)
+        keys = self._keys_by_name[key[0]]
+        keys.discard(key)
+        if not keys:
+            del self._keys_by_name[key[0]]
+        if entry.users:
+            entry.retired = True
+        else:
+            self._close(entry)
+
+    def _close(self, entry):
+        try:
+            entry.service.close()
+        except WindowsError:
+            pass
+
+
+class PooledService(object):
+    """
+    Stands in for a Service whose handle is owned by a ServiceHandlePool. close() hands the handle back to the pool,
+    and a call that fails because the handle went stale is retried once on a freshly opened handle.
+    """
+    def __init__(self, pool, name, access):
+        super(PooledService, self).__init__()
+        self._pool = pool
+        self._name = name
+        self._access = access
+        self._service = pool.acquire(name, access)
+
+    @property
+    def handle(self):
+        return self._service.handle
+
+    def __getattr__(self, attr):
+        value = getattr(self._service, attr)
+        if not callable(value):
+            return value
+
+        @functools.wraps(value)
+        def wrapper(*args, **kwargs):
+            try:
+                return getattr(self._service, attr)(*args, **kwargs)
+            except WindowsError as e:
+                if e.winerror not in STALE_HANDLE_ERRORS:
+                    raise
+            self._pool.invalidate(self._service)
+            service, self._service = self._service, None
+            self._pool.release(service)
+            self._service = self._pool.acquire(self._name, self._access)
+            return getattr(self._service, attr)(*args, **kwargs)
+        return wrapper
+
+    def delete(self):
+        self._service.delete()
+        # the service is gone for good once all of its handles are closed, so the pool lets go of ours (which is
+        # closed when we are)
+        self._pool.invalidate_name(self._name)
+
+    def close(self):
+        service, self._service = self._service, None
+        if service is not None:
+            self._pool.release(service)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
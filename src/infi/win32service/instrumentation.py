@@ -0,0 +1,191 @@
+from bisect import bisect_left
+from threading import Lock
+import importlib
+import sys
+import time
+
+from .bindings import GetLastError, SetLastError
+
+# The advapi32 bindings we time, by the module that declares them. Other modules that imported a binding by name
+# (e.g. notifier) are patched too, since enable() replaces every module-level reference to the same function.
+INSTRUMENTED_APIS = (
+    ("service", ("StartService", "ControlService", "DeleteService", "SetServiceStatus", "CloseServiceHandle",
+                 "QueryServiceStatus", "QueryServiceConfig", "ChangeServiceConfig", "QueryServiceStatusEx",
+                 "NotifyServiceStatusChange")),
+    ("service_control_manager", ("OpenSCManager", "OpenService", "CreateService", "EnumServicesStatusEx")),
+    ("optional_config", ("QueryServiceConfig2", "ChangeServiceConfig2")),
+    ("service_runner", ("RegisterServiceCtrlHandlerEx", )),
+)
+
+# NotifyServiceStatusChange returns its error instead of setting the last error; the others return FALSE or NULL
+_RETURNS_ERROR = frozenset(["NotifyServiceStatusChange"])
+
+# Upper bounds (in seconds) of the latency histogram buckets; the last bucket takes everything slower
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5,
+                   5.0, 10.0)
+
+_timer = getattr(time, "perf_counter", time.time)
+
+
+class ApiStats(object):
+    """ Counters of one API: calls, failures by error code, total and worst latency, and a latency histogram """
+    __slots__ = ("name", "calls", "errors", "total_time", "max_time", "histogram", "_lock")
+
+    def __init__(self, name):
+        self.name = name
+        self.calls = 0
+        self.errors = dict()
+        self.total_time = 0.0
+        self.max_time = 0.0
+        self.histogram = [0] * (len(LATENCY_BUCKETS) + 1)
+        self._lock = Lock()
+
+    def record(self, elapsed, error):
+        bucket = bisect_left(LATENCY_BUCKETS, elapsed)
+        with self._lock:
+            self.calls += 1
+            self.total_time += elapsed
+            if elapsed > self.max_time:
+                self.max_time = elapsed
+            self.histogram[bucket] += 1
+            if error:
+                self.errors[error] = self.errors.get(error, 0) + 1
+
+    def to_dict(self):
+        with self._lock:
+            return dict(calls=self.calls,
+                        errors=dict(self.errors),
+                        failures=sum(self.errors.values()),
+                        total_time=self.total_time,
+                        mean_time=self.total_time / self.calls if self.calls else 0.0,
+                        max_time=self.max_time,
+                        histogram=list(zip(LATENCY_BUCKETS + (float("inf"), ), self.histogram)))
+
+
+class _Instrumentation(object):
+    def __init__(self):
+        self._lock = Lock()
+        self._stats = dict()
+        self._sinks = []
+        # original binding -> its wrapper, and the (module, attribute) pairs we replaced
+        self._wrappers = dict()
+        self._patched = []
+
+    @property
+    def enabled(self):
+        return bool(self._patched)
+
+    def enable(self):
+        with self._lock:
+            if self._patched:
+                return
+            package = __name__.rsplit(".", 1)[0]
+            for module_name, names in INSTRUMENTED_APIS:
+                module = importlib.import_module("{}.{}".format(package, module_name))
+                for name in names:
+                    original = getattr(module, name, None)
+                    if original is not None and original not in self._wrappers:
+                        self._wrappers[original] = self._wrap(name, original)
+            for module_name, module in list(sys.modules.items()):
+                if module is None or not module_name.startswith(package + "."):
+                    continue
+                for attribute, value in list(vars(module).items()):
+                    wrapper = self._wrappers.get(value) if _hashable(value) else None
+                    if wrapper is not None:
+                        setattr(module, attribute, wrapper)
+                        self._patched.append((module, attribute, value))
+
+    def disable(self):
+        with self._lock:
+            for module, attribute, original in self._patched:
+                # leave alone whatever someone else put there since
+                if getattr(module, attribute, None) is self._wrappers.get(original):
+                    setattr(module, attribute, original)
+            del self._patched[:]
+            self._wrappers.clear()
+
+    def add_sink(self, sink):
+        """
+        Calls sink(api_name, elapsed_in_seconds, error) after every instrumented call; error is 0 if the call
+        succeeded. Sinks run on the calling thread, so they must be quick.
+        """
+        self._sinks = self._sinks + [sink]
+
+    def remove_sink(self, sink):
+        self._sinks = [item for item in self._sinks if item is not sink]
+
+    def snapshot(self):
+        """ Returns a dict of API name -> its counters (see ApiStats.to_dict) """
+        return dict((name, stats.to_dict()) for name, stats in list(self._stats.items()))
+
+    def reset(self):
+        self._stats = dict()
+
+    def _get_stats(self, name):
+        stats = self._stats.get(name)
+        if stats is None:
+            with self._lock:
+                stats = self._stats.setdefault(name, ApiStats(name))
+        return stats
+
+    def _wrap(self, name, function):
+        returns_error = name in _RETURNS_ERROR
+
+        def wrapper(*args):
+            start = _timer()
+            result = function(*args)
+            elapsed = _timer() - start
+            if returns_error:
+                error = result
+            elif not result:
+                error = GetLastError()
+            else:
+                error = 0
+            self._get_stats(name).record(elapsed, error)
+            for sink in self._sinks:
+                try:
+                    sink(name, elapsed, error)
+                except:
+                    pass
+            if error and not returns_error:
+                # the caller reads the last error right after the call, and sinks may have called into the system
+                SetLastError(error)
+            return result
+        wrapper.instrumented_function = function
+        return wrapper
+
+
+def _hashable(value):
+    try:
+        hash(value)
+    except TypeError:
+        return False
+    return True
+
+
+_instrumentation = _Instrumentation()
+
+enable = _instrumentation.enable
+disable = _instrumentation.disable
+add_sink = _instrumentation.add_sink
+remove_sink = _instrumentation.remove_sink
+snapshot = _instrumentation.snapshot
+reset = _instrumentation.reset
+
+
+def is_enabled():
+    return _instrumentation.enabled
+
+
+class SlowCallLogger(object):
+    """ A sink that logs calls slower than threshold_in_seconds, and failed calls """
+    def __init__(self, logger, threshold_in_seconds=1.0):
+        super(SlowCallLogger, self).__init__()
+        self.logger = logger
+        self.threshold_in_seconds = threshold_in_seconds
+
+    def __call__(self, name, elapsed, error):
+        if error:
+            self.logger.debug("%s failed with error %d after %.6f seconds", name, error, elapsed)
+        elif elapsed >= self.threshold_in_seconds:
+            self.logger.warning("%s took %.3f seconds", name, elapsed)
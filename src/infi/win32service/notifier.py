@@ -0,0 +1,266 @@
+import ctypes
+from ctypes import wintypes
+from collections import namedtuple, deque
+from threading import Thread, Event, Lock
+import logging
+
+from .service import (SERVICE_NOTIFY, SERVICE_NOTIFY_STATUS_CHANGE, PFN_SC_NOTIFY_CALLBACK, ServiceNotifyMask,
+                      NotifyServiceStatusChange, SleepEx, INFINITE, NO_ERROR)
+from .utils import read_multi_sz
+from .bindings import bind, is_available, WINFUNCTYPE, WinError
+
+logger = logging.getLogger(__name__)
+
+# http://msdn.microsoft.com/en-us/library/windows/desktop/ms681947%28v=vs.85%29.aspx
+# VOID CALLBACK APCProc(
+#   __in  ULONG_PTR dwParam
+# );
+PAPCFUNC = WINFUNCTYPE(None, ctypes.c_void_p)
+
+QueueUserAPC = bind("kernel32", "QueueUserAPC", (PAPCFUNC, wintypes.HANDLE, ctypes.c_void_p), wintypes.DWORD)
+OpenThread = bind("kernel32", "OpenThread", (wintypes.DWORD, wintypes.BOOL, wintypes.DWORD), wintypes.HANDLE)
+GetCurrentThreadId = bind("kernel32", "GetCurrentThreadId", (), wintypes.DWORD)
+CloseHandle = bind("kernel32", "CloseHandle", (wintypes.HANDLE, ), wintypes.BOOL)
+LocalFree = bind("kernel32", "LocalFree", (ctypes.c_void_p, ), ctypes.c_void_p)
+
+# From WinNT.h:
+THREAD_SET_CONTEXT = 0x0010
+
+ALL_STATES_MASK = (ServiceNotifyMask.STOPPED | ServiceNotifyMask.START_PENDING | ServiceNotifyMask.STOP_PENDING |
+                   ServiceNotifyMask.RUNNING | ServiceNotifyMask.CONTINUE_PENDING |
+                   ServiceNotifyMask.PAUSE_PENDING | ServiceNotifyMask.PAUSED)
+SCM_CHANGES_MASK = ServiceNotifyMask.CREATED | ServiceNotifyMask.DELETED
+
+# error is the Win32 error of the notification (NO_ERROR if it went fine), state and process_id are those reported
+# for a service handle, and service_names holds the services created ("/"-prefixed) or deleted for an SCM handle.
+ServiceNotification = namedtuple("ServiceNotification", ["error", "state", "process_id", "triggered",
+                                                         "service_names"])
+
+
+class Subscription(object):
+    __slots__ = ("key", "callback")
+
+    def __init__(self, key, callback):
+        self.key = key
+        self.callback = callback
+
+
+class _Tracked(object):
+    """ All we know about one service (or SCM) handle the notifier watches """
+    def __init__(self, handle, is_scm):
+        self.handle = handle
+        self.is_scm = is_scm
+        self.subscriptions = []
+        self.buffer = None
+        self.last = None
+
+    def next_mask(self):
+        if self.is_scm:
+            return SCM_CHANGES_MASK
+        if self.last is None or self.last.error != NO_ERROR:
+            # fires right away with the current state
+            return ALL_STATES_MASK
+        # fires on the next transition away from the state we know about
+        return ALL_STATES_MASK & ~(1 << (self.last.state - 1))
+
+
+class StatusNotifier(object):
+    """
+    Owns a thread that sits in an alertable wait and holds NotifyServiceStatusChange registrations on behalf of
+    everyone else. The SCM delivers notifications as APCs to the thread that registered them, so instead of every
+    waiter blocking a thread of its own, one thread serves all of them.
+
+    Subscribers are called on the notifier thread with a ServiceNotification: service subscribers on every state
+    change of the service (starting with its current state), SCM subscribers on every service created or deleted.
+    Callbacks must be quick; hand the work off to another thread or event loop.
+    """
+    def __init__(self):
+        super(StatusNotifier, self).__init__()
+        self._jobs = deque()
+        self._tracked = dict()
+        self._registrations = dict()
+        self._thread = None
+        self._thread_handle = None
+        self._started = Event()
+        self._stopping = False
+        self._start_lock = Lock()
+        self._callback_thunk = PFN_SC_NOTIFY_CALLBACK(self._on_notify)
+        self._wake_thunk = PAPCFUNC(self._on_wake)
+
+    @property
+    def available(self):
+        return is_available(NotifyServiceStatusChange)
+
+    def start(self):
+        with self._start_lock:
+            if self._thread is None:
+                self._stopping = False
+                self._thread = Thread(target=self._run, name="win32service-notifier")
+                self._thread.daemon = True
+                self._thread.start()
+                self._started.wait()
+
+    def stop(self):
+        if self._thread is not None:
+            self._stopping = True
+            self._submit(lambda: None)
+            self._thread.join()
+            self._thread = None
+
+    def subscribe(self, handle, callback):
+        """
+        Calls callback with a ServiceNotification whenever the service behind handle changes its state.
+        """
+        return self._subscribe(handle, callback, False)
+
+    def subscribe_scm(self, handle, callback):
+        """
+        Calls callback with a ServiceNotification whenever services are created or deleted on the SCM behind handle.
+        """
+        return self._subscribe(handle, callback, True)
+
+    def unsubscribe(self, subscription):
+        self._submit(lambda: self._unsubscribe(subscription))
+
+    def flush(self, timeout=None):
+        """
+        Waits until the notifier thread is done with every subscribe, unsubscribe and close submitted so far, which
+        otherwise happen asynchronously. Returns False on timeout.
+        """
+        done = Event()
+        self.start()
+        self._submit(done.set)
+        return done.wait(timeout)
+
+    def close(self, handle_owner):
+        """
+        Closes a Service or ServiceControlManager on the notifier thread, which cancels its pending registrations.
+        Objects that were subscribed must be closed through here, since their registrations still point at buffers
+        the notifier holds. Returns an Event that is set once the handle is closed.
+        """
+        done = Event()
+
+        def close():
+            try:
+                tracked = self._tracked.pop(_handle_value(handle_owner.handle), None)
+                handle_owner.close()
+                if tracked is not None and tracked.buffer is not None:
+                    self._registrations.pop(ctypes.addressof(tracked.buffer), None)
+            finally:
+                done.set()
+        self.start()
+        self._submit(close)
+        return done
+
+    def _subscribe(self, handle, callback, is_scm):
+        self.start()
+        subscription = Subscription(_handle_value(handle), callback)
+        self._submit(lambda: self._add_subscription(subscription, is_scm))
+        return subscription
+
+    def _submit(self, job):
+        self._jobs.append(job)
+        if self._thread_handle is not None:
+            if not QueueUserAPC(self._wake_thunk, self._thread_handle, None):
+                raise WinError()
+
+    def _run(self):
+        self._thread_handle = OpenThread(THREAD_SET_CONTEXT, False, GetCurrentThreadId())
+        self._started.set()
+        try:
+            while not self._stopping:
+                # jobs submitted before the thread handle existed did not queue a wake-up, so we look first
+                while self._jobs:
+                    try:
+                        self._jobs.popleft()()
+                    except:
+                        logger.exception("notifier job failed")
+                if not self._stopping:
+                    SleepEx(INFINITE, True)
+        finally:
+            CloseHandle(self._thread_handle)
+            self._thread_handle = None
+
+    def _on_wake(self, dwParam):
+        pass
+
+    def _add_subscription(self, subscription, is_scm):
+        tracked = self._tracked.get(subscription.key)
+        if tracked is None:
+            tracked = self._tracked[subscription.key] = _Tracked(wintypes.SC_HANDLE(subscription.key), is_scm)
+        tracked.subscriptions.append(subscription)
+        if tracked.last is not None and tracked.last.error == NO_ERROR and not is_scm:
+            self._deliver(subscription, tracked.last)
+        self._arm(tracked)
+
+    def _unsubscribe(self, subscription):
+        tracked = self._tracked.get(subscription.key)
+        if tracked is not None and subscription in tracked.subscriptions:
+            tracked.subscriptions.remove(subscription)
+            if not tracked.subscriptions and tracked.buffer is None:
+                del self._tracked[subscription.key]
+
+    def _arm(self, tracked):
+        # http://msdn.microsoft.com/en-us/library/windows/desktop/ms684276%28v=vs.85%29.aspx
+        if tracked.buffer is not None or not tracked.subscriptions:
+            return
+        buffer = SERVICE_NOTIFY()
+        buffer.dwVersion = SERVICE_NOTIFY_STATUS_CHANGE
+        buffer.pfnNotifyCallback = self._callback_thunk
+        result = NotifyServiceStatusChange(tracked.handle, tracked.next_mask(), ctypes.byref(buffer))
+        if result != NO_ERROR:
+            # e.g. ERROR_SERVICE_NOTIFY_CLIENT_LAGGING or ERROR_SERVICE_MARKED_FOR_DELETE; subscribers get the error
+            # and are expected to fall back to something else
+            notification = ServiceNotification(result, None, None, 0, [])
+            tracked.last = notification
+            for subscription in list(tracked.subscriptions):
+                self._deliver(subscription, notification)
+            return
+        tracked.buffer = buffer
+        self._registrations[ctypes.addressof(buffer)] = tracked
+
+    def _on_notify(self, pParameter):
+        tracked = self._registrations.pop(pParameter, None)
+        if tracked is None or self._tracked.get(_handle_value(tracked.handle)) is not tracked:
+            return
+        buffer, tracked.buffer = tracked.buffer, None
+        service_names = []
+        if buffer.pszServiceNames:
+            service_names = read_multi_sz(buffer.pszServiceNames)
+            LocalFree(buffer.pszServiceNames)
+        notification = ServiceNotification(buffer.dwNotificationStatus, buffer.ServiceStatus.dwCurrentState,
+                                           buffer.ServiceStatus.dwProcessId, buffer.dwNotificationTriggered,
+                                           service_names)
+        tracked.last = notification
+        for subscription in list(tracked.subscriptions):
+            self._deliver(subscription, notification)
+        if tracked.subscriptions:
+            if notification.error == NO_ERROR:
+                self._arm(tracked)
+        else:
+            del self._tracked[_handle_value(tracked.handle)]
+
+    def _deliver(self, subscription, notification):
+        try:
+            subscription.callback(notification)
+        except:
+            logger.exception("exception caught in service notification callback")
+
+
+def _handle_value(handle):
+    return handle.value if hasattr(handle, "value") else handle
+
+
+_notifier = None
+_notifier_lock = Lock()
+
+
+def get_notifier():
+    """
+    Returns the process-wide StatusNotifier, or None if the system does not support status change notifications.
+    """
+    global _notifier
+    with _notifier_lock:
+        if _notifier is None:
+            _notifier = StatusNotifier()
+    return _notifier if _notifier.available else None
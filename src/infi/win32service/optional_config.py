@@ -0,0 +1,212 @@
+import ctypes
+from ctypes import wintypes
+from collections import namedtuple
+from threading import local
+
+from .utils import enum, read_multi_sz
+from .bindings import bind, WinError, GetLastError
+from .common import ERROR_INSUFFICIENT_BUFFER
+
+# http://msdn.microsoft.com/en-us/library/windows/desktop/ms684935%28v=VS.85%29.aspx
+# -- QueryServiceConfig2.dwInfoLevel:
+ServiceConfigInfoLevel = enum(
+    DESCRIPTION              = 1,
+    FAILURE_ACTIONS          = 2,
+    DELAYED_AUTO_START_INFO  = 3,
+    FAILURE_ACTIONS_FLAG     = 4,
+    SERVICE_SID_INFO         = 5,
+    REQUIRED_PRIVILEGES_INFO = 6,
+    PRESHUTDOWN_INFO         = 7)
+
+# http://msdn.microsoft.com/en-us/library/windows/desktop/ms685126%28v=vs.85%29.aspx
+SCActionType = enum(
+    NONE        = 0,
+    RESTART     = 1,
+    REBOOT      = 2,
+    RUN_COMMAND = 3)
+
+# http://msdn.microsoft.com/en-us/library/windows/desktop/ms685987%28v=vs.85%29.aspx
+ServiceSidType = enum(
+    NONE         = 0x00000000,
+    UNRESTRICTED = 0x00000001,
+    RESTRICTED   = 0x00000003)
+
+# From WinError.h:
+ERROR_INVALID_LEVEL = 124
+
+# typedef struct _SERVICE_DESCRIPTION {
+#   LPTSTR lpDescription;
+# } SERVICE_DESCRIPTION, *LPSERVICE_DESCRIPTION;
+class SERVICE_DESCRIPTION(ctypes.Structure):
+    _fields_ = [("lpDescription", wintypes.LPWSTR)]
+
+# typedef struct _SC_ACTION {
+#   SC_ACTION_TYPE Type;
+#   DWORD          Delay;
+# } SC_ACTION, *LPSC_ACTION;
+class SC_ACTION(ctypes.Structure):
+    _fields_ = [("Type", ctypes.c_int),
+                ("Delay", wintypes.DWORD)]
+
+# typedef struct _SERVICE_FAILURE_ACTIONS {
+#   DWORD     dwResetPeriod;
+#   LPTSTR    lpRebootMsg;
+#   LPTSTR    lpCommand;
+#   DWORD     cActions;
+#   SC_ACTION *lpsaActions;
+# } SERVICE_FAILURE_ACTIONS, *LPSERVICE_FAILURE_ACTIONS;
+class SERVICE_FAILURE_ACTIONS(ctypes.Structure):
+    _fields_ = [("dwResetPeriod", wintypes.DWORD),
+                ("lpRebootMsg", wintypes.LPWSTR),
+                ("lpCommand", wintypes.LPWSTR),
+                ("cActions", wintypes.DWORD),
+                ("lpsaActions", ctypes.POINTER(SC_ACTION))]
+
+# typedef struct _SERVICE_DELAYED_AUTO_START_INFO {
+#   BOOL fDelayedAutostart;
+# } SERVICE_DELAYED_AUTO_START_INFO, *LPSERVICE_DELAYED_AUTO_START_INFO;
+class SERVICE_DELAYED_AUTO_START_INFO(ctypes.Structure):
+    _fields_ = [("fDelayedAutostart", wintypes.BOOL)]
+
+# typedef struct _SERVICE_FAILURE_ACTIONS_FLAG {
+#   BOOL fFailureActionsOnNonCrashFailures;
+# } SERVICE_FAILURE_ACTIONS_FLAG, *LPSERVICE_FAILURE_ACTIONS_FLAG;
+class SERVICE_FAILURE_ACTIONS_FLAG(ctypes.Structure):
+    _fields_ = [("fFailureActionsOnNonCrashFailures", wintypes.BOOL)]
+
+# typedef struct _SERVICE_SID_INFO {
+#   DWORD dwServiceSidType;
+# } SERVICE_SID_INFO, *LPSERVICE_SID_INFO;
+class SERVICE_SID_INFO(ctypes.Structure):
+    _fields_ = [("dwServiceSidType", wintypes.DWORD)]
+
+# typedef struct _SERVICE_REQUIRED_PRIVILEGES_INFO {
+#   LPTSTR pmszRequiredPrivileges;
+# } SERVICE_REQUIRED_PRIVILEGES_INFO, *LPSERVICE_REQUIRED_PRIVILEGES_INFO;
+class SERVICE_REQUIRED_PRIVILEGES_INFO(ctypes.Structure):
+    _fields_ = [("pmszRequiredPrivileges", ctypes.c_void_p)]
+
+# typedef struct _SERVICE_PRESHUTDOWN_INFO {
+#   DWORD dwPreshutdownTimeout;
+# } SERVICE_PRESHUTDOWN_INFO, *LPSERVICE_PRESHUTDOWN_INFO;
+class SERVICE_PRESHUTDOWN_INFO(ctypes.Structure):
+    _fields_ = [("dwPreshutdownTimeout", wintypes.DWORD)]
+
+
+QueryServiceConfig2 = bind("advapi32", "QueryServiceConfig2W",
+                           (wintypes.SC_HANDLE, wintypes.DWORD, ctypes.c_void_p, wintypes.DWORD,
+                            ctypes.POINTER(wintypes.DWORD)),
+                           wintypes.BOOL)
+ChangeServiceConfig2 = bind("advapi32", "ChangeServiceConfig2W", (wintypes.SC_HANDLE, wintypes.DWORD, ctypes.c_void_p),
+                            wintypes.BOOL)
+
+FailureActions = namedtuple("FailureActions", ["reset_period", "reboot_message", "command", "actions"])
+FailureAction = namedtuple("FailureAction", ["type", "delay"])
+
+
+def _decode_failure_actions(info):
+    actions = [FailureAction(info.lpsaActions[index].Type, info.lpsaActions[index].Delay)
+               for index in range(info.cActions)]
+    return FailureActions(info.dwResetPeriod, info.lpRebootMsg, info.lpCommand, actions)
+
+# info level -> (snapshot attribute, structure, decoder)
+_INFO_LEVELS = {
+    ServiceConfigInfoLevel.DESCRIPTION: ("description", SERVICE_DESCRIPTION,
+                                         lambda info: info.lpDescription),
+    ServiceConfigInfoLevel.FAILURE_ACTIONS: ("failure_actions", SERVICE_FAILURE_ACTIONS, _decode_failure_actions),
+    ServiceConfigInfoLevel.DELAYED_AUTO_START_INFO: ("delayed_auto_start", SERVICE_DELAYED_AUTO_START_INFO,
+                                                     lambda info: bool(info.fDelayedAutostart)),
+    ServiceConfigInfoLevel.FAILURE_ACTIONS_FLAG: ("failure_actions_on_non_crash_failures",
+                                                  SERVICE_FAILURE_ACTIONS_FLAG,
+                                                  lambda info: bool(info.fFailureActionsOnNonCrashFailures)),
+    ServiceConfigInfoLevel.SERVICE_SID_INFO: ("service_sid_type", SERVICE_SID_INFO,
+                                              lambda info: info.dwServiceSidType),
+    ServiceConfigInfoLevel.REQUIRED_PRIVILEGES_INFO: ("required_privileges", SERVICE_REQUIRED_PRIVILEGES_INFO,
+                                                      lambda info: read_multi_sz(info.pmszRequiredPrivileges)),
+    ServiceConfigInfoLevel.PRESHUTDOWN_INFO: ("preshutdown_timeout", SERVICE_PRESHUTDOWN_INFO,
+                                              lambda info: info.dwPreshutdownTimeout),
+}
+
+ALL_INFO_LEVELS = tuple(sorted(_INFO_LEVELS))
+
+
+class OptionalConfigSnapshot(object):
+    """
+    The optional configuration of a service, as returned by QueryServiceConfig2. Attributes of info levels that were
+    not queried (or that the system does not support) are None.
+    """
+    __slots__ = tuple(attribute for attribute, _, _ in _INFO_LEVELS.values())
+
+    def __init__(self):
+        for attribute in self.__slots__:
+            setattr(self, attribute, None)
+
+    def to_dict(self):
+        return dict((attribute, getattr(self, attribute)) for attribute in self.__slots__)
+
+    def __repr__(self):
+        return "<OptionalConfigSnapshot {!r}>".format(self.to_dict())
+
+
+# QueryServiceConfig2 buffers start this small and grow to what the SCM asked for (the docs cap them at 8K bytes)
+QUERY_CONFIG2_INITIAL_BUFFER_SIZE = 1024
+
+
+class _Config2Buffer(local):
+    def __init__(self):
+        super(_Config2Buffer, self).__init__()
+        self.bytes_needed = wintypes.DWORD()
+        self.bytes_needed_ref = ctypes.byref(self.bytes_needed)
+        self.resize(QUERY_CONFIG2_INITIAL_BUFFER_SIZE)
+
+    def resize(self, size):
+        self.size = size
+        self.buffer = ctypes.create_string_buffer(size)
+        self.address = ctypes.addressof(self.buffer)
+
+_config2_buffer = _Config2Buffer()
+
+
+def query_optional_config(handle, info_levels=ALL_INFO_LEVELS):
+    """
+    Queries every one of info_levels on the service handle, reusing one per-thread buffer for all of them, and
+    returns an OptionalConfigSnapshot.
+    """
+    # http://msdn.microsoft.com/en-us/library/windows/desktop/ms684935%28v=VS.85%29.aspx
+    # BOOL WINAPI QueryServiceConfig2(
+    #   __in       SC_HANDLE hService,
+    #   __in       DWORD dwInfoLevel,
+    #   __out_opt  LPBYTE lpBuffer,
+    #   __in       DWORD cbBufSize,
+    #   __out      LPDWORD pcbBytesNeeded
+    # );
+    buffer = _config2_buffer
+    snapshot = OptionalConfigSnapshot()
+    for info_level in info_levels:
+        attribute, structure, decode = _INFO_LEVELS[info_level]
+        while not QueryServiceConfig2(handle, info_level, buffer.address, buffer.size, buffer.bytes_needed_ref):
+            error = GetLastError()
+            if error == ERROR_INVALID_LEVEL:
+                # older systems do not know about the newer info levels
+                break
+            if error != ERROR_INSUFFICIENT_BUFFER or buffer.size >= buffer.bytes_needed.value:
+                raise WinError(error)
+            buffer.resize(buffer.bytes_needed.value)
+        else:
+            # the structure's pointers point into the buffer, so we decode it before the next query
+            setattr(snapshot, attribute, decode(structure.from_address(buffer.address)))
+    return snapshot
+
+
+def change_optional_config(handle, info_level, info):
+    """
+    Sets one info level of the service's optional configuration; info is the matching structure.
+    """
+    # http://msdn.microsoft.com/en-us/library/windows/desktop/ms681988%28v=vs.85%29.aspx
+    # BOOL WINAPI ChangeServiceConfig2(
+    #   __in      SC_HANDLE hService,
+    #   __in      DWORD dwInfoLevel,
+    #   __in_opt  LPVOID lpInfo
+    # );
+    if not ChangeServiceConfig2(handle, info_level, ctypes.byref(info)):
+        raise WinError()
@@ -0,0 +1,121 @@
+from concurrent.futures import ThreadPoolExecutor
+import logging
+
+from .utils import monotonic
+from .service import ServiceState, SC_GROUP_IDENTIFIER
+from .service_control_manager import ServiceAccess
+
+logger = logging.getLogger(__name__)
+
+ORCHESTRATOR_ACCESS = (ServiceAccess.QUERY_CONFIG | ServiceAccess.QUERY_STATUS |
+                       ServiceAccess.START | ServiceAccess.STOP)
+
+
+class OrchestrationError(RuntimeError):
+    """
+    Raised when services in a wave failed to reach their target state. failures maps service names to exceptions;
+    services in later waves were not touched.
+    """
+    def __init__(self, message, failures):
+        super(OrchestrationError, self).__init__(message)
+        self.failures = failures
+
+
+class DependencyCycleError(RuntimeError):
+    pass
+
+
+def dependency_waves(dependencies):
+    """
+    Given a dict of name -> names it depends on, returns a list of waves (lists of names) such that every name
+    comes after all of its dependencies. Dependencies outside the dict are ignored.
+    """
+    remaining = dict((name, set(deps) & set(dependencies)) for name, deps in dependencies.items())
+    waves = []
+    while remaining:
+        wave = sorted(name for name, deps in remaining.items() if not deps)
+        if not wave:
+            raise DependencyCycleError("dependency cycle between services: {}".format(", ".join(sorted(remaining))))
+        waves.append(wave)
+        for name in wave:
+            del remaining[name]
+        for deps in remaining.values():
+            deps.difference_update(wave)
+    return waves
+
+
+class ServiceOrchestrator(object):
+    """
+    Starts or stops a set of services in dependency order: every wave holds the services whose dependencies (within
+    the set) are already taken care of, and the services of a wave are started (or stopped) in parallel on a
+    bounded thread pool. A wave is done when all of its services reached their target state. Every service gets
+    timeout_in_seconds (None waits forever) for it all, including waiting for it to leave a pending state first.
+    """
+    def __init__(self, scm, max_workers=8, timeout_in_seconds=60):
+        super(ServiceOrchestrator, self).__init__()
+        self.scm = scm
+        self.max_workers = max_workers
+        self.timeout_in_seconds = timeout_in_seconds
+
+    def dependency_graph(self, names):
+        """
+        Returns a dict of name -> set of names (out of the given ones) the service depends on. Names are compared
+        case-insensitively, as the SCM does, and dependencies on load ordering groups are left out.
+        """
+        by_lower_name = dict((name.lower(), name) for name in names)
+        graph = dict()
+        for name in names:
+            with self.scm.open_service(name, ServiceAccess.QUERY_CONFIG) as service:
+                dependencies = service.query_dependencies()
+            graph[name] = set(by_lower_name[dependency.lower()] for dependency in dependencies
+                              if not dependency.startswith(SC_GROUP_IDENTIFIER) and
+                              dependency.lower() in by_lower_name)
+        return graph
+
+    def start(self, names):
+        """
+        Starts the services, dependencies first.
+        """
+        self._run_waves(dependency_waves(self.dependency_graph(names)), self._start_one)
+
+    def stop(self, names):
+        """
+        Stops the services, dependents first.
+        """
+        self._run_waves(list(reversed(dependency_waves(self.dependency_graph(names)))), self._stop_one)
+
+    def _run_waves(self, waves, action):
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            for wave in waves:
+                logger.debug("running %s on %s", action.__name__, wave)
+                futures = [(name, executor.submit(action, name)) for name in wave]
+                failures = dict()
+                for name, future in futures:
+                    error = future.exception()
+                    if error is not None:
+                        failures[name] = error
+                if failures:
+                    raise OrchestrationError("failed on services: {}".format(", ".join(sorted(failures))), failures)
+
+    def _start_one(self, name):
+        remaining = self._time_left()
+        with self.scm.open_service(name, ORCHESTRATOR_ACCESS) as service:
+            service.wait_on_pending(remaining())
+            service.safe_start()
+            state = service.wait_for_status((ServiceState.RUNNING, ServiceState.STOPPED), remaining())
+            if state != ServiceState.RUNNING:
+                raise RuntimeError("service {} stopped while starting".format(name))
+
+    def _stop_one(self, name):
+        remaining = self._time_left()
+        with self.scm.open_service(name, ORCHESTRATOR_ACCESS) as service:
+            service.wait_on_pending(remaining())
+            service.safe_stop()
+            service.wait_for_status(ServiceState.STOPPED, remaining())
+
+    def _time_left(self):
+        # returns a function telling how much of timeout_in_seconds is left from now on
+        if self.timeout_in_seconds is None:
+            return lambda: None
+        deadline = monotonic() + self.timeout_in_seconds
+        return lambda: max(deadline - monotonic(), 0)
@@ -0,0 +1,252 @@
+from concurrent.futures import ThreadPoolExecutor
+from collections import namedtuple
+from threading import Event, Lock
+import logging
+import time
+
+from .utils import monotonic
+from .bindings import WindowsError
+from .common import (ERROR_SERVICE_DATABASE_LOCKED, ERROR_SERVICE_DOES_NOT_EXIST,
+                     ERROR_SERVICE_MARKED_FOR_DELETE, ERROR_SERVICE_EXISTS)
+from .service import ServiceState, NO_ERROR
+from .service_control_manager import (ServiceControlManager, ServiceManagerAccess, ServiceAccess, ServiceErrorControl,
+                                      open_sc_manager)
+from .notifier import get_notifier
+
+logger = logging.getLogger(__name__)
+
+# From WinNT.h (a standard access right, so ServiceAccess does not list it on its own):
+DELETE = 0x00010000
+
+PROVISIONING_SCM_ACCESS = (ServiceManagerAccess.CONNECT | ServiceManagerAccess.CREATE_SERVICE |
+                           ServiceManagerAccess.ENUMERATE_SERVICE)
+PROVISIONING_SERVICE_ACCESS = ServiceAccess.QUERY_STATUS | ServiceAccess.STOP | DELETE
+
+# Errors that go away by themselves: the SCM database is locked by someone else for a moment, and a service of the
+# same name is marked for deletion and goes once its last handle is closed
+TRANSIENT_ERRORS = (ERROR_SERVICE_DATABASE_LOCKED, ERROR_SERVICE_MARKED_FOR_DELETE)
+
+RETRY_INITIAL_DELAY = 0.05
+RETRY_MAX_DELAY = 2.0
+DELETION_POLL_INITIAL_INTERVAL = 0.05
+DELETION_POLL_MAX_INTERVAL = 1.0
+
+# The arguments of ServiceControlManager.create_service, for create_services
+ServiceSpec = namedtuple("ServiceSpec", ["name", "display_name", "type", "start_type", "path", "load_order_group",
+                                         "dependencies", "error_control", "account", "account_password"])
+ServiceSpec.__new__.__defaults__ = (None, None, ServiceErrorControl.NORMAL, None, None)
+
+# error is the exception the operation ended with (None if it went fine), attempts the number of CreateService (or
+# DeleteService) calls it took, and elapsed is counted from the moment it started running, not from when it was queued
+ProvisionResult = namedtuple("ProvisionResult", ["name", "error", "attempts", "elapsed"])
+
+
+class ProvisionTimeoutError(RuntimeError):
+    pass
+
+
+class _DeletionTracker(object):
+    """
+    Tells when services are gone from the SCM database. A deleted service lingers (marked for deletion) until its
+    last handle is closed, so rather than guess how long that takes we wait for the SCM to notify the deletion, and
+    check the database whenever it does. Without notification support the database is polled with a backoff.
+    """
+    def __init__(self, scm, notifier):
+        super(_DeletionTracker, self).__init__()
+        self._scm = scm
+        self._notifier = notifier
+        self._lock = Lock()
+        self._events = dict()
+        if notifier is not None:
+            notifier.subscribe_scm(scm.handle, self._on_scm_change)
+            notifier.flush()
+
+    def wait(self, name, deadline):
+        """ Waits until the service called name is gone; returns False if it is still there at deadline """
+        with self._lock:
+            event = self._events.setdefault(name.lower(), Event())
+        # we listen before we look, so a deletion is either seen by the first look or notified
+        interval = DELETION_POLL_INITIAL_INTERVAL
+        try:
+            while self._scm.is_service_exist(name):
+                remaining = deadline - monotonic()
+                if remaining <= 0:
+                    return False
+                if event.wait(min(interval, remaining)):
+                    # deleted, and maybe already created again by someone else; either way we check again
+                    event.clear()
+                interval = min(interval * 2, DELETION_POLL_MAX_INTERVAL)
+            return True
+        finally:
+            with self._lock:
+                if self._events.get(name.lower()) is event:
+                    del self._events[name.lower()]
+
+    def _on_scm_change(self, notification):
+        with self._lock:
+            if notification.error != NO_ERROR:
+                logger.error("service deletion notifications failed with error %d, polling instead",
+                             notification.error)
+                events = list(self._events.values())
+            else:
+                events = [self._events[name.lower()] for name in notification.service_names
+                          if not name.startswith(u"/") and name.lower() in self._events]
+        for event in events:
+            event.set()
+
+
+class ServiceProvisioner(object):
+    """
+    Creates and deletes services in batches, on a pool of max_workers threads sharing one SCM connection.
+
+    Deleting a service (stopping it first, if it runs) waits until the SCM is done with it, as told by its deletion
+    notifications, so a service can be created again under the same name right after delete_services() returns.
+    Creating a service that is still marked for deletion waits for the deletion the same way and tries again, and
+    errors in TRANSIENT_ERRORS are retried with a backoff, up to retries times. Every service gets
+    timeout_in_seconds for all of that, after which it is reported with a ProvisionTimeoutError.
+
+    Both batch operations return a list of ProvisionResult tuples, one per service in the order they were given;
+    failures are reported there rather than raised.
+
+    >>> with ServiceProvisioner() as provisioner:
+    ...     specs = [ServiceSpec(u"Worker%d" % index, None, ServiceType.WIN32_OWN_PROCESS, ServiceStartType.DEMAND,
+    ...                          u"C:\\\\worker.exe %d" % index) for index in range(200)]
+    ...     failed = [result for result in provisioner.create_services(specs, replace=True) if result.error]
+    """
+    def __init__(self, machine=None, max_workers=16, retries=5, timeout_in_seconds=60, notifier=None):
+        super(ServiceProvisioner, self).__init__()
+        self.machine = machine
+        self.max_workers = max_workers
+        self.retries = retries
+        self.timeout_in_seconds = timeout_in_seconds
+        self._notifier = notifier
+        self._scm = None
+        self._tracker = None
+        self._executor = None
+
+    def start(self):
+        if self._scm is None:
+            if self._notifier is None:
+                self._notifier = get_notifier()
+            self._scm = ServiceControlManager(open_sc_manager(self.machine, None, PROVISIONING_SCM_ACCESS))
+            self._tracker = _DeletionTracker(self._scm, self._notifier)
+            self._executor = ThreadPoolExecutor(max_workers=self.max_workers)
+        return self
+
+    def close(self):
+        if self._scm is None:
+            return
+        self._executor.shutdown()
+        if self._notifier is not None:
+            self._notifier.close(self._scm)
+        else:
+            self._scm.close()
+        self._scm = self._tracker = self._executor = None
+
+    def create_services(self, specs, replace=False):
+        """
+        Creates a service for every ServiceSpec in specs. A service that already exists is reported with
+        ERROR_SERVICE_EXISTS, unless replace is True, in which case it is deleted (see delete_services) and created
+        anew.
+        """
+        return self._run_batch(self._create, [(spec.name, spec) for spec in specs], replace)
+
+    def delete_services(self, names, stop=True, wait=True, missing_ok=True):
+        """
+        Deletes the services called names. A running service is stopped first when stop is True (otherwise it stays
+        marked for deletion until it stops); wait=False returns as soon as the services are marked for deletion.
+        Services that do not exist count as deleted, unless missing_ok is False.
+        """
+        return self._run_batch(self._delete, [(name, name) for name in names], stop, wait, missing_ok)
+
+    def _run_batch(self, operation, items, *args):
+        self.start()
+        futures = [self._executor.submit(self._run_one, operation, name, item, args) for name, item in items]
+        return [future.result() for future in futures]
+
+    def _run_one(self, operation, name, item, args):
+        started = monotonic()
+        attempts = [0]
+        failure = None
+        try:
+            operation(item, started + self.timeout_in_seconds, attempts, *args)
+        except Exception as error:
+            logger.debug("provisioning %s failed: %s", name, error)
+            failure = error
+        return ProvisionResult(name, failure, attempts[0], monotonic() - started)
+
+    def _create(self, spec, deadline, attempts, replace):
+        while True:
+            attempts[0] += 1
+            try:
+                self._scm.create_service(*spec, access=ServiceAccess.QUERY_STATUS).close()
+                return
+            except WindowsError as error:
+                if attempts[0] > self.retries:
+                    raise
+                if error.winerror == ERROR_SERVICE_EXISTS and replace:
+                    self._delete(spec.name, deadline, [0], True, True, True)
+                elif error.winerror == ERROR_SERVICE_MARKED_FOR_DELETE:
+                    self._wait_until_deleted(spec.name, deadline)
+                elif error.winerror in TRANSIENT_ERRORS:
+                    self._back_off(attempts[0], deadline, error)
+                else:
+                    raise
+
+    def _delete(self, name, deadline, attempts, stop, wait, missing_ok):
+        try:
+            service = self._scm.open_service(name, PROVISIONING_SERVICE_ACCESS)
+        except WindowsError as error:
+            if error.winerror == ERROR_SERVICE_DOES_NOT_EXIST and missing_ok:
+                return
+            raise
+        with service:
+            if stop:
+                self._stop(service, deadline)
+            while True:
+                attempts[0] += 1
+                try:
+                    service.delete()
+                    break
+                except WindowsError as error:
+                    if error.winerror == ERROR_SERVICE_MARKED_FOR_DELETE:
+                        # someone else deleted it, we wait for it all the same
+                        break
+                    if error.winerror not in TRANSIENT_ERRORS or attempts[0] > self.retries:
+                        raise
+                    self._back_off(attempts[0], deadline, error)
+        if wait:
+            self._wait_until_deleted(name, deadline)
+
+    def _stop(self, service, deadline):
+        service.wait_on_pending(max(deadline - monotonic(), 0))
+        service.safe_stop()
+        service.wait_for_status(ServiceState.STOPPED, max(deadline - monotonic(), 0))
+
+    def _wait_until_deleted(self, name, deadline):
+        if not self._tracker.wait(name, deadline):
+            raise ProvisionTimeoutError("{} is still marked for deletion".format(name))
+
+    def _back_off(self, attempt, deadline, error):
+        delay = min(RETRY_INITIAL_DELAY * 2 ** (attempt - 1), RETRY_MAX_DELAY)
+        if monotonic() + delay > deadline:
+            raise ProvisionTimeoutError("gave up retrying after error {}".format(error.winerror))
+        time.sleep(delay)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+
+def create_services(specs, machine=None, max_workers=16, replace=False, **kwargs):
+    """ Creates services in a batch with a ServiceProvisioner of its own (see ServiceProvisioner.create_services) """
+    with ServiceProvisioner(machine, max_workers, **kwargs) as provisioner:
+        return provisioner.create_services(specs, replace)
+
+
+def delete_services(names, machine=None, max_workers=16, stop=True, wait=True, missing_ok=True, **kwargs):
+    """ Deletes services in a batch with a ServiceProvisioner of its own (see ServiceProvisioner.delete_services) """
+    with ServiceProvisioner(machine, max_workers, **kwargs) as provisioner:
+        return provisioner.delete_services(names, stop, wait, missing_ok)
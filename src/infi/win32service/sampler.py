@@ -0,0 +1,355 @@
+import ctypes
+from ctypes import wintypes
+from array import array
+from collections import namedtuple
+from threading import Thread, Event, Lock
+import logging
+
+from .utils import monotonic
+from .bindings import bind, WinError, WindowsError, GetLastError
+from .service_control_manager import (ServiceControlManagerContext, ServiceManagerAccess, ServiceEnumState,
+                                      SERVICE_WIN32)
+
+logger = logging.getLogger(__name__)
+
+# From WinNT.h:
+PROCESS_QUERY_LIMITED_INFORMATION = 0x1000
+
+# http://msdn.microsoft.com/en-us/library/windows/desktop/ms684877%28v=vs.85%29.aspx
+# typedef struct _PROCESS_MEMORY_COUNTERS_EX {
+#   DWORD  cb;
+#   DWORD  PageFaultCount;
+#   SIZE_T PeakWorkingSetSize;
+#   SIZE_T WorkingSetSize;
+#   SIZE_T QuotaPeakPagedPoolUsage;
+#   SIZE_T QuotaPagedPoolUsage;
+#   SIZE_T QuotaPeakNonPagedPoolUsage;
+#   SIZE_T QuotaNonPagedPoolUsage;
+#   SIZE_T PagefileUsage;
+#   SIZE_T PeakPagefileUsage;
+#   SIZE_T PrivateUsage;
+# } PROCESS_MEMORY_COUNTERS_EX, *PPROCESS_MEMORY_COUNTERS_EX;
+class PROCESS_MEMORY_COUNTERS_EX(ctypes.Structure):
+    _fields_ = [("cb", wintypes.DWORD),
+                ("PageFaultCount", wintypes.DWORD),
+                ("PeakWorkingSetSize", ctypes.c_size_t),
+                ("WorkingSetSize", ctypes.c_size_t),
+                ("QuotaPeakPagedPoolUsage", ctypes.c_size_t),
+                ("QuotaPagedPoolUsage", ctypes.c_size_t),
+                ("QuotaPeakNonPagedPoolUsage", ctypes.c_size_t),
+                ("QuotaNonPagedPoolUsage", ctypes.c_size_t),
+                ("PagefileUsage", ctypes.c_size_t),
+                ("PeakPagefileUsage", ctypes.c_size_t),
+                ("PrivateUsage", ctypes.c_size_t)]
+
+# http://msdn.microsoft.com/en-us/library/windows/desktop/ms684320%28v=vs.85%29.aspx
+# HANDLE WINAPI OpenProcess(
+#   __in  DWORD dwDesiredAccess,
+#   __in  BOOL bInheritHandle,
+#   __in  DWORD dwProcessId
+# );
+OpenProcess = bind("kernel32", "OpenProcess", (wintypes.DWORD, wintypes.BOOL, wintypes.DWORD), wintypes.HANDLE)
+CloseHandle = bind("kernel32", "CloseHandle", (wintypes.HANDLE, ), wintypes.BOOL)
+
+# http://msdn.microsoft.com/en-us/library/windows/desktop/ms683223%28v=vs.85%29.aspx
+# BOOL WINAPI GetProcessTimes(
+#   __in   HANDLE hProcess,
+#   __out  LPFILETIME lpCreationTime,
+#   __out  LPFILETIME lpExitTime,
+#   __out  LPFILETIME lpKernelTime,
+#   __out  LPFILETIME lpUserTime
+# );
+GetProcessTimes = bind("kernel32", "GetProcessTimes",
+                       (wintypes.HANDLE, ctypes.POINTER(wintypes.FILETIME), ctypes.POINTER(wintypes.FILETIME),
+                        ctypes.POINTER(wintypes.FILETIME), ctypes.POINTER(wintypes.FILETIME)),
+                       wintypes.BOOL)
+
+# http://msdn.microsoft.com/en-us/library/windows/desktop/ms683219%28v=vs.85%29.aspx
+# BOOL WINAPI GetProcessMemoryInfo(
+#   __in   HANDLE Process,
+#   __out  PPROCESS_MEMORY_COUNTERS ppsmemCounters,
+#   __in   DWORD cb
+# );
+# kernel32 exports it as K32GetProcessMemoryInfo since Windows 7, which spares us loading psapi
+GetProcessMemoryInfo = bind("kernel32", "K32GetProcessMemoryInfo",
+                            (wintypes.HANDLE, ctypes.POINTER(PROCESS_MEMORY_COUNTERS_EX), wintypes.DWORD),
+                            wintypes.BOOL)
+
+# http://msdn.microsoft.com/en-us/library/windows/desktop/ms683214%28v=vs.85%29.aspx
+# BOOL WINAPI GetProcessHandleCount(
+#   __in     HANDLE hProcess,
+#   __inout  PDWORD pdwHandleCount
+# );
+GetProcessHandleCount = bind("kernel32", "GetProcessHandleCount", (wintypes.HANDLE, ctypes.POINTER(wintypes.DWORD)),
+                             wintypes.BOOL)
+
+# FILETIME durations are in units of 100 nanoseconds
+_FILETIME_UNITS_PER_SECOND = 10000000.0
+
+ProcessCounters = namedtuple("ProcessCounters", ["cpu_time", "working_set", "private_bytes", "handle_count"])
+
+# Aggregates of the samples of one service over a window (see ServiceHistory.aggregate). cpu_percent is of one
+# processor, so a process that keeps two processors busy shows 200; the growth figures are per second.
+WindowAggregate = namedtuple("WindowAggregate", ["samples", "duration", "cpu_percent_mean", "cpu_percent_max",
+                                                 "working_set_last", "working_set_max", "working_set_growth",
+                                                 "private_bytes_last", "private_bytes_growth", "handle_count_last",
+                                                 "handle_count_growth", "process_ids"])
+
+
+def _filetime_seconds(filetime):
+    return ((filetime.dwHighDateTime << 32) + filetime.dwLowDateTime) / _FILETIME_UNITS_PER_SECOND
+
+
+def query_process_counters(handle):
+    """ Returns the ProcessCounters of the process behind handle """
+    creation_time, exit_time, kernel_time, user_time = (wintypes.FILETIME() for index in range(4))
+    if not GetProcessTimes(handle, ctypes.byref(creation_time), ctypes.byref(exit_time), ctypes.byref(kernel_time),
+                           ctypes.byref(user_time)):
+        raise WinError()
+    memory = PROCESS_MEMORY_COUNTERS_EX()
+    memory.cb = ctypes.sizeof(memory)
+    if not GetProcessMemoryInfo(handle, ctypes.byref(memory), memory.cb):
+        raise WinError()
+    handle_count = wintypes.DWORD()
+    if not GetProcessHandleCount(handle, ctypes.byref(handle_count)):
+        raise WinError()
+    return ProcessCounters(_filetime_seconds(kernel_time) + _filetime_seconds(user_time), memory.WorkingSetSize,
+                           memory.PrivateUsage, handle_count.value)
+
+
+class RingBuffer(object):
+    """
+    The last capacity values appended, in an array of typecode (see the array module), so its memory is allocated
+    once and never grows.
+    """
+    __slots__ = ("capacity", "_values", "_next", "_count")
+
+    def __init__(self, capacity, typecode="d"):
+        self.capacity = capacity
+        self._values = array(typecode, [0]) * capacity
+        self._next = 0
+        self._count = 0
+
+    def append(self, value):
+        self._values[self._next] = value
+        self._next = (self._next + 1) % self.capacity
+        self._count = min(self._count + 1, self.capacity)
+
+    def __len__(self):
+        return self._count
+
+    def __getitem__(self, index):
+        # 0 is the oldest value held, -1 the newest
+        if index < 0:
+            index += self._count
+        if not 0 <= index < self._count:
+            raise IndexError(index)
+        return self._values[(self._next - self._count + index) % self.capacity]
+
+    def tolist(self):
+        start = (self._next - self._count) % self.capacity
+        if start + self._count <= self.capacity:
+            return self._values[start:start + self._count].tolist()
+        return self._values[start:].tolist() + self._values[:self._next].tolist()
+
+
+class ServiceHistory(object):
+    """
+    The last capacity samples of one service: when each was taken, the process it was taken of, and the counters
+    of that process, one ring buffer per column.
+    """
+    COLUMNS = (("timestamp", "d"), ("process_id", "L"), ("cpu_percent", "d"), ("working_set", "d"),
+               ("private_bytes", "d"), ("handle_count", "L"))
+
+    def __init__(self, service_name, capacity):
+        super(ServiceHistory, self).__init__()
+        self.service_name = service_name
+        self.capacity = capacity
+        self._columns = dict((name, RingBuffer(capacity, typecode)) for name, typecode in self.COLUMNS)
+        self._lock = Lock()
+
+    def append(self, timestamp, process_id, cpu_percent, counters):
+        values = dict(timestamp=timestamp, process_id=process_id, cpu_percent=cpu_percent,
+                      working_set=counters.working_set, private_bytes=counters.private_bytes,
+                      handle_count=counters.handle_count)
+        with self._lock:
+            for name, column in self._columns.items():
+                column.append(values[name])
+
+    def __len__(self):
+        return len(self._columns["timestamp"])
+
+    def column(self, name):
+        """ Returns the values of a column (see COLUMNS), oldest first """
+        with self._lock:
+            return self._columns[name].tolist()
+
+    def aggregate(self, window_in_seconds=None, now=None):
+        """
+        Returns a WindowAggregate of the samples taken in the last window_in_seconds (all of them if None), or None
+        if there are none. The first sample of every process has no CPU figure, since it takes two to tell, so it is
+        left out of every figure, not just the CPU ones, and all of them cover the same samples.
+        """
+        with self._lock:
+            columns = dict((name, column.tolist()) for name, column in self._columns.items())
+        since = None
+        if window_in_seconds is not None:
+            since = (monotonic() if now is None else now) - window_in_seconds
+        # NaN is the only value that differs from itself
+        rows = [index for index, (timestamp, cpu_percent) in enumerate(zip(columns["timestamp"],
+                                                                            columns["cpu_percent"]))
+                if cpu_percent == cpu_percent and (since is None or timestamp >= since)]
+        if not rows:
+            return None
+        window = dict((name, [values[index] for index in rows]) for name, values in columns.items())
+        duration = window["timestamp"][-1] - window["timestamp"][0]
+        cpu = window["cpu_percent"]
+
+        def growth(name):
+            return (window[name][-1] - window[name][0]) / duration if duration else 0.0
+        return WindowAggregate(samples=len(rows), duration=duration,
+                               cpu_percent_mean=sum(cpu) / len(cpu),
+                               cpu_percent_max=max(cpu),
+                               working_set_last=window["working_set"][-1],
+                               working_set_max=max(window["working_set"]),
+                               working_set_growth=growth("working_set"),
+                               private_bytes_last=window["private_bytes"][-1],
+                               private_bytes_growth=growth("private_bytes"),
+                               handle_count_last=window["handle_count"][-1],
+                               handle_count_growth=growth("handle_count"),
+                               process_ids=sorted(set(window["process_id"])))
+
+
+class _TrackedProcess(object):
+    __slots__ = ("handle", "cpu_time", "timestamp")
+
+    def __init__(self, handle):
+        self.handle = handle
+        self.cpu_time = None
+        self.timestamp = None
+
+
+class ProcessSampler(object):
+    """
+    Samples the CPU usage, memory and handle count of the processes of running services every interval seconds,
+    keeping the last capacity samples of every service in a ServiceHistory. Every round maps services to processes
+    with a single sweep of the SCM, and queries every process once, however many services it hosts.
+
+    Process handles are kept open between rounds; while we hold one, the process ID cannot be reused by a new
+    process. Processes we are not allowed to query (protected ones, or others' without privileges) are skipped.
+    The history of a service is dropped once a round finds it no longer running.
+
+    >>> with ProcessSampler(interval=5, capacity=720) as sampler:   # an hour of history
+    ...     ...
+    ...     sampler.aggregate("Spooler", window_in_seconds=300).working_set_growth
+    """
+    def __init__(self, interval=5.0, capacity=720, service_names=None, type=SERVICE_WIN32):
+        super(ProcessSampler, self).__init__()
+        self.interval = interval
+        self.capacity = capacity
+        self.service_names = None if service_names is None else set(name.lower() for name in service_names)
+        self.type = type
+        self._histories = dict()
+        self._processes = dict()
+        self._denied = set()
+        self._lock = Lock()
+        self._stopped = Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._stopped.clear()
+            self._thread = Thread(target=self._run, name="win32service-sampler")
+            self._thread.daemon = True
+            self._thread.start()
+        return self
+
+    def stop(self):
+        if self._thread is not None:
+            self._stopped.set()
+            self._thread.join()
+            self._thread = None
+        with self._lock:
+            for process in self._processes.values():
+                CloseHandle(process.handle)
+            self._processes.clear()
+
+    def history(self, service_name):
+        """ Returns the ServiceHistory of a service, or None if it was never sampled """
+        return self._histories.get(service_name.lower())
+
+    def sampled_services(self):
+        return [history.service_name for history in list(self._histories.values())]
+
+    def aggregate(self, service_name, window_in_seconds=None):
+        history = self.history(service_name)
+        return None if history is None else history.aggregate(window_in_seconds)
+
+    def sample(self):
+        """ Takes one round of samples right away """
+        with ServiceControlManagerContext(access=ServiceManagerAccess.ENUMERATE_SERVICE) as scm:
+            services_by_process = dict()
+            for status in scm.enumerate_services(self.type, ServiceEnumState.ACTIVE):
+                if not status.process_id:
+                    continue
+                if self.service_names is not None and status.service_name.lower() not in self.service_names:
+                    continue
+                services_by_process.setdefault(status.process_id, []).append(status.service_name)
+        running = set(name.lower() for service_names in services_by_process.values() for name in service_names)
+        with self._lock:
+            self._denied &= set(services_by_process)
+            for process_id in set(self._processes) - set(services_by_process):
+                CloseHandle(self._processes.pop(process_id).handle)
+            for service_name in set(self._histories) - running:
+                del self._histories[service_name]
+            for process_id, service_names in services_by_process.items():
+                self._sample_process(process_id, service_names)
+
+    def _sample_process(self, process_id, service_names):
+        process = self._processes.get(process_id)
+        if process is None:
+            if process_id in self._denied:
+                return
+            handle = OpenProcess(PROCESS_QUERY_LIMITED_INFORMATION, False, process_id)
+            if not handle:
+                logger.debug("cannot open process %d of %s (error %d), not sampling it", process_id,
+                             service_names, GetLastError())
+                self._denied.add(process_id)
+                return
+            process = self._processes[process_id] = _TrackedProcess(handle)
+        try:
+            counters = query_process_counters(process.handle)
+        except WindowsError:
+            logger.debug("failed to sample process %d of %s", process_id, service_names, exc_info=True)
+            return
+        timestamp = monotonic()
+        cpu_percent = float("nan")
+        if process.timestamp is not None and timestamp > process.timestamp:
+            cpu_percent = (counters.cpu_time - process.cpu_time) / (timestamp - process.timestamp) * 100
+        process.cpu_time, process.timestamp = counters.cpu_time, timestamp
+        for service_name in service_names:
+            history = self._histories.get(service_name.lower())
+            if history is None:
+                history = self._histories[service_name.lower()] = ServiceHistory(service_name, self.capacity)
+            history.append(timestamp, process_id, cpu_percent, counters)
+
+    def _run(self):
+        # rounds are due at fixed times, so slow rounds do not make the rate drift
+        due = monotonic()
+        while not self._stopped.is_set():
+            try:
+                self.sample()
+            except:
+                logger.exception("failed to sample service processes")
+            due += self.interval
+            now = monotonic()
+            if due < now:
+                # we fell behind a whole round or more; skip the rounds we missed
+                due = now + self.interval - (now - due) % self.interval
+            self._stopped.wait(due - now)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, type, value, traceback):
+        self.stop()
@@ -1,10 +1,16 @@
 import ctypes
 from ctypes import wintypes
+from threading import local
+from time import sleep
 import logging
 import six
 
-from .utils import enum
-from .common import ServiceControl, ServiceType, ERROR_INVALID_HANDLE
+from .utils import enum, monotonic, read_multi_sz
+from .bindings import bind, is_available, WINFUNCTYPE, WinError, GetLastError, WindowsError
+from .common import ServiceControl, ServiceType, ERROR_INVALID_HANDLE, ERROR_SERVICE_NOTIFY_CLIENT_LAGGING
+from .common import ERROR_INSUFFICIENT_BUFFER
+from .optional_config import query_optional_config, change_optional_config, ALL_INFO_LEVELS
+from .optional_config import ServiceConfigInfoLevel, SERVICE_PRESHUTDOWN_INFO
 
 # http://msdn.microsoft.com/en-us/library/windows/desktop/ms685992%28v=VS.85%29.aspx
 # typedef struct _SERVICE_STATUS_PROCESS {
@@ -58,9 +64,70 @@ class QUERY_SERVICE_CONFIG(ctypes.Structure):
                     load_order_group=self.lpLoadOrderGroup, tag_id=self.dwTagId,
                     dependencies=self.lpDependencies, service_start_name=self.lpServiceStartName)
 
+    def dependency_list(self):
+        """
+        Returns all the names in lpDependencies. The field is a double-null-terminated list, but ctypes only reads
+        up to the first null, so we walk the raw pointer ourselves.
+        """
+        address = ctypes.c_void_p.from_buffer(self, QUERY_SERVICE_CONFIG.lpDependencies.offset).value
+        return read_multi_sz(address)
+
+# Dependencies on load ordering groups are prefixed with SC_GROUP_IDENTIFIER
+SC_GROUP_IDENTIFIER = u"+"
+
 
 LPQUERY_SERVICE_CONFIG = ctypes.POINTER(QUERY_SERVICE_CONFIG)
 
+
+class ServiceStatusRecord(object):
+    """
+    A compact copy of SERVICE_STATUS_PROCESS, for callers that keep statuses around.
+    """
+    __slots__ = ("service_type", "current_state", "controls_accepted", "win32_exit_code",
+                 "service_specific_exit_code", "check_point", "wait_hint", "process_id", "service_flags")
+
+    def __init__(self, status):
+        self.service_type = status.dwServiceType
+        self.current_state = status.dwCurrentState
+        self.controls_accepted = status.dwControlsAccepted
+        self.win32_exit_code = status.dwWin32ExitCode
+        self.service_specific_exit_code = status.dwServiceSpecificExitCode
+        self.check_point = status.dwCheckPoint
+        self.wait_hint = status.dwWaitHint
+        self.process_id = status.dwProcessId
+        self.service_flags = status.dwServiceFlags
+
+    def __repr__(self):
+        return "<ServiceStatusRecord state={} pid={}>".format(self.current_state, self.process_id)
+
+
+class ServiceConfigRecord(object):
+    """
+    A compact copy of QUERY_SERVICE_CONFIG, with the strings already decoded and the full list of dependencies.
+    """
+    __slots__ = ("service_type", "start_type", "error_control", "binary_path_name", "load_order_group", "tag_id",
+                 "dependencies", "service_start_name", "display_name")
+
+    def __init__(self, config):
+        self.service_type = config.dwServiceType
+        self.start_type = config.dwStartType
+        self.error_control = config.dwErrorControl
+        self.binary_path_name = config.lpBinaryPathName
+        self.load_order_group = config.lpLoadOrderGroup
+        self.tag_id = config.dwTagId
+        self.dependencies = config.dependency_list()
+        self.service_start_name = config.lpServiceStartName
+        self.display_name = config.lpDisplayName
+
+    def to_dict(self):
+        # same as QUERY_SERVICE_CONFIG.to_dict, where "dependencies" is only the first dependency (an empty string
+        # if there are none)
+        return dict(service_type=self.service_type, start_type=self.start_type,
+                    error_control=self.error_control, binary_path_name=self.binary_path_name,
+                    load_order_group=self.load_order_group, tag_id=self.tag_id,
+                    dependencies=self.dependencies[0] if self.dependencies else u"",
+                    service_start_name=self.service_start_name)
+
 # From http://msdn.microsoft.com/en-us/library/windows/desktop/ms685996%28v=vs.85%29.aspx
 
 ServiceState = enum(
@@ -137,46 +204,154 @@ ServiceNotifyMask = enum(
     DELETE_PENDING   = 0x00000200
 )
 
+# The notify mask bit of every service state is 1 << (state - 1)
+def status_to_notify_mask(states):
+    mask = 0
+    for state in states:
+        mask |= 1 << (state - 1)
+    return mask
+
+PENDING_STATES = (ServiceState.START_PENDING, ServiceState.STOP_PENDING,
+                  ServiceState.CONTINUE_PENDING, ServiceState.PAUSE_PENDING)
+SETTLED_STATES = (ServiceState.STOPPED, ServiceState.RUNNING, ServiceState.PAUSED)
+
+# http://msdn.microsoft.com/en-us/library/windows/desktop/ms685947%28v=vs.85%29.aspx
+# VOID CALLBACK NotifyCallback(
+#   __in  PVOID pParameter
+# );
+PFN_SC_NOTIFY_CALLBACK = WINFUNCTYPE(None, ctypes.c_void_p)
+
+# http://msdn.microsoft.com/en-us/library/windows/desktop/ms685947%28v=vs.85%29.aspx
+# typedef struct _SERVICE_NOTIFY {
+#   DWORD                  dwVersion;
+#   PFN_SC_NOTIFY_CALLBACK pfnNotifyCallback;
+#   PVOID                  pContext;
+#   DWORD                  dwNotificationStatus;
+#   SERVICE_STATUS_PROCESS ServiceStatus;
+#   DWORD                  dwNotificationTriggered;
+#   LPTSTR                 pszServiceNames;
+# } SERVICE_NOTIFY, *PSERVICE_NOTIFY;
+class SERVICE_NOTIFY(ctypes.Structure):
+    _fields_ = [("dwVersion", wintypes.DWORD),
+                ("pfnNotifyCallback", PFN_SC_NOTIFY_CALLBACK),
+                ("pContext", ctypes.c_void_p),
+                ("dwNotificationStatus", wintypes.DWORD),
+                ("ServiceStatus", SERVICE_STATUS_PROCESS),
+                ("dwNotificationTriggered", wintypes.DWORD),
+                ("pszServiceNames", ctypes.c_void_p)]
+
+SERVICE_NOTIFY_STATUS_CHANGE = 2
+
+# The SCM hands the callback a pointer to the SERVICE_NOTIFY it filled, so we put a flag right after it and let the
+# callback raise it. The callback runs as an APC on the thread that registered the notification.
+class _SERVICE_NOTIFY_BUFFER(ctypes.Structure):
+    _fields_ = [("notify", SERVICE_NOTIFY),
+                ("fired", wintypes.BOOL)]
+
+def _notify_callback(pParameter):
+    ctypes.cast(pParameter, ctypes.POINTER(_SERVICE_NOTIFY_BUFFER)).contents.fired = True
+
+_notify_callback_thunk = PFN_SC_NOTIFY_CALLBACK(_notify_callback)
+
 # From WinError.h:
 ERROR_SERVICE_SPECIFIC_ERROR = 1066
 NO_ERROR = 0
 
+# From winsvc.h:
+SC_STATUS_PROCESS_INFO = 0
+
+# QueryServiceConfig buffers start this small and grow to what the SCM asked for (the docs cap them at 8K bytes)
+QUERY_CONFIG_INITIAL_BUFFER_SIZE = 1024
+
+
+class _QueryBuffers(local):
+    """
+    Per-thread buffers for status and config queries, so polling loops do not allocate on every call.
+    """
+    def __init__(self):
+        super(_QueryBuffers, self).__init__()
+        self.status = SERVICE_STATUS_PROCESS()
+        self.status_address = ctypes.addressof(self.status)
+        self.bytes_needed = wintypes.DWORD()
+        self.bytes_needed_ref = ctypes.byref(self.bytes_needed)
+        self.resize_config(QUERY_CONFIG_INITIAL_BUFFER_SIZE)
+
+    def resize_config(self, size):
+        self.config_size = size
+        self.config = ctypes.create_string_buffer(size)
+        self.config_pointer = ctypes.cast(self.config, LPQUERY_SERVICE_CONFIG)
+
+_query_buffers = _QueryBuffers()
+
+# From WinBase.h:
+WAIT_IO_COMPLETION = 0x000000C0
+INFINITE = 0xFFFFFFFF
+
 # From winsvc.h:
 SERVICE_NO_CHANGE = 0xffffffff
 
 
-StartService = ctypes.windll.advapi32.StartServiceW
-StartService.argtypes = (wintypes.SC_HANDLE, wintypes.DWORD, wintypes.LPCWSTR)
-StartService.restype = wintypes.BOOL
-ControlService = ctypes.windll.advapi32.ControlService
-ControlService.argtypes = (wintypes.SC_HANDLE, wintypes.DWORD, LPSERVICE_STATUS)
-ControlService.restype = wintypes.BOOL
-DeleteService = ctypes.windll.advapi32.DeleteService
-DeleteService.argtypes = (wintypes.SC_HANDLE, )
-DeleteService.restype = wintypes.BOOL
-SetServiceStatus = ctypes.windll.advapi32.SetServiceStatus
-SetServiceStatus.argtypes = (wintypes.SERVICE_STATUS_HANDLE, LPSERVICE_STATUS)
-SetServiceStatus.restype = wintypes.BOOL
-CloseServiceHandle = ctypes.windll.advapi32.CloseServiceHandle
-CloseServiceHandle.argtypes = (wintypes.SC_HANDLE, )
-CloseServiceHandle.restype = wintypes.BOOL
-QueryServiceStatus = ctypes.windll.advapi32.QueryServiceStatus
-QueryServiceStatus.argtypes = (wintypes.SC_HANDLE, LPSERVICE_STATUS)
-QueryServiceStatus.restype = wintypes.BOOL
-QueryServiceConfig = ctypes.windll.advapi32.QueryServiceConfigW
-QueryServiceConfig.argtypes = (wintypes.SC_HANDLE, LPQUERY_SERVICE_CONFIG, wintypes.DWORD, ctypes.POINTER(wintypes.DWORD))
-QueryServiceConfig.restype = wintypes.BOOL
-ChangeServiceConfig = ctypes.windll.advapi32.ChangeServiceConfigW
-ChangeServiceConfig.argtypes = (wintypes.SC_HANDLE, wintypes.DWORD, wintypes.DWORD, wintypes.DWORD,
-                                wintypes.LPCWSTR, wintypes.LPCWSTR, ctypes.POINTER(wintypes.DWORD),
-                                wintypes.LPCWSTR, wintypes.LPCWSTR, wintypes.LPCWSTR, wintypes.LPCWSTR)
-ChangeServiceConfig.restype = wintypes.BOOL
+StartService = bind("advapi32", "StartServiceW", (wintypes.SC_HANDLE, wintypes.DWORD, wintypes.LPCWSTR), wintypes.BOOL)
+ControlService = bind("advapi32", "ControlService", (wintypes.SC_HANDLE, wintypes.DWORD, LPSERVICE_STATUS),
+                      wintypes.BOOL)
+DeleteService = bind("advapi32", "DeleteService", (wintypes.SC_HANDLE, ), wintypes.BOOL)
+SetServiceStatus = bind("advapi32", "SetServiceStatus", (wintypes.SERVICE_STATUS_HANDLE, LPSERVICE_STATUS),
+                        wintypes.BOOL)
+CloseServiceHandle = bind("advapi32", "CloseServiceHandle", (wintypes.SC_HANDLE, ), wintypes.BOOL)
+QueryServiceStatus = bind("advapi32", "QueryServiceStatus", (wintypes.SC_HANDLE, LPSERVICE_STATUS), wintypes.BOOL)
+QueryServiceConfig = bind("advapi32", "QueryServiceConfigW",
+                          (wintypes.SC_HANDLE, LPQUERY_SERVICE_CONFIG, wintypes.DWORD, ctypes.POINTER(wintypes.DWORD)),
+                          wintypes.BOOL)
+ChangeServiceConfig = bind("advapi32", "ChangeServiceConfigW",
+                           (wintypes.SC_HANDLE, wintypes.DWORD, wintypes.DWORD, wintypes.DWORD, wintypes.LPCWSTR,
+                            wintypes.LPCWSTR, ctypes.POINTER(wintypes.DWORD), wintypes.LPCWSTR, wintypes.LPCWSTR,
+                            wintypes.LPCWSTR, wintypes.LPCWSTR),
+                           wintypes.BOOL)
+QueryServiceStatusEx = bind("advapi32", "QueryServiceStatusEx",
+                            (wintypes.SC_HANDLE, ctypes.c_int, ctypes.c_void_p, wintypes.DWORD,
+                             ctypes.POINTER(wintypes.DWORD)),
+                            wintypes.BOOL)
+# NotifyServiceStatusChange does not exist before Vista, in which case waits fall back to polling
+NotifyServiceStatusChange = bind("advapi32", "NotifyServiceStatusChangeW",
+                                 (wintypes.SC_HANDLE, wintypes.DWORD, ctypes.POINTER(SERVICE_NOTIFY)), wintypes.DWORD,
+                                 optional=True)
+SleepEx = bind("kernel32", "SleepEx", (wintypes.DWORD, wintypes.BOOL), wintypes.DWORD)
+
+# Polling intervals used when notifications are not available: start short and back off, but never wait longer than
+# a tenth of the wait hint the service reported (as the MSDN sample does) or POLL_MAX_INTERVAL
+POLL_MIN_INTERVAL = 0.01
+POLL_MAX_INTERVAL = 10.0
+
+
+class PollBackoff(object):
+    """
+    Computes how long to sleep between status polls of a pending service: intervals double from POLL_MIN_INTERVAL up
+    to a tenth of the service's wait hint (and no more than POLL_MAX_INTERVAL), and start over whenever the service
+    advances its checkpoint.
+    """
+    def __init__(self):
+        super(PollBackoff, self).__init__()
+        self.interval = POLL_MIN_INTERVAL
+        self.check_point = None
+
+    def next_interval(self, check_point, wait_hint):
+        if check_point != self.check_point:
+            # the service made progress, so it is worth looking again soon
+            self.check_point = check_point
+            self.interval = POLL_MIN_INTERVAL
+        max_interval = min(max(wait_hint / 10000.0, POLL_MIN_INTERVAL), POLL_MAX_INTERVAL)
+        self.interval = min(self.interval * 2, max_interval)
+        return self.interval
 
 
 class Service(object):
     def __init__(self, handle):
         self.handle = wintypes.SC_HANDLE(handle) if isinstance(handle, six.integer_types) else \
                       wintypes.SC_HANDLE(handle.value) if hasattr(handle, "value") else handle
+        # A notification buffer the SCM may still write to; it must outlive the registration, which only ends
+        # when the callback runs or when the handle is closed.
+        self._pending_notify = None
+        self._notifications_supported = is_available(NotifyServiceStatusChange)
 
     def start(self, *args):
         # http://msdn.microsoft.com/en-us/library/windows/desktop/ms686321%28v=vs.85%29.aspx
@@ -190,16 +365,81 @@ class Service(object):
         else:
             lpServiceArgVectors = (wintypes.LPWSTR * len(args))(*args)
         if not StartService(self.handle, len(args), lpServiceArgVectors):
-            raise ctypes.WinError()
+            raise WinError()
 
     def wait_on_pending(self, timeout_in_seconds=60):
-        from time import sleep
-        for sec in range(timeout_in_seconds):
-            if self.get_status() in (ServiceState.STOP_PENDING, ServiceState.START_PENDING):
-                sleep(1)
+        """
+        Waits until the service leaves any of the pending states.
+        """
+        self._wait_for_status(SETTLED_STATES, timeout_in_seconds, "wait_on_pending")
+
+    def wait_for_status(self, states, timeout_in_seconds=60):
+        """
+        Waits until the service reaches one of the given states (a single state or a sequence of them) and returns
+        the state it reached. A timeout of None waits forever.
+        """
+        if isinstance(states, six.integer_types):
+            states = (states, )
+        return self._wait_for_status(tuple(states), timeout_in_seconds, "wait_for_status")
+
+    def _wait_for_status(self, states, timeout_in_seconds, caller):
+        deadline = None if timeout_in_seconds is None else monotonic() + timeout_in_seconds
+        backoff = PollBackoff()
+        while True:
+            if self._pending_notify is not None and self._pending_notify.fired:
+                self._pending_notify = None
+            status = self._query_status_process()
+            if status.dwCurrentState in states:
+                return status.dwCurrentState
+            remaining = None if deadline is None else deadline - monotonic()
+            if remaining is not None and remaining <= 0:
+                raise RuntimeError("{} timed out, status is: {}".format(caller, status.dwCurrentState))
+            if self._notifications_supported and self._pending_notify is None:
+                self._wait_for_notification(status_to_notify_mask(states), remaining)
+                continue
+            interval = backoff.next_interval(status.dwCheckPoint, status.dwWaitHint)
+            self._sleep(interval if remaining is None else min(interval, remaining))
+
+    def _wait_for_notification(self, mask, timeout_in_seconds):
+        # http://msdn.microsoft.com/en-us/library/windows/desktop/ms684276%28v=vs.85%29.aspx
+        # DWORD WINAPI NotifyServiceStatusChange(
+        #   __in  SC_HANDLE hService,
+        #   __in  DWORD dwNotifyMask,
+        #   __in  PSERVICE_NOTIFY pNotifyBuffer
+        # );
+        buffer = _SERVICE_NOTIFY_BUFFER()
+        buffer.notify.dwVersion = SERVICE_NOTIFY_STATUS_CHANGE
+        buffer.notify.pfnNotifyCallback = _notify_callback_thunk
+        result = NotifyServiceStatusChange(self.handle, mask, ctypes.byref(buffer.notify))
+        if result == ERROR_SERVICE_NOTIFY_CLIENT_LAGGING:
+            # the SCM gave up on this handle; from here on we poll
+            self._notifications_supported = False
+            return
+        if result != NO_ERROR:
+            raise WinError(result)
+        self._pending_notify = buffer
+        deadline = None if timeout_in_seconds is None else monotonic() + timeout_in_seconds
+        while not buffer.fired:
+            if deadline is None:
+                milliseconds = INFINITE
             else:
-                return
-        raise RuntimeError("wait_on_pending timed out, status is: {}".format(self.get_status()))
+                remaining = deadline - monotonic()
+                if remaining <= 0:
+                    # the registration stays pending; the buffer is released when the handle is closed
+                    return
+                milliseconds = int(remaining * 1000) + 1
+            SleepEx(milliseconds, True)
+        self._pending_notify = None
+        if buffer.notify.dwNotificationStatus != NO_ERROR:
+            raise WinError(buffer.notify.dwNotificationStatus)
+
+    def _sleep(self, seconds):
+        if self._pending_notify is not None:
+            # alertable, so that a registration left pending by a wait that timed out can still fire; once it has,
+            # the following waits use notifications again
+            SleepEx(int(seconds * 1000) + 1, True)
+        else:
+            sleep(seconds)
 
     def stop(self):
         """
@@ -207,9 +447,9 @@ class Service(object):
         """
         new_status = SERVICE_STATUS()
         if not ControlService(self.handle, ServiceControl.STOP, ctypes.byref(new_status)):
-            raise ctypes.WinError()
+            raise WinError()
         if new_status.dwCurrentState not in [ServiceState.STOPPED, ServiceState.STOP_PENDING]:
-            raise ctypes.WinError()
+            raise WinError()
 
     def safe_start(self):
         if self.get_status() in [ServiceState.RUNNING, ServiceState.START_PENDING]:
@@ -229,10 +469,29 @@ class Service(object):
                 raise
 
     def get_status(self):
-        current_status = SERVICE_STATUS()
-        if not QueryServiceStatus(self.handle, ctypes.byref(current_status)):
-            raise ctypes.WinError()
-        return current_status.dwCurrentState
+        return self._query_status_process().dwCurrentState
+
+    def query_status_ex(self):
+        """
+        Returns a ServiceStatusRecord, which also carries the process ID and flags of the service.
+        """
+        return ServiceStatusRecord(self._query_status_process())
+
+    def _query_status_process(self):
+        # Returns this thread's SERVICE_STATUS_PROCESS buffer, which the next query on this thread overwrites.
+        # http://msdn.microsoft.com/en-us/library/windows/desktop/ms684941%28v=vs.85%29.aspx
+        # BOOL WINAPI QueryServiceStatusEx(
+        #   __in       SC_HANDLE hService,
+        #   __in       SC_STATUS_TYPE InfoLevel,
+        #   __out_opt  LPBYTE lpBuffer,
+        #   __in       DWORD cbBufSize,
+        #   __out      LPDWORD pcbBytesNeeded
+        # );
+        buffers = _query_buffers
+        if not QueryServiceStatusEx(self.handle, SC_STATUS_PROCESS_INFO, buffers.status_address,
+                                    ctypes.sizeof(SERVICE_STATUS_PROCESS), buffers.bytes_needed_ref):
+            raise WinError()
+        return buffers.status
 
     def is_running(self):
         return self.get_status() == ServiceState.RUNNING
@@ -241,6 +500,12 @@ class Service(object):
     # https://msdn.microsoft.com/en-us/library/windows/desktop/ms681987(v=vs.85).aspx
 
     def query_config(self):
+        return self.query_config_record().to_dict()
+
+    def query_config_record(self):
+        """
+        Returns the service configuration as a ServiceConfigRecord.
+        """
         # http://msdn.microsoft.com/en-us/library/windows/desktop/ms684932%28v=vs.85%29.aspx
         # BOOL WINAPI QueryServiceConfig(
         #   __in       SC_HANDLE hService,
@@ -248,12 +513,21 @@ class Service(object):
         #   __in       DWORD cbBufSize,
         #   __out      LPDWORD pcbBytesNeeded
         # );
-        config_buffer = ctypes.create_string_buffer(8192) # The maximum size of this array is 8K bytes
-        bytes_needed = wintypes.DWORD()
-        service_config = ctypes.cast(config_buffer, ctypes.POINTER(QUERY_SERVICE_CONFIG))
-        if not QueryServiceConfig(self.handle, service_config, 8192, ctypes.byref(bytes_needed)):
-            raise ctypes.WinError()
-        return service_config.contents.to_dict()
+        buffers = _query_buffers
+        while not QueryServiceConfig(self.handle, buffers.config_pointer, buffers.config_size,
+                                     buffers.bytes_needed_ref):
+            if GetLastError() != ERROR_INSUFFICIENT_BUFFER or \
+               buffers.config_size >= buffers.bytes_needed.value:
+                raise WinError()
+            # the buffer stays with this thread, so the next query already fits
+            buffers.resize_config(buffers.bytes_needed.value)
+        return ServiceConfigRecord(buffers.config_pointer.contents)
+
+    def query_dependencies(self):
+        """
+        Returns the names of the services (and "+"-prefixed load ordering groups) this service depends on.
+        """
+        return self.query_config_record().dependencies
 
     def change_service_config(self, start_type):
         # https://msdn.microsoft.com/en-us/library/windows/desktop/ms681987(v=vs.85).aspx
@@ -275,7 +549,7 @@ class Service(object):
                                    None, None,
                                    None, None, None,
                                    None, None):
-            raise ctypes.WinError()
+            raise WinError()
 
     def is_disabled(self):
         return self.query_config()['start_type'] == StartType.SERVICE_DISABLED
@@ -289,16 +563,18 @@ class Service(object):
     def start_automatically(self):
         self.change_service_config(StartType.SERVICE_AUTO_START)
 
-    def query_optional_config(self):
-        # http://msdn.microsoft.com/en-us/library/windows/desktop/ms684935%28v=VS.85%29.aspx
-        # BOOL WINAPI QueryServiceConfig2(
-        #   __in       SC_HANDLE hService,
-        #   __in       DWORD dwInfoLevel,
-        #   __out_opt  LPBYTE lpBuffer,
-        #   __in       DWORD cbBufSize,
-        #   __out      LPDWORD pcbBytesNeeded
-        # );
-        raise NotImplementedError()
+    def query_optional_config(self, *info_levels):
+        """
+        Returns an OptionalConfigSnapshot of the given ServiceConfigInfoLevel values (all of them by default).
+        """
+        return query_optional_config(self.handle, info_levels or ALL_INFO_LEVELS)
+
+    def set_preshutdown_timeout(self, milliseconds):
+        """
+        Sets how long the SCM waits for the service to stop after sending it PRESHUTDOWN.
+        """
+        change_optional_config(self.handle, ServiceConfigInfoLevel.PRESHUTDOWN_INFO,
+                               SERVICE_PRESHUTDOWN_INFO(dwPreshutdownTimeout=milliseconds))
 
     def set_status(self, status):
         """
@@ -310,7 +586,7 @@ class Service(object):
         #   __in  LPSERVICE_STATUS lpServiceStatus
         # );
         if not SetServiceStatus(self.handle, LPSERVICE_STATUS(status)):
-            raise ctypes.WinError()
+            raise WinError()
 
     def delete(self):
         """
@@ -321,14 +597,16 @@ class Service(object):
         #   __in  SC_HANDLE hService
         # );
         if not DeleteService(self.handle):
-            raise ctypes.WinError()
+            raise WinError()
 
     def close(self):
         if self.handle != 0:
             if not CloseServiceHandle(self.handle):
-                if ctypes.get_last_error() != ERROR_INVALID_HANDLE:
-                    raise ctypes.WinError()
+                if GetLastError() != ERROR_INVALID_HANDLE:
+                    raise WinError()
             self.handle = 0
+            # closing the handle cancels any pending notification, so its buffer can go now
+            self._pending_notify = None
 
     def __enter__(self):
         return self
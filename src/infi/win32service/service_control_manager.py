@@ -1,27 +1,42 @@
 import ctypes
 from ctypes import wintypes
 from collections import namedtuple
+from threading import Lock
 import six
 
 from .utils import enum
-from .service import Service
-from .common import ServiceType, ERROR_INVALID_HANDLE
-
-OpenSCManager = ctypes.windll.advapi32.OpenSCManagerW
-OpenSCManager.argtypes = (wintypes.LPWSTR, wintypes.LPWSTR, wintypes.DWORD)
-OpenSCManager.restype = wintypes.SC_HANDLE
-OpenService = ctypes.windll.advapi32.OpenServiceW
-OpenService.argtypes = (wintypes.SC_HANDLE, wintypes.LPWSTR, wintypes.DWORD)
-OpenService.restype = wintypes.SC_HANDLE
-CloseServiceHandle = ctypes.windll.advapi32.CloseServiceHandle
-CloseServiceHandle.argtypes = (wintypes.SC_HANDLE, )
-CloseServiceHandle.restype = wintypes.BOOL
-CreateService = ctypes.windll.advapi32.CreateServiceW
-CreateService.argtypes = (wintypes.SC_HANDLE, wintypes.LPCWSTR, wintypes.LPCWSTR,
-                          wintypes.DWORD, wintypes.DWORD, wintypes.DWORD, wintypes.DWORD,
-                          wintypes.LPCWSTR, wintypes.LPCWSTR, ctypes.POINTER(wintypes.DWORD),
-                          wintypes.LPCWSTR, wintypes.LPCWSTR, wintypes.LPCWSTR)
-CreateService.restype = wintypes.SC_HANDLE
+from .bindings import bind, WinError, GetLastError, WindowsError
+from .service import Service, SERVICE_STATUS_PROCESS
+from .common import ServiceType, ERROR_INVALID_HANDLE, ERROR_MORE_DATA, ERROR_SERVICE_DOES_NOT_EXIST
+from .optional_config import ALL_INFO_LEVELS
+from .handle_pool import ServiceHandlePool, PooledService
+
+# http://msdn.microsoft.com/en-us/library/windows/desktop/ms682648%28v=vs.85%29.aspx
+# typedef struct _ENUM_SERVICE_STATUS_PROCESS {
+#   LPTSTR                 lpServiceName;
+#   LPTSTR                 lpDisplayName;
+#   SERVICE_STATUS_PROCESS ServiceStatusProcess;
+# } ENUM_SERVICE_STATUS_PROCESS, *LPENUM_SERVICE_STATUS_PROCESS;
+class ENUM_SERVICE_STATUS_PROCESS(ctypes.Structure):
+    _fields_ = [("lpServiceName", wintypes.LPWSTR),
+                ("lpDisplayName", wintypes.LPWSTR),
+                ("ServiceStatusProcess", SERVICE_STATUS_PROCESS)]
+
+OpenSCManager = bind("advapi32", "OpenSCManagerW", (wintypes.LPWSTR, wintypes.LPWSTR, wintypes.DWORD),
+                     wintypes.SC_HANDLE)
+OpenService = bind("advapi32", "OpenServiceW", (wintypes.SC_HANDLE, wintypes.LPWSTR, wintypes.DWORD),
+                   wintypes.SC_HANDLE)
+CloseServiceHandle = bind("advapi32", "CloseServiceHandle", (wintypes.SC_HANDLE, ), wintypes.BOOL)
+CreateService = bind("advapi32", "CreateServiceW",
+                     (wintypes.SC_HANDLE, wintypes.LPCWSTR, wintypes.LPCWSTR, wintypes.DWORD, wintypes.DWORD,
+                      wintypes.DWORD, wintypes.DWORD, wintypes.LPCWSTR, wintypes.LPCWSTR,
+                      ctypes.POINTER(wintypes.DWORD), wintypes.LPCWSTR, wintypes.LPCWSTR, wintypes.LPCWSTR),
+                     wintypes.SC_HANDLE)
+EnumServicesStatusEx = bind("advapi32", "EnumServicesStatusExW",
+                            (wintypes.SC_HANDLE, ctypes.c_int, wintypes.DWORD, wintypes.DWORD, ctypes.c_void_p,
+                             wintypes.DWORD, ctypes.POINTER(wintypes.DWORD), ctypes.POINTER(wintypes.DWORD),
+                             ctypes.POINTER(wintypes.DWORD), wintypes.LPCWSTR),
+                            wintypes.BOOL)
 
 # From http://msdn.microsoft.com/en-us/library/windows/desktop/ms685981%28v=vs.85%29.aspx
 ServiceManagerAccess = enum(
@@ -65,23 +80,102 @@ ServiceAccess = enum(ALL                  = 0xF01FF,
                      INTERROGATE          = 0x0080,
                      USER_DEFINED_CONTROL = 0x0100)
 
+# From http://msdn.microsoft.com/en-us/library/windows/desktop/ms682640%28v=vs.85%29.aspx
+# -- EnumServicesStatusEx.InfoLevel:
+SC_ENUM_PROCESS_INFO = 0
+
+# -- EnumServicesStatusEx.dwServiceType:
+SERVICE_DRIVER = ServiceType.KERNEL_DRIVER | ServiceType.FILE_SYSTEM_DRIVER | ServiceType.RECOGNIZER_DRIVER
+SERVICE_WIN32 = ServiceType.WIN32_OWN_PROCESS | ServiceType.WIN32_SHARE_PROCESS
+
+# -- EnumServicesStatusEx.dwServiceState:
+ServiceEnumState = enum(
+    ACTIVE   = 0x00000001,
+    INACTIVE = 0x00000002,
+    ALL      = 0x00000003)
+
+# The docs cap the buffer at 256K bytes; we start small and grow to what the SCM asks for.
+ENUM_SERVICES_INITIAL_BUFFER_SIZE = 16 * 1024
+ENUM_SERVICES_MAX_BUFFER_SIZE = 256 * 1024
+
+EnumServiceStatus = namedtuple("EnumServiceStatus", ["service_name", "display_name", "service_type",
+                                                     "current_state", "controls_accepted", "win32_exit_code",
+                                                     "service_specific_exit_code", "check_point", "wait_hint",
+                                                     "process_id", "service_flags"])
+
+def open_sc_manager(machine=None, database=None, access=ServiceManagerAccess.ALL):
+    # http://msdn.microsoft.com/en-us/library/windows/desktop/ms684323%28v=vs.85%29.aspx
+    # SC_HANDLE WINAPI OpenSCManager(
+    #   __in_opt  LPCTSTR lpMachineName,
+    #   __in_opt  LPCTSTR lpDatabaseName,
+    #   __in      DWORD dwDesiredAccess
+    # );
+    lpMachineName = wintypes.LPWSTR(machine) if machine is not None else None
+    lpDatabaseName = wintypes.LPWSTR(database) if database is not None else None
+    scm_handle = OpenSCManager(lpMachineName, lpDatabaseName, access)
+    if scm_handle is None:
+        raise WinError()
+    return scm_handle
+
+
+# Pooled managers are shared by every pooled context with the same machine, database and access
+_pooled_managers = dict()
+_pooled_managers_lock = Lock()
+
+
+def get_pooled_manager(machine=None, database=None, access=ServiceManagerAccess.ALL, pool_size=64, pool_ttl=None):
+    """
+    Returns the process-wide PooledServiceControlManager for machine/database/access, opening it on first use.
+    The pool settings are those of the first use; asking for the same manager with a different pool_size or pool_ttl
+    raises ValueError (close_pooled_managers() first to change them).
+    """
+    key = (machine, database, access)
+    with _pooled_managers_lock:
+        scm = _pooled_managers.get(key)
+        if scm is None or scm.handle is None:
+            scm = PooledServiceControlManager(open_sc_manager(machine, database, access), pool_size, pool_ttl)
+            _pooled_managers[key] = scm
+        elif (scm.pool.max_size, scm.pool.ttl) != (pool_size, pool_ttl):
+            raise ValueError("the pooled manager for {!r} is open with pool_size={}, pool_ttl={}".format(
+                key, scm.pool.max_size, scm.pool.ttl))
+        return scm
+
+
+def close_pooled_managers():
+    """
+    Closes all the pooled managers (and the service handles they hold).
+    """
+    with _pooled_managers_lock:
+        managers = list(_pooled_managers.values())
+        _pooled_managers.clear()
+    for scm in managers:
+        scm.close()
+
+
 class ServiceControlManagerContext(object):
-    def __init__(self, machine=None, database=None, access=ServiceManagerAccess.ALL):
+    """
+    Opens a ServiceControlManager for the duration of a with block. If pool_size is given, the context hands out a
+    shared PooledServiceControlManager instead, which is left open on exit so the next pooled context with the same
+    machine, database and access can reuse it and the service handles it holds.
+    """
+    def __init__(self, machine=None, database=None, access=ServiceManagerAccess.ALL, pool_size=None, pool_ttl=None):
         super(ServiceControlManagerContext, self).__init__()
-        self.machine = wintypes.LPWSTR(machine) if machine is not None else None
-        self.database = wintypes.LPWSTR(database) if database is not None else None
+        self.machine = machine
+        self.database = database
         self.access = access
+        self.pool_size = pool_size
+        self.pool_ttl = pool_ttl
         self.scm = None
 
     def __enter__(self):
-        scm_handle = OpenSCManager(self.machine, self.database, self.access)
-        if scm_handle is None:
-            raise ctypes.WinError()
-        self.scm = ServiceControlManager(scm_handle)
+        if self.pool_size is not None:
+            self.scm = get_pooled_manager(self.machine, self.database, self.access, self.pool_size, self.pool_ttl)
+        else:
+            self.scm = ServiceControlManager(open_sc_manager(self.machine, self.database, self.access))
         return self.scm
 
     def __exit__(self, type, value, traceback):
-        if self.scm is not None:
+        if self.scm is not None and self.pool_size is None:
             self.scm.close()
 
 class ServiceControlManager(object):
@@ -129,20 +223,83 @@ class ServiceControlManager(object):
                                   dwStartType, dwErrorControl, lpBinaryPathName, lpLoadOrderGroup, lpdwTagId,
                                   lpDependencies, lpServiceStartName, lpPassword)
         if service_h is None:
-            raise ctypes.WinError()
+            raise WinError()
         return Service(service_h)
 
     def open_service(self, name, access=ServiceAccess.ALL):
         service_h = OpenService(self.handle, wintypes.LPWSTR(name), access)
         if service_h is None:
-            raise ctypes.WinError()
+            raise WinError()
         return Service(service_h)
 
+    def enumerate_services(self, type=SERVICE_WIN32, state=ServiceEnumState.ALL, group=None):
+        """
+        Yields an EnumServiceStatus for every service matching type, state and group (None means all groups, an
+        empty string means services that do not belong to any group). The services are fetched in chunks, so a
+        full sweep costs a handful of calls to EnumServicesStatusEx instead of one open/query/close per service.
+        """
+        # http://msdn.microsoft.com/en-us/library/windows/desktop/ms682640%28v=vs.85%29.aspx
+        # BOOL WINAPI EnumServicesStatusEx(
+        #   __in         SC_HANDLE hSCManager,
+        #   __in         SC_ENUM_TYPE InfoLevel,
+        #   __in         DWORD dwServiceType,
+        #   __in         DWORD dwServiceState,
+        #   __out_opt    LPBYTE lpServices,
+        #   __in         DWORD cbBufSize,
+        #   __out        LPDWORD pcbBytesNeeded,
+        #   __out        LPDWORD lpServicesReturned,
+        #   __inout_opt  LPDWORD lpResumeHandle,
+        #   __in_opt     LPCTSTR pszGroupName
+        # );
+        assert self.handle is not None
+        pszGroupName = wintypes.LPWSTR(group) if group is not None else None
+        bytes_needed = wintypes.DWORD()
+        services_returned = wintypes.DWORD()
+        resume_handle = wintypes.DWORD(0)
+        buffer_size = ENUM_SERVICES_INITIAL_BUFFER_SIZE
+        buffer = ctypes.create_string_buffer(buffer_size)
+        while True:
+            done = EnumServicesStatusEx(self.handle, SC_ENUM_PROCESS_INFO, type, state, buffer, buffer_size,
+                                        ctypes.byref(bytes_needed), ctypes.byref(services_returned),
+                                        ctypes.byref(resume_handle), pszGroupName)
+            if not done and GetLastError() != ERROR_MORE_DATA:
+                raise WinError()
+            # The string pointers point into our buffer, so every record in this chunk is decoded before the
+            # buffer is handed back to EnumServicesStatusEx.
+            entries = (ENUM_SERVICE_STATUS_PROCESS * services_returned.value).from_buffer(buffer)
+            for entry in entries:
+                status = entry.ServiceStatusProcess
+                yield EnumServiceStatus(entry.lpServiceName, entry.lpDisplayName, status.dwServiceType,
+                                        status.dwCurrentState, status.dwControlsAccepted, status.dwWin32ExitCode,
+                                        status.dwServiceSpecificExitCode, status.dwCheckPoint, status.dwWaitHint,
+                                        status.dwProcessId, status.dwServiceFlags)
+            del entries
+            if done:
+                return
+            if bytes_needed.value > buffer_size:
+                buffer_size = min(max(bytes_needed.value, buffer_size * 2), ENUM_SERVICES_MAX_BUFFER_SIZE)
+                buffer = ctypes.create_string_buffer(buffer_size)
+
+    def query_optional_configs(self, info_levels=ALL_INFO_LEVELS, type=SERVICE_WIN32, state=ServiceEnumState.ALL):
+        """
+        Yields a (service name, OptionalConfigSnapshot) pair for every service matching type and state, in a single
+        pass over the services. Services deleted while we are at it are skipped.
+        """
+        for entry in self.enumerate_services(type, state):
+            try:
+                service = self.open_service(entry.service_name, ServiceAccess.QUERY_CONFIG)
+            except WindowsError as e:
+                if e.winerror == ERROR_SERVICE_DOES_NOT_EXIST:
+                    continue
+                raise
+            with service:
+                yield entry.service_name, service.query_optional_config(*info_levels)
+
     def close(self):
         if self.handle is not None:
             if not CloseServiceHandle(self.handle):
-                if ctypes.get_last_error() != ERROR_INVALID_HANDLE:
-                    raise ctypes.WinError()
+                if GetLastError() != ERROR_INVALID_HANDLE:
+                    raise WinError()
             self.handle = None
 
     def is_service_exist(self, name):
@@ -158,3 +315,32 @@ class ServiceControlManager(object):
 
     def __exit__(self, type, value, traceback):
         self.close()
+
+
+class PooledServiceControlManager(ServiceControlManager):
+    """
+    A ServiceControlManager that keeps the service handles it opens in an LRU ServiceHandlePool, so services that
+    are opened over and over again (e.g. by monitoring loops) reuse the same handle. The services it returns are
+    PooledService objects: closing them hands the handle back to the pool, and stale handles are reopened
+    transparently.
+    """
+    def __init__(self, handle, pool_size=64, pool_ttl=None):
+        super(PooledServiceControlManager, self).__init__(handle)
+        self.pool = ServiceHandlePool(super(PooledServiceControlManager, self).open_service, pool_size, pool_ttl)
+
+    def open_service(self, name, access=ServiceAccess.ALL):
+        return PooledService(self.pool, name, access)
+
+    def is_service_exist(self, name):
+        # a pooled handle may outlive its service, so existence is always checked against the SCM
+        try:
+            service = super(PooledServiceControlManager, self).open_service(name, ServiceAccess.QUERY_STATUS)
+            service.close()
+            return True
+        except WindowsError:
+            self.pool.invalidate_name(name)
+            return False
+
+    def close(self):
+        self.pool.clear()
+        super(PooledServiceControlManager, self).close()
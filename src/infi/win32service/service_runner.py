@@ -1,8 +1,16 @@
 import ctypes
 from ctypes import wintypes
-from .service import ServiceState, ServiceControlsAccepted, SERVICE_STATUS, Service
-from .common import ServiceControl, ServiceType
-from infi.winver import Windows
+from threading import Thread, Event, Lock, RLock, Condition
+from collections import deque, OrderedDict
+from itertools import count
+from .service import ServiceState, ServiceControlsAccepted, SERVICE_STATUS, Service, PENDING_STATES, NO_ERROR
+from .common import ServiceControl, ServiceType, ERROR_SERVICE_SPECIFIC_ERROR
+from .service_control_manager import ServiceControlManagerContext, ServiceManagerAccess, ServiceAccess
+from .event_data import EventData
+from .bindings import bind, WINFUNCTYPE, WinError, WindowsError
+from .utils import monotonic
+from . import tracing
+from .tracing import TraceEvent
 
 import logging
 logger = logging.getLogger(__name__)
@@ -12,7 +20,7 @@ logger = logging.getLogger(__name__)
 #   __in  DWORD dwArgc,
 #   __in  LPTSTR *lpszArgv
 # );
-SERVICE_MAIN_FUNCTION = ctypes.WINFUNCTYPE(ctypes.c_int, wintypes.DWORD, ctypes.POINTER(wintypes.LPWSTR))
+SERVICE_MAIN_FUNCTION = WINFUNCTYPE(None, wintypes.DWORD, ctypes.POINTER(wintypes.LPWSTR))
 
 # http://msdn.microsoft.com/en-us/library/windows/desktop/ms683241%28v=VS.85%29.aspx
 # DWORD WINAPI HandlerEx(
@@ -21,7 +29,7 @@ SERVICE_MAIN_FUNCTION = ctypes.WINFUNCTYPE(ctypes.c_int, wintypes.DWORD, ctypes.
 #   __in  LPVOID lpEventData,
 #   __in  LPVOID lpContext
 # );
-HANDLER_EX = ctypes.WINFUNCTYPE(wintypes.DWORD, wintypes.DWORD, wintypes.DWORD, wintypes.LPVOID, wintypes.LPVOID)
+HANDLER_EX = WINFUNCTYPE(wintypes.DWORD, wintypes.DWORD, wintypes.DWORD, wintypes.LPVOID, wintypes.LPVOID)
 
 # http://msdn.microsoft.com/en-us/library/windows/desktop/ms686324%28v=VS.85%29.aspx
 # typedef struct _SERVICE_TABLE_ENTRY {
@@ -32,47 +40,82 @@ class SERVICE_TABLE_ENTRY(ctypes.Structure):
     _fields_ = [("lpServiceName", wintypes.LPWSTR), ("lpServiceProc", SERVICE_MAIN_FUNCTION)]
 
 
-RegisterServiceCtrlHandlerEx = ctypes.windll.advapi32.RegisterServiceCtrlHandlerExW
-RegisterServiceCtrlHandlerEx.argtypes = (wintypes.LPCWSTR, HANDLER_EX, wintypes.LPVOID)
-RegisterServiceCtrlHandlerEx.restype = wintypes.SERVICE_STATUS_HANDLE
-StartServiceCtrlDispatcher = ctypes.windll.advapi32.StartServiceCtrlDispatcherW
-StartServiceCtrlDispatcher.argtypes = (ctypes.POINTER(SERVICE_TABLE_ENTRY),)
-StartServiceCtrlDispatcher.restype = wintypes.BOOL
+RegisterServiceCtrlHandlerEx = bind("advapi32", "RegisterServiceCtrlHandlerExW",
+                                    (wintypes.LPCWSTR, HANDLER_EX, wintypes.LPVOID),
+                                    wintypes.SERVICE_STATUS_HANDLE)
+StartServiceCtrlDispatcher = bind("advapi32", "StartServiceCtrlDispatcherW", (ctypes.POINTER(SERVICE_TABLE_ENTRY),),
+                                  wintypes.BOOL)
+
+_platform_description = None
+
+
+def _describe_platform():
+    # probing the version, edition and service pack takes a while, and they do not change while we are running
+    global _platform_description
+    if _platform_description is None:
+        from infi.winver import Windows
+        windows = Windows()
+        _platform_description = "{} {} {} Service Pack {}".format(windows.version, windows.edition,
+                                                                   windows.architecture, windows.service_pack)
+    return _platform_description
+
+
+class _CtrlHandlerRegistration(object):
+    __slots__ = ("key", "service_name", "callback", "context", "thunk", "handle")
+
+    def __init__(self, key, service_name, callback, context):
+        self.key = key
+        self.service_name = service_name
+        self.callback = callback
+        self.context = context
+        self.thunk = None
+        self.handle = None
 
 
 class _ServiceCtrl(object):
+    """
+    Registers control handlers and ServiceMain functions with the SCM, and keeps their ctypes thunks alive for as
+    long as the SCM may call them.
+
+    Every control handler registration gets a key of its own, which is never reused, and a thunk bound to that
+    registration, so a control goes straight to its callback and context without a lookup (lpContext is not used).
+    A handler is unregistered when its service reports STOPPED, after which the SCM no longer calls it; its thunk is
+    kept a little longer (the last RETIRED_THUNKS of them), since the STOPPED report is often made from the very
+    handler call that is running.
+    """
+    RETIRED_THUNKS = 16
+
     def __init__(self):
-        self._garbage_protect_map = dict()
-        self._contexts = dict()
-        self._handles = dict()
+        self._lock = Lock()
+        self._keys = count(1)
+        self._registrations = dict()
+        self._keys_by_handle = dict()
+        self._retired_thunks = deque(maxlen=self.RETIRED_THUNKS)
+        self._service_main_thunks = dict()
 
     def register_ctrl_handler(self, service_name, callback, context=None):
+        """
+        Registers callback(handle, control, event_type, event_data, context) as the control handler of a service,
+        and returns the Service of its status handle.
+        """
+        registration = _CtrlHandlerRegistration(next(self._keys), service_name, callback, context)
+
         def wrapper(dwControl, dwEventType, lpEventData, lpContext):
+            # lpEventData is passed on as is, see event_data.EventData for decoding it
+            tracing.record(TraceEvent.CONTROL_RECEIVED, dwControl, dwEventType)
+            result = None
             try:
-                if dwControl == ServiceControl.DEVICEEVENT and dwEventType == EventType.POWERSETTINGCHANGE:
-                    # TODO: convert lpEventData to a POWERBROADCAST_SETTING structure.
-                    pass
-                elif dwControl == ServiceControl.SESSIONCHANGE:
-                    # TODO: convert lpEventData to WTSSESSION_NOTIFICATION structure.
-                    pass
-                elif dwControl == ServiceControl.TIMECHANGE:
-                    # TODO: convert lpEventData to SERVICE_TIMECHANGE_INFO structure.
-                    pass
-
-                if id(wrapper) in self._handles:
-                    handle = self._handles[id(wrapper)]
-                else:
-                    handle = None
-                if lpContext in self._contexts:
-                    context = self._contexts[lpContext]
-                else:
-                    context = None
-
-                return callback(handle, dwControl, dwEventType, lpEventData, context)
+                result = callback(registration.handle, dwControl, dwEventType, lpEventData, context)
+                return result
             except:
+                tracing.crashed()
                 logger.exception("exception caught in service callback handler")
+            finally:
+                tracing.record(TraceEvent.CONTROL_HANDLED, dwControl, result or 0)
 
-        thunk = HANDLER_EX(wrapper)
+        registration.thunk = HANDLER_EX(wrapper)
+        with self._lock:
+            self._registrations[registration.key] = registration
 
         # http://msdn.microsoft.com/en-us/library/windows/desktop/ms685058%28v=VS.85%29.aspx
         # SERVICE_STATUS_HANDLE WINAPI RegisterServiceCtrlHandlerEx(
@@ -80,16 +123,50 @@ class _ServiceCtrl(object):
         #   __in      LPHANDLER_FUNCTION_EX lpHandlerProc,
         #   __in_opt  LPVOID lpContext
         # );
-        handle = RegisterServiceCtrlHandlerEx(wintypes.LPWSTR(service_name), thunk, id(context))
+        handle = RegisterServiceCtrlHandlerEx(wintypes.LPWSTR(service_name), registration.thunk, None)
         if handle is None:
-            raise ctypes.WinError()
-
-        self._garbage_protect_map[id(thunk)] = thunk
-        self._contexts[id(context)] = context
-        self._handles[id(wrapper)] = handle
+            with self._lock:
+                del self._registrations[registration.key]
+            raise WinError()
 
+        with self._lock:
+            registration.handle = handle
+            self._keys_by_handle[handle] = registration.key
         return Service(handle)
 
+    def unregister_ctrl_handler(self, service):
+        """
+        Forgets the control handler of a service (a Service or its status handle) once the SCM will no longer call
+        it, that is after the service reported STOPPED. Returns False if it was not registered.
+        """
+        handle = service.handle if isinstance(service, Service) else service
+        handle = handle.value if hasattr(handle, "value") else handle
+        with self._lock:
+            key = self._keys_by_handle.pop(handle, None)
+            registration = self._registrations.pop(key, None)
+            if registration is None:
+                return False
+            self._retired_thunks.append(registration.thunk)
+            return True
+
+    def __len__(self):
+        with self._lock:
+            return len(self._registrations)
+
+    def _wrap_service_main(self, caller, method):
+        # a function of its own, so every wrapper binds its own caller and method
+        def main_wrapper(argc, argv):
+            args = list(argv[index] for index in range(argc))
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug('Start system control dispatcher for %s service on %s with %s argument(s): [%s]',
+                             caller, _describe_platform(), argc, ' '.join(args))
+            try:
+                method(args)
+            except:
+                tracing.crashed()
+                logger.exception("service main exception caught")
+        return main_wrapper
+
     def start_ctrl_dispatcher(self, *services):
         """
         Sets the ServiceMain function of each service. Every element in the list is a pair of name and callback.
@@ -108,42 +185,252 @@ class _ServiceCtrl(object):
                 caller = 'unknown'
             else:
                 caller = service[0]
-            method = service[1]
-            def main_wrapper(argc, argv):
-                windows = Windows()
-                args = list(argv[index] for index in range(argc))
-                logger.debug('Start system control dispatcher for %s service on '
-                             '%s %s %s Service Pack %s with %s argument(s): [%s]',
-                             caller, windows.version, windows.edition,
-                             windows.architecture, windows.service_pack,
-                             argc, ' '.join(args))
-                try:
-                    method(args)
-                except:
-                    logger.exception("service main exception caught")
-
-            thunk = SERVICE_MAIN_FUNCTION(main_wrapper)
+            thunk = SERVICE_MAIN_FUNCTION(self._wrap_service_main(caller, service[1]))
             name = wintypes.LPWSTR(caller)
             service_tables[i] = SERVICE_TABLE_ENTRY(lpServiceName=name, lpServiceProc=thunk)
+            # ServiceMain may still be on its way out when the dispatcher returns, so its thunk outlives this call;
+            # dispatching the same service again replaces it, which keeps us at one thunk per service
+            with self._lock:
+                self._service_main_thunks[caller] = thunk
 
         # http://msdn.microsoft.com/en-us/library/windows/desktop/ms686324%28v=VS.85%29.aspx
         # BOOL WINAPI StartServiceCtrlDispatcher(
         #   __in  const SERVICE_TABLE_ENTRY *lpServiceTable
         # );
         if not StartServiceCtrlDispatcher(service_tables):
-            raise ctypes.WinError()
-
-        # We need to protect ctype's thunk from the garbage collector. Note that this is a memory "leak" because we
-        # never remove it from the map, but it's okay since a service should have a single ServiceMain entry.
-        for service_table in service_tables:
-            self._garbage_protect_map[id(service_table.lpServiceProc)] = service_table.lpServiceProc
+            raise WinError()
 
 ServiceCtrl = _ServiceCtrl()
 
+# controls a service receives only if it says it accepts them
+_CONTROLS_ACCEPTED = {
+    ServiceControl.PAUSE: ServiceControlsAccepted.PAUSE_CONTINUE,
+    ServiceControl.CONTINUE: ServiceControlsAccepted.PAUSE_CONTINUE,
+    ServiceControl.PARAMCHANGE: ServiceControlsAccepted.PARAMCHANGE,
+    ServiceControl.NETBINDADD: ServiceControlsAccepted.NETBINDCHANGE,
+    ServiceControl.NETBINDREMOVE: ServiceControlsAccepted.NETBINDCHANGE,
+    ServiceControl.NETBINDENABLE: ServiceControlsAccepted.NETBINDCHANGE,
+    ServiceControl.NETBINDDISABLE: ServiceControlsAccepted.NETBINDCHANGE,
+    ServiceControl.HARDWAREPROFILECHANGE: ServiceControlsAccepted.HARDWAREPROFILECHANGE,
+    ServiceControl.POWEREVENT: ServiceControlsAccepted.POWEREVENT,
+    ServiceControl.SESSIONCHANGE: ServiceControlsAccepted.SESSIONCHANGE,
+    ServiceControl.PRESHUTDOWN: ServiceControlsAccepted.PRESHUTDOWN,
+    ServiceControl.TIMECHANGE: ServiceControlsAccepted.TIMECHANGE,
+    ServiceControl.TRIGGEREVENT: ServiceControlsAccepted.TRIGGEREVENT,
+}
+
+
+# the points of a service start recorded in ServiceRunner.startup_timeline, in the order they happen
+STARTUP_MILESTONES = ("dispatcher_started", "service_main_entered", "handler_registered", "running_reported",
+                      "main_entered")
+
+
+class StartupTimeline(object):
+    """
+    When each milestone of a service start (see STARTUP_MILESTONES) was reached, in monotonic seconds.
+    """
+    def __init__(self):
+        super(StartupTimeline, self).__init__()
+        self._marks = OrderedDict()
+
+    def mark(self, milestone):
+        # only the first time counts, so a milestone reached again later on does not move
+        self._marks.setdefault(milestone, monotonic())
+
+    def get(self, milestone):
+        """ Returns when milestone was reached, or None if it was not reached yet """
+        return self._marks.get(milestone)
+
+    def elapsed(self, milestone, since=None):
+        """
+        Returns the seconds from since (the first milestone reached, by default) to milestone, or None if either
+        was not reached yet.
+        """
+        end = self._marks.get(milestone)
+        start = self._marks.get(since) if since is not None else next(iter(self._marks.values()), None)
+        if end is None or start is None:
+            return None
+        return end - start
+
+    def to_dict(self):
+        """ Returns an ordered dict of every milestone reached so far -> seconds since the first one """
+        marks = list(self._marks.items())
+        return OrderedDict((milestone, when - marks[0][1]) for milestone, when in marks)
+
+    def __repr__(self):
+        return "<StartupTimeline {}>".format(", ".join("{}=+{:.6f}s".format(milestone, elapsed)
+                                                        for milestone, elapsed in self.to_dict().items()))
+
+
+class RestartPolicy(object):
+    """
+    How a supervised ServiceRunner restarts main() when it raises: after initial_delay seconds, then after
+    multiplier times the previous delay, up to max_delay. A run of main() that lasted longer than window_in_seconds
+    starts the backoff over. More than max_restarts restarts within window_in_seconds is a crash loop, and the
+    service stops with ERROR_SERVICE_SPECIFIC_ERROR and exit_code as its service-specific exit code.
+    """
+    def __init__(self, max_restarts=5, window_in_seconds=60.0, initial_delay=0.1, max_delay=30.0, multiplier=2.0,
+                 exit_code=1):
+        super(RestartPolicy, self).__init__()
+        self.max_restarts = max_restarts
+        self.window_in_seconds = window_in_seconds
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+        self.multiplier = multiplier
+        self.exit_code = exit_code
+
+
+class _ProgressReporter(object):
+    """
+    Keeps reporting a pending state with an advancing checkpoint, so the SCM knows the service is making progress
+    and does not give up on it while a long start or stop is under way.
+    """
+    def __init__(self, runner, service, state, interval):
+        super(_ProgressReporter, self).__init__()
+        self.runner = runner
+        self.service = service
+        self.state = state
+        self.interval = interval
+        self._stopped = Event()
+        self._thread = Thread(target=self._run, name="{}-progress".format(runner.service_name))
+        self._thread.daemon = True
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                if not self.runner._report_progress(self.service, self.state):
+                    return
+            except:
+                logger.exception("failed to report progress")
+
+
+class _ControlQueue(object):
+    """
+    Delivers controls to ServiceRunner.control() on a worker thread, so the SCM dispatcher thread never waits for
+    them. A control that is already waiting in the queue is not queued again.
+    """
+    def __init__(self, runner):
+        super(_ControlQueue, self).__init__()
+        self.runner = runner
+        self._queue = deque()
+        self._pending = set()
+        self._closed = False
+        self._condition = Condition()
+        self._thread = Thread(target=self._run, name="{}-controls".format(runner.service_name))
+        self._thread.daemon = True
+
+    def start(self):
+        self._thread.start()
+
+    def put(self, control):
+        with self._condition:
+            if control in self._pending:
+                return
+            self._pending.add(control)
+            self._queue.append(control)
+            self._condition.notify()
+
+    def close(self, timeout=None):
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+        self._thread.join(timeout)
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._queue and not self._closed:
+                    self._condition.wait()
+                if not self._queue:
+                    return
+                control = self._queue.popleft()
+                self._pending.discard(control)
+            try:
+                self.runner.control(control)
+            except:
+                logger.exception("exception caught in service control handler")
+
+
 class ServiceRunner(object):
-    def __init__(self, service_name):
+    """
+    Runs a service: subclasses implement main(), which runs for the lifetime of the service, and control(), which
+    handles control requests from the SCM.
+
+    By default the service is reported as RUNNING right before main() is called. A service that has to warm up first
+    passes auto_ready=False and calls ready() from main() once it is done; until then it is reported as START_PENDING
+    with a checkpoint that advances every progress_interval seconds. The same heartbeat runs while control() handles
+    a STOP request. start_wait_hint and stop_wait_hint (in milliseconds) are the SCM's estimate of how long each
+    step may take between two checkpoints.
+
+    With control_queue=True, controls are acknowledged right away and handed to control() on a worker thread. A STOP
+    request is then reported as STOP_PENDING (with the heartbeat running), and STOPPED is reported only when main()
+    returns, so main() should return once control() told it to stop.
+
+    Services that need time to flush their state when the machine goes down register drain callbacks with
+    register_drain(). On PRESHUTDOWN (accepted when accept_preshutdown is True or preshutdown_timeout, in
+    milliseconds, is given) or SHUTDOWN, the service reports STOP_PENDING and calls the drains one after the other,
+    each for at most its budget, advancing the checkpoint after each one. control() then gets a STOP, whether or not
+    there were drains to call.
+
+    Controls that come with event data (SESSIONCHANGE, POWEREVENT, TIMECHANGE, DEVICEEVENT, ...) are best handled
+    with register_control_handler(): the handler is called right on the SCM dispatcher thread with an
+    event_data.EventData, and whatever it returns (NO_ERROR if None) goes back to the SCM. Controls without a handler
+    go to control().
+
+    With fast_startup=True (and auto_ready), the service goes straight to RUNNING once its control handler is
+    registered, without reporting START_PENDING first, and anything that is not needed to start (such as setting the
+    preshutdown timeout) happens in the background while main() runs; it is done by the time STOPPED is reported.
+    Either way, startup_timeline records how long each step of the start took. Without a control queue, STOPPED is
+    reported by the control handler as soon as control() returns, which may be before main() was even entered, so the
+    timeline is only complete once main() has returned.
+
+    Without a restart_policy, a main() that raises leaves the service as it was. With one, main() is supervised:
+    it is called again, in the same process, after a backoff (see RestartPolicy). While the service runs after
+    restarts, its status carries ERROR_SERVICE_SPECIFIC_ERROR with the number of restarts as the service-specific
+    exit code; a stop that follows clears it. On a crash loop the service reports STOPPED with the policy's exit
+    code, so the SCM's failure actions (for non-crash failures) can take over.
+    """
+    service_type = ServiceType.WIN32_OWN_PROCESS
+
+    def __init__(self, service_name, auto_ready=True, progress_interval=1.0, start_wait_hint=10000,
+                 stop_wait_hint=10000, control_queue=False, accept_preshutdown=False, preshutdown_timeout=None,
+                 fast_startup=False, restart_policy=None):
         self.status = ServiceState.START_PENDING
         self.service_name = service_name
+        self.auto_ready = auto_ready
+        self.progress_interval = progress_interval
+        # a wait hint shorter than the heartbeat would let the SCM time out between two checkpoints
+        minimal_wait_hint = int(progress_interval * 3000)
+        self.start_wait_hint = max(start_wait_hint, minimal_wait_hint)
+        self.stop_wait_hint = max(stop_wait_hint, minimal_wait_hint)
+        self._check_point = 0
+        self._wait_hint = 0
+        self._status_lock = RLock()
+        self._progress = None
+        self._service = None
+        self.control_queue = control_queue
+        self._controls = None
+        self.preshutdown_timeout = preshutdown_timeout
+        self.controls_accepted = ServiceControlsAccepted.STOP | ServiceControlsAccepted.SHUTDOWN
+        if accept_preshutdown or preshutdown_timeout is not None:
+            self.controls_accepted |= ServiceControlsAccepted.PRESHUTDOWN
+        self._drains = []
+        self._control_handlers = dict()
+        self.fast_startup = fast_startup
+        self.startup_timeline = StartupTimeline()
+        self._configure_thread = None
+        self.restart_policy = restart_policy
+        self.restart_count = 0
+        self.win32_exit_code = 0
+        self.service_specific_exit_code = 0
+        self._stopping = Event()
 
     def main(self):
         raise NotImplementedError()
@@ -151,54 +438,324 @@ class ServiceRunner(object):
     def control(self, service_control):
         raise NotImplementedError()
 
+    def ready(self):
+        """
+        Reports the service as RUNNING. Called by main() when auto_ready is False.
+        """
+        with self._status_lock:
+            if self.status != ServiceState.START_PENDING:
+                # we were asked to stop while still warming up, and the heartbeat is that of the stop now
+                return
+            # the START_PENDING heartbeat waits for this lock to report progress, so it is stopped once we let go
+            progress, self._progress = self._progress, None
+            logger.debug("setting status to RUNNING")
+            self._notify_status(self._service, ServiceState.RUNNING)
+            self.startup_timeline.mark("running_reported")
+        if progress is not None:
+            progress.stop()
+
+    def register_drain(self, callback, budget_in_seconds):
+        """
+        Registers callback() to be called when the machine shuts down, for at most budget_in_seconds.
+        """
+        self._drains.append((callback, budget_in_seconds))
+
+    def register_control_handler(self, control, handler):
+        """
+        Calls handler(event_data) for every control request of the given ServiceControl, instead of control(). The
+        service also starts accepting the control, if the SCM asks services to opt in to it.
+        """
+        self._control_handlers[control] = handler
+        self.controls_accepted |= _CONTROLS_ACCEPTED.get(control, 0)
+
     def run(self):
         logger.debug("ServiceRunner.run called.")
+        self.startup_timeline.mark("dispatcher_started")
         try:
             ServiceCtrl.start_ctrl_dispatcher((self.service_name, self._service_main))
         except:
             logger.exception("error occurred")
 
     def _service_main(self, args):
-        logger.debug("ServiceRunner._service_main called, self=%s, args=%s" % (self, repr(args)))
+        self.startup_timeline.mark("service_main_entered")
+        tracing.record(TraceEvent.SERVICE_MAIN_ENTERED)
+        logger.debug("ServiceRunner._service_main called, self=%s, args=%r", self, args)
 
         try:
             service = ServiceCtrl.register_ctrl_handler(self.service_name, self._service_callback)
+            self._service = service
+            self.startup_timeline.mark("handler_registered")
+            tracing.record(TraceEvent.HANDLER_REGISTERED)
+            fast = self.fast_startup and self.auto_ready
 
-            logger.debug("setting status to START_PENDING")
-            self._notify_status(service, ServiceState.START_PENDING)
+            if not fast:
+                logger.debug("setting status to START_PENDING")
+                self._notify_status(service, ServiceState.START_PENDING, wait_hint=self.start_wait_hint)
 
-            logger.debug("setting status to RUNNING")
-            self._notify_status(service, ServiceState.RUNNING)
+            if self.preshutdown_timeout is not None and not fast:
+                self._configure_preshutdown_timeout()
 
-            self.main()
+            if self.control_queue:
+                self._controls = _ControlQueue(self)
+                self._controls.start()
+
+            if self.auto_ready:
+                self.ready()
+            else:
+                self._start_progress(service, ServiceState.START_PENDING)
+
+            if self.preshutdown_timeout is not None and fast:
+                self._configure_thread = Thread(target=self._configure_preshutdown_timeout,
+                                                name="{}-configure".format(self.service_name))
+                self._configure_thread.daemon = True
+                self._configure_thread.start()
+
+            self.startup_timeline.mark("main_entered")
+            tracing.record(TraceEvent.MAIN_ENTERED)
+            if self.restart_policy is None:
+                self.main()
+            else:
+                self._supervise_main(self.restart_policy)
+            tracing.record(TraceEvent.MAIN_RETURNED)
         except:
+            tracing.crashed()
             logger.exception("error occurred")
+        finally:
+            if self._controls is not None:
+                self._stop_progress()
+                self._controls.close(self.stop_wait_hint / 1000.0)
+                logger.debug("main returned, setting status to STOPPED")
+                self._notify_status(self._service, ServiceState.STOPPED)
+
+    def _supervise_main(self, policy):
+        restarts = deque()
+        delay = policy.initial_delay
+        while True:
+            started = monotonic()
+            try:
+                self.main()
+                self._clear_exit_code()
+                return
+            except:
+                tracing.crashed()
+                logger.exception("main() raised")
+            now = monotonic()
+            if self._stopping.is_set():
+                return
+            if now - started > policy.window_in_seconds:
+                delay = policy.initial_delay
+            while restarts and now - restarts[0] > policy.window_in_seconds:
+                restarts.popleft()
+            if len(restarts) >= policy.max_restarts:
+                logger.error("main() raised %d times within %s seconds, stopping", len(restarts) + 1,
+                             policy.window_in_seconds)
+                self._give_up(policy.exit_code)
+                return
+            restarts.append(now)
+            self.restart_count += 1
+            tracing.record(TraceEvent.MAIN_RESTARTING, self.restart_count, int(delay * 1000))
+            logger.warning("restarting main() in %s seconds (restart %d)", delay, self.restart_count)
+            if self._stopping.wait(delay):
+                return
+            delay = min(delay * policy.multiplier, policy.max_delay)
+            with self._status_lock:
+                if self._stopping.is_set():
+                    return
+                self.win32_exit_code = ERROR_SERVICE_SPECIFIC_ERROR
+                self.service_specific_exit_code = self.restart_count
+                if self.status == ServiceState.RUNNING:
+                    self._set_status(self._service)
+
+    def _clear_exit_code(self):
+        # the failure code of earlier restarts is not how a service that stops cleanly stops; only _give_up ends so
+        with self._status_lock:
+            self.win32_exit_code = NO_ERROR
+            self.service_specific_exit_code = 0
+
+    def _give_up(self, exit_code):
+        self._stop_progress()
+        with self._status_lock:
+            if self.status == ServiceState.STOPPED:
+                return
+            self.win32_exit_code = ERROR_SERVICE_SPECIFIC_ERROR
+            self.service_specific_exit_code = exit_code
+            if self._controls is None:
+                # with a control queue, _service_main reports STOPPED once we return
+                self._notify_status(self._service, ServiceState.STOPPED)
 
     def _service_callback(self, handle, fdwControl, dwEventType, lpEventData, lpContext):
-        logger.debug("ServiceRunner._service_callback: handle=%x, fdwControl=%x dwEventType=%x" %
-                  (handle, fdwControl, dwEventType))
+        # runs on the SCM dispatcher thread for every control, so it leaves logging to tracing (see tracing.enable)
+        handler = self._control_handlers.get(fdwControl)
+        if handler is not None:
+            # runs on the dispatcher thread, and the event data is only valid until we return
+            result = handler(EventData(fdwControl, dwEventType, lpEventData))
+            return 0 if result is None else result
+
+        service = Service(handle)
+        if fdwControl in (ServiceControl.PRESHUTDOWN, ServiceControl.SHUTDOWN):
+            # with no drains registered this is just a stop, reported right away rather than left to the SCM's timeout
+            return self._shutdown(service)
+        if self._controls is not None:
+            return self._queue_control(service, fdwControl)
+        if fdwControl == ServiceControl.STOP:
+            # a STOP that comes while we are already stopping is not handed to control() again
+            if self._begin_stopping(service):
+                self._stop(service)
+            return 0
 
         self.control(fdwControl)
 
-        service = Service(handle)
+        if fdwControl == ServiceControl.INTERROGATE:
+            logger.debug("INTERROGATE requested.")
+            self._notify_status(service)
+
+        return 0
+
+    def _queue_control(self, service, fdwControl):
         if fdwControl == ServiceControl.STOP:
-            logger.debug("STOP requested, quitting.")
-            self._notify_status(service, ServiceState.STOPPED)
+            self._begin_stopping(service)
         elif fdwControl == ServiceControl.INTERROGATE:
-            logger.debug("INTERROGATE requested.")
             self._notify_status(service)
+        self._controls.put(fdwControl)
+        return 0
 
+    def _begin_stopping(self, service):
+        # reports STOP_PENDING and starts the heartbeat; returns False if we are already on our way down
+        with self._status_lock:
+            if self.status in (ServiceState.STOP_PENDING, ServiceState.STOPPED):
+                return False
+            self._stopping.set()
+            self._clear_exit_code()
+            self._notify_status(service, ServiceState.STOP_PENDING, wait_hint=self.stop_wait_hint)
+        self._stop_progress()
+        self._start_progress(service, ServiceState.STOP_PENDING)
+        return True
+
+    def _stop(self, service):
+        # delivers STOP to control(); without a control queue, that is also when we report STOPPED
+        if self._controls is not None:
+            self._controls.put(ServiceControl.STOP)
+            return
+        try:
+            self.control(ServiceControl.STOP)
+        finally:
+            self._stop_progress()
+        logger.debug("STOP requested, quitting.")
+        self._notify_status(service, ServiceState.STOPPED)
+
+    def _shutdown(self, service):
+        if self._begin_stopping(service):
+            # the SCM expects the handler to return right away, so the drains run on a thread of their own
+            thread = Thread(target=self._drain_and_stop, args=(service, ), name="{}-drain".format(self.service_name))
+            thread.daemon = True
+            thread.start()
         return 0
 
-    def _notify_status(self, service, status=None):
-        if status is not None:
-            self.status = status
-        status_struct = SERVICE_STATUS(dwServiceType=ServiceType.WIN32_OWN_PROCESS,
+    def _drain_and_stop(self, service):
+        for index, (callback, budget_in_seconds) in enumerate(list(self._drains)):
+            tracing.record(TraceEvent.DRAIN_STARTED, index)
+            thread = Thread(target=self._drain, args=(callback, ), name="{}-drain".format(self.service_name))
+            thread.daemon = True
+            thread.start()
+            thread.join(budget_in_seconds)
+            overran = thread.is_alive()
+            tracing.record(TraceEvent.DRAIN_FINISHED, index, overran)
+            if overran:
+                logger.warning("drain %r did not finish within its budget of %s seconds, moving on",
+                               callback, budget_in_seconds)
+            self._report_progress(service, ServiceState.STOP_PENDING)
+        self._stop(service)
+
+    def _drain(self, callback):
+        try:
+            callback()
+        except:
+            logger.exception("exception caught in drain callback")
+
+    def _configure_preshutdown_timeout(self):
+        try:
+            with ServiceControlManagerContext(access=ServiceManagerAccess.CONNECT) as scm:
+                with scm.open_service(self.service_name, ServiceAccess.CHANGE_CONFIG) as service:
+                    service.set_preshutdown_timeout(self.preshutdown_timeout)
+        except WindowsError:
+            # the service account may not be allowed to change its own configuration; the installer can set it too
+            logger.exception("failed to set the preshutdown timeout")
+
+    def _start_progress(self, service, state):
+        self._progress = _ProgressReporter(self, service, state, self.progress_interval)
+        self._progress.start()
+
+    def _stop_progress(self):
+        progress, self._progress = self._progress, None
+        if progress is not None:
+            progress.stop()
+
+    def _report_progress(self, service, state):
+        # called by the progress reporter; returns False once the service moved on to another state
+        with self._status_lock:
+            if self.status != state:
+                return False
+            self._check_point += 1
+            self._set_status(service)
+            return True
+
+    def _notify_status(self, service, status=None, wait_hint=None):
+        if status == ServiceState.STOPPED and self._configure_thread is not None:
+            # what fast startup left to the background is done before we say we stopped
+            self._configure_thread.join(self.stop_wait_hint / 1000.0)
+        with self._status_lock:
+            if status is not None and status != self.status:
+                self.status = status
+                self._check_point = 0
+                self._wait_hint = 0
+            if wait_hint is not None:
+                self._wait_hint = wait_hint
+            self._set_status(service)
+            if self.status == ServiceState.STOPPED:
+                # the SCM calls no handler of a stopped service
+                ServiceCtrl.unregister_ctrl_handler(service)
+
+    def _set_status(self, service):
+        # the docs ask for the checkpoint and wait hint to be zero, and for no controls to be accepted, unless the
+        # service is in a pending state
+        pending = self.status in PENDING_STATES
+        controls_accepted = 0 if pending else self.controls_accepted
+        tracing.record(TraceEvent.STATUS_REPORTED, self.status, controls_accepted, self._check_point if pending else 0,
+                       self._wait_hint if pending else 0)
+        status_struct = SERVICE_STATUS(dwServiceType=self.service_type,
                                        dwCurrentState=self.status,
-                                       dwControlsAccepted=(ServiceControlsAccepted.STOP |
-                                                           ServiceControlsAccepted.SHUTDOWN),
-                                       dwWin32ExitCode=0,
-                                       dwServiceSpecificExitCode=0,
-                                       dwCheckPoint=0,
-                                       dwWaitHint=0)
+                                       dwControlsAccepted=controls_accepted,
+                                       dwWin32ExitCode=self.win32_exit_code,
+                                       dwServiceSpecificExitCode=self.service_specific_exit_code,
+                                       dwCheckPoint=self._check_point if pending else 0,
+                                       dwWaitHint=self._wait_hint if pending else 0)
         service.set_status(status_struct)
+
+
+class ServiceHost(object):
+    """
+    Runs several ServiceRunners in one process, so they share one interpreter and its imported modules. The services
+    must be installed as ServiceType.WIN32_SHARE_PROCESS with the same binary path, and each one gets its own
+    ServiceMain thread, status handle and control handler:
+
+    >>> ServiceHost(CollectorService(), UploaderService()).run()
+    """
+    def __init__(self, *runners):
+        super(ServiceHost, self).__init__()
+        self.runners = []
+        for runner in runners:
+            self.add(runner)
+
+    def add(self, runner):
+        runner.service_type = ServiceType.WIN32_SHARE_PROCESS
+        self.runners.append(runner)
+
+    def run(self):
+        logger.debug("ServiceHost.run called for %s", [runner.service_name for runner in self.runners])
+        for runner in self.runners:
+            runner.startup_timeline.mark("dispatcher_started")
+        try:
+            ServiceCtrl.start_ctrl_dispatcher(*[(runner.service_name, runner._service_main)
+                                                for runner in self.runners])
+        except:
+            logger.exception("error occurred")
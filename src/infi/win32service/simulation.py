@@ -0,0 +1,818 @@
+import ctypes
+from threading import RLock, Condition, Thread, local
+from six.moves._thread import get_ident
+import random
+import six
+import time
+
+from .utils import monotonic
+from .bindings import set_backend
+from .common import (ServiceControl, ServiceType, ERROR_INVALID_HANDLE, ERROR_INVALID_PARAMETER,
+                     ERROR_INSUFFICIENT_BUFFER, ERROR_MORE_DATA, ERROR_INVALID_SERVICE_CONTROL,
+                     ERROR_SERVICE_ALREADY_RUNNING, ERROR_SERVICE_DISABLED,
+                     ERROR_SERVICE_DOES_NOT_EXIST, ERROR_SERVICE_CANNOT_ACCEPT_CTRL, ERROR_SERVICE_NOT_ACTIVE,
+                     ERROR_SERVICE_MARKED_FOR_DELETE, ERROR_SERVICE_EXISTS)
+from .service import (ServiceState, StartType, ServiceNotifyMask, ServiceControlsAccepted,
+                      SERVICE_STATUS_PROCESS, QUERY_SERVICE_CONFIG, WAIT_IO_COMPLETION, INFINITE, SERVICE_NO_CHANGE,
+                      NO_ERROR)
+from .service_control_manager import ENUM_SERVICE_STATUS_PROCESS, ServiceEnumState
+from .optional_config import (ServiceConfigInfoLevel, SERVICE_DESCRIPTION, SERVICE_FAILURE_ACTIONS,
+                              SERVICE_DELAYED_AUTO_START_INFO, SERVICE_FAILURE_ACTIONS_FLAG, SERVICE_SID_INFO,
+                              SERVICE_REQUIRED_PRIVILEGES_INFO, SERVICE_PRESHUTDOWN_INFO)
+
+# The bindings the simulation stands in for, by the name the package modules bind them under
+SIMULATED_APIS = ("OpenSCManager", "OpenService", "CloseServiceHandle", "CreateService", "DeleteService",
+                  "StartService", "ControlService", "QueryServiceStatus", "QueryServiceStatusEx",
+                  "QueryServiceConfig", "ChangeServiceConfig", "QueryServiceConfig2", "ChangeServiceConfig2",
+                  "EnumServicesStatusEx", "NotifyServiceStatusChange", "SetServiceStatus",
+                  "RegisterServiceCtrlHandlerEx", "StartServiceCtrlDispatcher", "SleepEx", "QueueUserAPC",
+                  "OpenThread", "GetCurrentThreadId", "CloseHandle", "LocalFree", "GetLastError", "SetLastError",
+                  "OpenProcess", "GetProcessTimes", "K32GetProcessMemoryInfo", "GetProcessHandleCount")
+
+_WCHAR_SIZE = ctypes.sizeof(ctypes.c_wchar)
+_PENDING_STATES = (ServiceState.START_PENDING, ServiceState.STOP_PENDING)
+
+
+class _SimulatedLibrary(object):
+    def __init__(self, simulation):
+        self._simulation = simulation
+
+    def __getattr__(self, name):
+        # exported names of the wide-character functions end with a W, which ours do not
+        simulated = name[:-1] if name.endswith("W") and name[:-1] in SIMULATED_APIS else name
+        if simulated not in SIMULATED_APIS:
+            raise AttributeError(name)
+        return getattr(self._simulation, "_" + simulated)
+
+
+def _value(argument):
+    # LPWSTR and SC_HANDLE arguments come as ctypes objects, or as plain values
+    return argument.value if hasattr(argument, "value") else argument
+
+
+def _target(argument):
+    # byref() arguments, pointers and addresses all lead to the object the caller wants us to fill
+    if hasattr(argument, "_obj"):
+        return argument._obj
+    if hasattr(argument, "contents"):
+        return argument.contents
+    return argument
+
+
+def _wide_size(strings):
+    return sum((len(string) + 1) * _WCHAR_SIZE for string in strings)
+
+
+class _Writer(object):
+    """ Lays out a structure followed by the strings it points to, the way the SCM fills caller buffers """
+    def __init__(self, address):
+        self.address = address
+
+    def string(self, string):
+        if string is None:
+            return None
+        address = self.address
+        ctypes.memmove(address, ctypes.create_unicode_buffer(string), (len(string) + 1) * _WCHAR_SIZE)
+        self.address += (len(string) + 1) * _WCHAR_SIZE
+        return address
+
+    def multi_sz(self, strings):
+        address = self.address
+        for string in strings:
+            self.string(string)
+        self.string(u"")
+        return address
+
+
+def _set_pointer(structure, field, address):
+    ctypes.c_void_p.from_address(ctypes.addressof(structure) + field.offset).value = address
+
+
+class SimulatedService(object):
+    """
+    A service of the simulated SCM. start_delay and stop_delay (in seconds) are how long the service stays in
+    START_PENDING and STOP_PENDING; a service with a main callable is instead run by calling main() on a thread of
+    its own when started, which is expected to go through StartServiceCtrlDispatcher like a real service process.
+    """
+    def __init__(self, name, display_name=None, service_type=ServiceType.WIN32_OWN_PROCESS,
+                 start_type=StartType.SERVICE_DEMAND_START, binary_path=u"C:\\service.exe", load_order_group=u"",
+                 dependencies=(), start_name=u"LocalSystem", error_control=1, start_delay=0.0, stop_delay=0.0,
+                 main=None):
+        super(SimulatedService, self).__init__()
+        self.name = name
+        self.display_name = display_name or name
+        self.service_type = service_type
+        self.start_type = start_type
+        self.binary_path = binary_path
+        self.load_order_group = load_order_group
+        self.dependencies = list(dependencies)
+        self.start_name = start_name
+        self.error_control = error_control
+        self.start_delay = start_delay
+        self.stop_delay = stop_delay
+        self.main = main
+        self.description = None
+        self.delayed_auto_start = False
+        self.failure_actions_on_non_crash_failures = False
+        self.service_sid_type = 0
+        self.required_privileges = []
+        self.preshutdown_timeout = 180000
+        self.state = ServiceState.STOPPED
+        self.process_id = 0
+        self.controls_accepted = 0
+        self.win32_exit_code = 0
+        self.service_specific_exit_code = 0
+        self.check_point = 0
+        self.wait_hint = 0
+        self.marked_for_delete = False
+        self.handles = 0
+        # (state to reach, when) for a pending state that ends on its own
+        self.transition = None
+        self.handler = None
+        self.handler_context = None
+        # what the process of the service reports while it runs; cpu_time is in seconds
+        self.cpu_time = 0.0
+        self.working_set = 0
+        self.private_bytes = 0
+        self.handle_count = 0
+
+
+class SimulatedAdvapi32(object):
+    """
+    An in-process stand-in for the parts of advapi32 (and the few kernel32 functions) this package binds: services
+    and their state transitions, configuration, enumeration, status change notifications delivered as emulated APCs
+    in alertable SleepEx calls, and the service side (dispatcher, control handler, SetServiceStatus).
+
+    latencies maps an API name (as in SIMULATED_APIS) to (base, jitter) in seconds, drawn from a random generator
+    seeded with seed, so runs are repeatable. inject_error() makes the next calls of an API fail.
+
+    >>> with SimulatedAdvapi32() as simulation:
+    ...     simulation.add_service(SimulatedService("VSS", start_delay=0.05))
+    ...     with ServiceControlManagerContext() as scm:
+    ...         ...
+    """
+    def __init__(self, latencies=None, seed=0):
+        super(SimulatedAdvapi32, self).__init__()
+        self.latencies = dict(latencies or ())
+        self._random = random.Random(seed)
+        self._lock = RLock()
+        self._changed = Condition(self._lock)
+        self._services = dict()
+        self._handles = dict()
+        self._next_handle = 0x1000
+        self._next_process_id = 0x100
+        self._errors = dict()
+        self._registrations = []
+        self._apcs = dict()
+        self._threads = dict()
+        self._allocations = dict()
+        self._previous_backend = None
+        self._last_error = local()
+        # as a backend, we stand in for both DLLs
+        self.advapi32 = self.kernel32 = _SimulatedLibrary(self)
+
+    # -- the simulation itself
+
+    def add_service(self, service):
+        with self._lock:
+            self._services[service.name.lower()] = service
+        return service
+
+    def get_service(self, name):
+        with self._lock:
+            self._advance()
+            return self._services.get(name.lower())
+
+    def inject_error(self, api, error, times=1):
+        """ Makes the next times calls of api fail with error """
+        with self._lock:
+            self._errors[api] = [error, times]
+
+    def install(self):
+        """ Makes the bindings of the package call into the simulation (see bindings.set_backend) """
+        self._previous_backend = set_backend(self)
+        return self
+
+    def uninstall(self):
+        set_backend(self._previous_backend)
+        self._previous_backend = None
+
+    def __enter__(self):
+        return self.install()
+
+    def __exit__(self, type, value, traceback):
+        self.uninstall()
+
+    def _call(self, api):
+        # simulated latency is spent outside the lock, so concurrent callers overlap as they do against the SCM
+        base, jitter = self.latencies.get(api, (0, 0))
+        with self._lock:
+            delay = base + (self._random.random() * jitter if jitter else 0)
+            failure = self._errors.get(api)
+            if failure is not None:
+                failure[1] -= 1
+                if failure[1] <= 0:
+                    del self._errors[api]
+        if delay:
+            time.sleep(delay)
+        return None if failure is None else failure[0]
+
+    def _fail(self, error, result=False):
+        self._last_error.value = error
+        return result
+
+    def _new_handle(self, kind, target):
+        handle = self._next_handle
+        self._next_handle += 4
+        self._handles[handle] = (kind, target)
+        return handle
+
+    def _lookup(self, handle, kind):
+        entry = self._handles.get(_value(handle))
+        if entry is None or entry[0] != kind:
+            return None
+        return entry[1]
+
+    def _set_state(self, service, state, transition=None):
+        service.state = state
+        service.transition = transition
+        service.check_point = 0
+        if state == ServiceState.STOPPED:
+            service.process_id = 0
+            service.controls_accepted = 0
+            if service.marked_for_delete and not service.handles:
+                self._remove(service)
+        self._changed.notify_all()
+
+    def _advance(self):
+        now = monotonic()
+        for service in list(self._services.values()):
+            if service.transition is None:
+                continue
+            state, due = service.transition
+            if now >= due:
+                if state == ServiceState.RUNNING:
+                    service.controls_accepted = ServiceControlsAccepted.STOP | ServiceControlsAccepted.SHUTDOWN
+                self._set_state(service, state)
+            else:
+                # a checkpoint every tenth of the pending time, as a well-behaved service would report
+                service.check_point = int(10 - 10 * (due - now) / max(service.wait_hint / 1000.0, 1e-9))
+
+    def _begin_transition(self, service, pending_state, state, delay):
+        service.wait_hint = int(delay * 1000) + 1
+        self._set_state(service, pending_state, (state, monotonic() + delay))
+
+    def _remove(self, service):
+        self._services.pop(service.name.lower(), None)
+        self._scm_event(ServiceNotifyMask.DELETED, service.name)
+        self._mark_registrations_deleted(service)
+
+    def _mark_registrations_deleted(self, service):
+        # pending notifications of a service fire with ERROR_SERVICE_MARKED_FOR_DELETE as soon as it is marked
+        for registration in self._registrations:
+            if registration[1] is service:
+                registration[4] = True
+        self._changed.notify_all()
+
+    def _fill_status(self, service, status):
+        status.dwServiceType = service.service_type
+        status.dwCurrentState = service.state
+        status.dwControlsAccepted = 0 if service.state in _PENDING_STATES else service.controls_accepted
+        status.dwWin32ExitCode = service.win32_exit_code
+        status.dwServiceSpecificExitCode = service.service_specific_exit_code
+        status.dwCheckPoint = service.check_point
+        status.dwWaitHint = service.wait_hint if service.state in _PENDING_STATES else 0
+
+    def _fill_status_process(self, service, status):
+        self._fill_status(service, status)
+        status.dwProcessId = service.process_id
+        status.dwServiceFlags = 0
+
+    # -- SCM and service handles
+
+    def _OpenSCManager(self, machine, database, access):
+        error = self._call("OpenSCManager")
+        with self._lock:
+            if error:
+                return self._fail(error, None)
+            return self._new_handle("scm", _value(machine) or u"")
+
+    def _OpenService(self, scm_handle, name, access):
+        error = self._call("OpenService")
+        with self._lock:
+            if error or self._lookup(scm_handle, "scm") is None:
+                return self._fail(error or ERROR_INVALID_HANDLE, None)
+            self._advance()
+            service = self._services.get(_value(name).lower())
+            if service is None:
+                return self._fail(ERROR_SERVICE_DOES_NOT_EXIST, None)
+            service.handles += 1
+            return self._new_handle("service", service)
+
+    def _CloseServiceHandle(self, handle):
+        error = self._call("CloseServiceHandle")
+        with self._lock:
+            entry = self._handles.pop(_value(handle), None)
+            if error or entry is None:
+                return self._fail(error or ERROR_INVALID_HANDLE)
+            # closing a handle cancels its pending notifications
+            self._registrations = [registration for registration in self._registrations
+                                   if registration[0] != _value(handle)]
+            if entry[0] == "service":
+                service = entry[1]
+                service.handles -= 1
+                if service.marked_for_delete and not service.handles and service.state == ServiceState.STOPPED:
+                    self._remove(service)
+            return True
+
+    def _CreateService(self, scm_handle, name, display_name, access, service_type, start_type, error_control,
+                       binary_path, load_order_group, tag_id, dependencies, start_name, password):
+        error = self._call("CreateService")
+        with self._lock:
+            if error or self._lookup(scm_handle, "scm") is None:
+                return self._fail(error or ERROR_INVALID_HANDLE, None)
+            existing = self._services.get(_value(name).lower())
+            if existing is not None:
+                return self._fail(ERROR_SERVICE_MARKED_FOR_DELETE if existing.marked_for_delete else
+                                  ERROR_SERVICE_EXISTS, None)
+            dependencies = _value(dependencies)
+            service = SimulatedService(_value(name), _value(display_name), service_type, start_type,
+                                       _value(binary_path), _value(load_order_group) or u"",
+                                       [dependencies] if dependencies else [], _value(start_name) or u"LocalSystem",
+                                       error_control)
+            self._services[service.name.lower()] = service
+            self._scm_event(ServiceNotifyMask.CREATED, service.name)
+            service.handles += 1
+            return self._new_handle("service", service)
+
+    def _DeleteService(self, handle):
+        error = self._call("DeleteService")
+        with self._lock:
+            service = self._lookup(handle, "service")
+            if error or service is None:
+                return self._fail(error or ERROR_INVALID_HANDLE)
+            if service.marked_for_delete:
+                return self._fail(ERROR_SERVICE_MARKED_FOR_DELETE)
+            service.marked_for_delete = True
+            self._mark_registrations_deleted(service)
+            return True
+
+    # -- state
+
+    def _StartService(self, handle, argc, argv):
+        error = self._call("StartService")
+        with self._lock:
+            service = self._lookup(handle, "service")
+            if error or service is None:
+                return self._fail(error or ERROR_INVALID_HANDLE)
+            self._advance()
+            if service.marked_for_delete:
+                return self._fail(ERROR_SERVICE_MARKED_FOR_DELETE)
+            if service.start_type == StartType.SERVICE_DISABLED:
+                return self._fail(ERROR_SERVICE_DISABLED)
+            if service.state != ServiceState.STOPPED:
+                return self._fail(ERROR_SERVICE_ALREADY_RUNNING)
+            self._next_process_id += 4
+            service.process_id = self._next_process_id
+            service.win32_exit_code = 0
+            if service.main is None:
+                self._begin_transition(service, ServiceState.START_PENDING, ServiceState.RUNNING, service.start_delay)
+                return True
+            service.wait_hint = 30000
+            self._set_state(service, ServiceState.START_PENDING)
+        thread = Thread(target=service.main, name="simulated-{}".format(service.name))
+        thread.daemon = True
+        thread.start()
+        return True
+
+    def _ControlService(self, handle, control, status):
+        error = self._call("ControlService")
+        with self._lock:
+            service = self._lookup(handle, "service")
+            if error or service is None:
+                return self._fail(error or ERROR_INVALID_HANDLE)
+            self._advance()
+            handler = service.handler
+            if control == ServiceControl.INTERROGATE and handler is None:
+                self._fill_status(service, _target(status))
+                return True
+            if control == ServiceControl.STOP and handler is None:
+                if service.state == ServiceState.STOPPED:
+                    return self._fail(ERROR_SERVICE_NOT_ACTIVE)
+                if service.state in _PENDING_STATES:
+                    return self._fail(ERROR_SERVICE_CANNOT_ACCEPT_CTRL)
+                self._begin_transition(service, ServiceState.STOP_PENDING, ServiceState.STOPPED, service.stop_delay)
+                self._fill_status(service, _target(status))
+                return True
+            if handler is None:
+                return self._fail(ERROR_INVALID_SERVICE_CONTROL)
+            if service.state == ServiceState.STOPPED:
+                return self._fail(ERROR_SERVICE_NOT_ACTIVE)
+            if service.state in _PENDING_STATES or not service.controls_accepted & _ACCEPT_FLAGS.get(control, ~0):
+                return self._fail(ERROR_SERVICE_CANNOT_ACCEPT_CTRL)
+            context = service.handler_context
+        # the SCM calls the handler on the dispatcher thread of the service; we call it on the caller's thread
+        handler(control, 0, None, context)
+        with self._lock:
+            self._fill_status(service, _target(status))
+        return True
+
+    def _QueryServiceStatus(self, handle, status):
+        error = self._call("QueryServiceStatus")
+        with self._lock:
+            service = self._lookup(handle, "service")
+            if error or service is None:
+                return self._fail(error or ERROR_INVALID_HANDLE)
+            self._advance()
+            self._fill_status(service, _target(status))
+            return True
+
+    def _QueryServiceStatusEx(self, handle, info_level, buffer, buffer_size, bytes_needed):
+        error = self._call("QueryServiceStatusEx")
+        with self._lock:
+            service = self._lookup(handle, "service")
+            if error or service is None:
+                return self._fail(error or ERROR_INVALID_HANDLE)
+            _target(bytes_needed).value = ctypes.sizeof(SERVICE_STATUS_PROCESS)
+            if buffer_size < ctypes.sizeof(SERVICE_STATUS_PROCESS):
+                return self._fail(ERROR_INSUFFICIENT_BUFFER)
+            self._advance()
+            address = buffer if isinstance(buffer, six.integer_types) else ctypes.addressof(_target(buffer))
+            self._fill_status_process(service, SERVICE_STATUS_PROCESS.from_address(address))
+            return True
+
+    # -- configuration
+
+    def _QueryServiceConfig(self, handle, config, buffer_size, bytes_needed):
+        error = self._call("QueryServiceConfig")
+        with self._lock:
+            service = self._lookup(handle, "service")
+            if error or service is None:
+                return self._fail(error or ERROR_INVALID_HANDLE)
+            strings = [service.binary_path, service.load_order_group, service.start_name, service.display_name]
+            needed = (ctypes.sizeof(QUERY_SERVICE_CONFIG) + _wide_size(strings) +
+                      _wide_size(service.dependencies) + _WCHAR_SIZE)
+            _target(bytes_needed).value = needed
+            if buffer_size < needed:
+                return self._fail(ERROR_INSUFFICIENT_BUFFER)
+            config = _target(config)
+            config.dwServiceType = service.service_type
+            config.dwStartType = service.start_type
+            config.dwErrorControl = service.error_control
+            config.dwTagId = 0
+            writer = _Writer(ctypes.addressof(config) + ctypes.sizeof(QUERY_SERVICE_CONFIG))
+            _set_pointer(config, QUERY_SERVICE_CONFIG.lpBinaryPathName, writer.string(service.binary_path))
+            _set_pointer(config, QUERY_SERVICE_CONFIG.lpLoadOrderGroup, writer.string(service.load_order_group))
+            _set_pointer(config, QUERY_SERVICE_CONFIG.lpDependencies, writer.multi_sz(service.dependencies))
+            _set_pointer(config, QUERY_SERVICE_CONFIG.lpServiceStartName, writer.string(service.start_name))
+            _set_pointer(config, QUERY_SERVICE_CONFIG.lpDisplayName, writer.string(service.display_name))
+            return True
+
+    def _ChangeServiceConfig(self, handle, service_type, start_type, error_control, binary_path, load_order_group,
+                             tag_id, dependencies, start_name, password, display_name):
+        error = self._call("ChangeServiceConfig")
+        with self._lock:
+            service = self._lookup(handle, "service")
+            if error or service is None:
+                return self._fail(error or ERROR_INVALID_HANDLE)
+            if service.marked_for_delete:
+                return self._fail(ERROR_SERVICE_MARKED_FOR_DELETE)
+            for attribute, value in (("service_type", service_type), ("start_type", start_type),
+                                     ("error_control", error_control)):
+                if value != SERVICE_NO_CHANGE:
+                    setattr(service, attribute, value)
+            for attribute, value in (("binary_path", binary_path), ("load_order_group", load_order_group),
+                                     ("start_name", start_name), ("display_name", display_name)):
+                if _value(value) is not None:
+                    setattr(service, attribute, _value(value))
+            if _value(dependencies) is not None:
+                service.dependencies = [_value(dependencies)] if _value(dependencies) else []
+            return True
+
+    def _QueryServiceConfig2(self, handle, info_level, buffer, buffer_size, bytes_needed):
+        error = self._call("QueryServiceConfig2")
+        with self._lock:
+            service = self._lookup(handle, "service")
+            if error or service is None:
+                return self._fail(error or ERROR_INVALID_HANDLE)
+            structure, strings = _CONFIG2_LAYOUTS[info_level]
+            needed = ctypes.sizeof(structure) + _wide_size(strings(service)) + _WCHAR_SIZE
+            _target(bytes_needed).value = needed
+            if buffer_size < needed:
+                return self._fail(ERROR_INSUFFICIENT_BUFFER)
+            address = buffer if isinstance(buffer, six.integer_types) else ctypes.addressof(_target(buffer))
+            ctypes.memset(address, 0, ctypes.sizeof(structure))
+            info = structure.from_address(address)
+            writer = _Writer(address + ctypes.sizeof(structure))
+            if info_level == ServiceConfigInfoLevel.DESCRIPTION:
+                _set_pointer(info, SERVICE_DESCRIPTION.lpDescription, writer.string(service.description))
+            elif info_level == ServiceConfigInfoLevel.DELAYED_AUTO_START_INFO:
+                info.fDelayedAutostart = service.delayed_auto_start
+            elif info_level == ServiceConfigInfoLevel.FAILURE_ACTIONS_FLAG:
+                info.fFailureActionsOnNonCrashFailures = service.failure_actions_on_non_crash_failures
+            elif info_level == ServiceConfigInfoLevel.SERVICE_SID_INFO:
+                info.dwServiceSidType = service.service_sid_type
+            elif info_level == ServiceConfigInfoLevel.REQUIRED_PRIVILEGES_INFO:
+                _set_pointer(info, SERVICE_REQUIRED_PRIVILEGES_INFO.pmszRequiredPrivileges,
+                             writer.multi_sz(service.required_privileges))
+            elif info_level == ServiceConfigInfoLevel.PRESHUTDOWN_INFO:
+                info.dwPreshutdownTimeout = service.preshutdown_timeout
+            return True
+
+    def _ChangeServiceConfig2(self, handle, info_level, info):
+        error = self._call("ChangeServiceConfig2")
+        with self._lock:
+            service = self._lookup(handle, "service")
+            if error or service is None:
+                return self._fail(error or ERROR_INVALID_HANDLE)
+            info = _target(info)
+            if info_level == ServiceConfigInfoLevel.DESCRIPTION:
+                service.description = info.lpDescription
+            elif info_level == ServiceConfigInfoLevel.DELAYED_AUTO_START_INFO:
+                service.delayed_auto_start = bool(info.fDelayedAutostart)
+            elif info_level == ServiceConfigInfoLevel.FAILURE_ACTIONS_FLAG:
+                service.failure_actions_on_non_crash_failures = bool(info.fFailureActionsOnNonCrashFailures)
+            elif info_level == ServiceConfigInfoLevel.SERVICE_SID_INFO:
+                service.service_sid_type = info.dwServiceSidType
+            elif info_level == ServiceConfigInfoLevel.PRESHUTDOWN_INFO:
+                service.preshutdown_timeout = info.dwPreshutdownTimeout
+            return True
+
+    def _EnumServicesStatusEx(self, scm_handle, info_level, service_type, service_state, buffer, buffer_size,
+                              bytes_needed, services_returned, resume_handle, group):
+        error = self._call("EnumServicesStatusEx")
+        with self._lock:
+            if error or self._lookup(scm_handle, "scm") is None:
+                return self._fail(error or ERROR_INVALID_HANDLE)
+            self._advance()
+            group = _value(group)
+            matching = [service for _, service in sorted(self._services.items())
+                        if service.service_type & service_type and _state_matches(service, service_state) and
+                        (group is None or service.load_order_group.lower() == group.lower())]
+            resume_handle = _target(resume_handle)
+            remaining = matching[resume_handle.value:]
+            address = ctypes.addressof(_target(buffer))
+            sizes = [ctypes.sizeof(ENUM_SERVICE_STATUS_PROCESS) + _wide_size([service.name, service.display_name])
+                     for service in remaining]
+            count, used = 0, 0
+            while count < len(remaining) and used + sizes[count] <= buffer_size:
+                used += sizes[count]
+                count += 1
+            # the records come first and the strings they point to after all of them
+            entries = (ENUM_SERVICE_STATUS_PROCESS * count).from_address(address)
+            writer = _Writer(address + ctypes.sizeof(entries))
+            for entry, service in zip(entries, remaining):
+                _set_pointer(entry, ENUM_SERVICE_STATUS_PROCESS.lpServiceName, writer.string(service.name))
+                _set_pointer(entry, ENUM_SERVICE_STATUS_PROCESS.lpDisplayName, writer.string(service.display_name))
+                self._fill_status_process(service, entry.ServiceStatusProcess)
+            _target(services_returned).value = count
+            if count == len(remaining):
+                resume_handle.value = 0
+                _target(bytes_needed).value = 0
+                return True
+            resume_handle.value += count
+            _target(bytes_needed).value = sum(sizes[count:])
+            return self._fail(ERROR_MORE_DATA)
+
+    # -- notifications
+
+    def _NotifyServiceStatusChange(self, handle, mask, buffer):
+        error = self._call("NotifyServiceStatusChange")
+        with self._lock:
+            entry = self._handles.get(_value(handle))
+            if error or entry is None:
+                return error or ERROR_INVALID_HANDLE
+            kind, target = entry
+            if kind == "service" and target.marked_for_delete:
+                return ERROR_SERVICE_MARKED_FOR_DELETE
+            # [handle, service or None, mask, SERVICE_NOTIFY, deleted, thread, SCM events so far]
+            self._registrations.append([_value(handle), target if kind == "service" else None, mask,
+                                        _target(buffer), False, get_ident(), []])
+            self._changed.notify_all()
+            return NO_ERROR
+
+    def _scm_event(self, kind, name):
+        for registration in self._registrations:
+            if registration[1] is None and registration[2] & kind:
+                registration[6].append(u"/" + name if kind == ServiceNotifyMask.CREATED else name)
+        self._changed.notify_all()
+
+    def _due_notifications(self, thread):
+        due = []
+        for registration in list(self._registrations):
+            handle, service, mask, notify, deleted, owner, events = registration
+            if owner != thread:
+                continue
+            if service is None:
+                fired = bool(events)
+            else:
+                fired = deleted or bool(mask & (1 << (service.state - 1)))
+            if fired:
+                self._registrations.remove(registration)
+                due.append(registration)
+        return due
+
+    def _fire(self, registration):
+        handle, service, mask, notify, deleted, owner, events = registration
+        notify.dwNotificationStatus = ERROR_SERVICE_MARKED_FOR_DELETE if deleted else NO_ERROR
+        notify.pszServiceNames = None
+        if service is not None:
+            self._fill_status_process(service, notify.ServiceStatus)
+            notify.dwNotificationTriggered = 1 << (service.state - 1)
+        else:
+            notify.dwNotificationTriggered = mask & (ServiceNotifyMask.CREATED | ServiceNotifyMask.DELETED)
+            names = ctypes.create_string_buffer(_wide_size(events) + _WCHAR_SIZE)
+            _Writer(ctypes.addressof(names)).multi_sz(events)
+            self._allocations[ctypes.addressof(names)] = names
+            notify.pszServiceNames = ctypes.addressof(names)
+        return notify
+
+    def _next_due_time(self):
+        times = [service.transition[1] for service in self._services.values() if service.transition is not None]
+        return min(times) if times else None
+
+    def _SleepEx(self, milliseconds, alertable):
+        deadline = None if milliseconds == INFINITE else monotonic() + milliseconds / 1000.0
+        thread = get_ident()
+        with self._lock:
+            while True:
+                self._advance()
+                if alertable:
+                    apcs = self._apcs.pop(thread, [])
+                    notifications = [self._fire(registration) for registration in self._due_notifications(thread)]
+                    if apcs or notifications:
+                        break
+                now = monotonic()
+                if deadline is not None and now >= deadline:
+                    return 0
+                wake = [time for time in (deadline, self._next_due_time()) if time is not None]
+                self._changed.wait(min(wake) - now if wake else None)
+        # APCs run outside the lock, as they call back into the package
+        for function, parameter in apcs:
+            function(parameter)
+        for notify in notifications:
+            notify.pfnNotifyCallback(ctypes.addressof(notify))
+        return WAIT_IO_COMPLETION
+
+    def _QueueUserAPC(self, function, thread_handle, parameter):
+        error = self._call("QueueUserAPC")
+        with self._lock:
+            thread = self._threads.get(_value(thread_handle))
+            if error or thread is None:
+                return self._fail(error or ERROR_INVALID_HANDLE, 0)
+            self._apcs.setdefault(thread, []).append((function, parameter))
+            self._changed.notify_all()
+            return 1
+
+    def _OpenThread(self, access, inherit, thread_id):
+        with self._lock:
+            handle = self._next_handle
+            self._next_handle += 4
+            self._threads[handle] = thread_id
+            return handle
+
+    def _GetCurrentThreadId(self):
+        return get_ident()
+
+    def _CloseHandle(self, handle):
+        with self._lock:
+            if self._lookup(handle, "process") is not None:
+                del self._handles[_value(handle)]
+                return True
+            return self._threads.pop(_value(handle), None) is not None
+
+    def _OpenProcess(self, access, inherit, process_id):
+        error = self._call("OpenProcess")
+        with self._lock:
+            self._advance()
+            services = [service for service in self._services.values()
+                        if service.process_id and service.process_id == process_id]
+            if error or not services:
+                return self._fail(error or ERROR_INVALID_PARAMETER, None)
+            return self._new_handle("process", process_id)
+
+    def _process_service(self, handle):
+        # the counters of a shared process are those of the first service we find in it
+        process_id = self._lookup(handle, "process")
+        for service in self._services.values():
+            if process_id and service.process_id == process_id:
+                return service
+        return None
+
+    def _GetProcessTimes(self, handle, creation_time, exit_time, kernel_time, user_time):
+        error = self._call("GetProcessTimes")
+        with self._lock:
+            service = self._process_service(handle)
+            if error or service is None:
+                return self._fail(error or ERROR_INVALID_HANDLE)
+            units = int(service.cpu_time * 10000000)
+            for filetime, value in ((creation_time, 0), (exit_time, 0), (kernel_time, 0), (user_time, units)):
+                filetime = _target(filetime)
+                filetime.dwLowDateTime, filetime.dwHighDateTime = value & 0xFFFFFFFF, value >> 32
+            return True
+
+    def _K32GetProcessMemoryInfo(self, handle, counters, size):
+        error = self._call("K32GetProcessMemoryInfo")
+        with self._lock:
+            service = self._process_service(handle)
+            if error or service is None:
+                return self._fail(error or ERROR_INVALID_HANDLE)
+            counters = _target(counters)
+            counters.WorkingSetSize = counters.PeakWorkingSetSize = service.working_set
+            counters.PrivateUsage = counters.PagefileUsage = service.private_bytes
+            return True
+
+    def _GetProcessHandleCount(self, handle, count):
+        error = self._call("GetProcessHandleCount")
+        with self._lock:
+            service = self._process_service(handle)
+            if error or service is None:
+                return self._fail(error or ERROR_INVALID_HANDLE)
+            _target(count).value = service.handle_count
+            return True
+
+    def _GetLastError(self):
+        return getattr(self._last_error, "value", 0)
+
+    def _SetLastError(self, error):
+        self._last_error.value = error
+
+    def _LocalFree(self, address):
+        with self._lock:
+            self._allocations.pop(_value(address), None)
+        return None
+
+    # -- the service side
+
+    def _StartServiceCtrlDispatcher(self, table):
+        # runs every ServiceMain of the table on a thread of its own and returns when all of them did
+        entries = _target(table)
+        threads = []
+        for entry in entries:
+            if not entry.lpServiceName:
+                break
+            thread = Thread(target=entry.lpServiceProc, args=(0, None),
+                            name="simulated-{}-main".format(entry.lpServiceName))
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+        return True
+
+    def _RegisterServiceCtrlHandlerEx(self, name, handler, context):
+        error = self._call("RegisterServiceCtrlHandlerEx")
+        with self._lock:
+            service = self._services.get(_value(name).lower())
+            if error or service is None:
+                return self._fail(error or ERROR_SERVICE_DOES_NOT_EXIST, None)
+            service.handler = handler
+            service.handler_context = context
+            return self._new_handle("status", service)
+
+    def _SetServiceStatus(self, status_handle, status):
+        error = self._call("SetServiceStatus")
+        with self._lock:
+            service = self._lookup(status_handle, "status")
+            if error or service is None:
+                return self._fail(error or ERROR_INVALID_HANDLE)
+            status = _target(status)
+            service.controls_accepted = status.dwControlsAccepted
+            service.win32_exit_code = status.dwWin32ExitCode
+            service.service_specific_exit_code = status.dwServiceSpecificExitCode
+            service.wait_hint = status.dwWaitHint
+            self._set_state(service, status.dwCurrentState)
+            service.check_point = status.dwCheckPoint
+            if status.dwCurrentState == ServiceState.STOPPED:
+                service.handler = None
+            return True
+
+
+def _state_matches(service, service_state):
+    stopped = service.state == ServiceState.STOPPED
+    return (service_state & ServiceEnumState.INACTIVE and stopped) or (service_state & ServiceEnumState.ACTIVE and
+                                                                      not stopped)
+
+
+# controls a hosted service gets only if it said it accepts them; we let the others through
+_ACCEPT_FLAGS = {
+    ServiceControl.STOP: ServiceControlsAccepted.STOP,
+    ServiceControl.SHUTDOWN: ServiceControlsAccepted.SHUTDOWN,
+    ServiceControl.PRESHUTDOWN: ServiceControlsAccepted.PRESHUTDOWN,
+    ServiceControl.SESSIONCHANGE: ServiceControlsAccepted.SESSIONCHANGE,
+    ServiceControl.POWEREVENT: ServiceControlsAccepted.POWEREVENT,
+    ServiceControl.TIMECHANGE: ServiceControlsAccepted.TIMECHANGE,
+}
+
+# info level -> (structure, function of the service that returns the strings stored after it)
+_CONFIG2_LAYOUTS = {
+    ServiceConfigInfoLevel.DESCRIPTION: (SERVICE_DESCRIPTION,
+                                         lambda service: [service.description] if service.description else []),
+    ServiceConfigInfoLevel.FAILURE_ACTIONS: (SERVICE_FAILURE_ACTIONS, lambda service: []),
+    ServiceConfigInfoLevel.DELAYED_AUTO_START_INFO: (SERVICE_DELAYED_AUTO_START_INFO, lambda service: []),
+    ServiceConfigInfoLevel.FAILURE_ACTIONS_FLAG: (SERVICE_FAILURE_ACTIONS_FLAG, lambda service: []),
+    ServiceConfigInfoLevel.SERVICE_SID_INFO: (SERVICE_SID_INFO, lambda service: []),
+    ServiceConfigInfoLevel.REQUIRED_PRIVILEGES_INFO: (SERVICE_REQUIRED_PRIVILEGES_INFO,
+                                                      lambda service: service.required_privileges),
+    ServiceConfigInfoLevel.PRESHUTDOWN_INFO: (SERVICE_PRESHUTDOWN_INFO, lambda service: []),
+}
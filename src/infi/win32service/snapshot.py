@@ -0,0 +1,151 @@
+from array import array
+from collections import namedtuple
+import time
+
+from .service_control_manager import SERVICE_WIN32, ServiceEnumState
+
+# The status fields a snapshot keeps, each in an array('I') column (they are all DWORDs)
+SNAPSHOT_COLUMNS = ("service_type", "current_state", "controls_accepted", "win32_exit_code",
+                    "service_specific_exit_code", "check_point", "wait_hint", "process_id", "service_flags")
+
+SnapshotRow = namedtuple("SnapshotRow", ("service_name", ) + SNAPSHOT_COLUMNS)
+
+# added and removed are service names; changed is a list of (service name, names of the columns that changed)
+SnapshotDiff = namedtuple("SnapshotDiff", ["added", "removed", "changed"])
+
+
+class StatusSnapshot(object):
+    """
+    The statuses of many services at one point in time, stored by column: one array('I') per status field (see
+    SNAPSHOT_COLUMNS) and a tuple of service names, so a snapshot of thousands of services is a dozen objects
+    rather than a few per service. Names are interned, and a snapshot taken with previous= shares the name tuple of
+    the previous one when the services did not change.
+
+    Filters (where(), select()) return new snapshots; diff() compares two snapshots column by column.
+    """
+    __slots__ = ("names", "columns", "timestamp", "_rows_by_name")
+
+    # service names are unicode on python 2 as well, which intern() does not take, so they are interned here
+    _interned_names = dict()
+
+    def __init__(self, names, columns, timestamp=None):
+        self.names = names
+        self.columns = columns
+        self.timestamp = time.time() if timestamp is None else timestamp
+        self._rows_by_name = None
+
+    @classmethod
+    def take(cls, scm, type=SERVICE_WIN32, state=ServiceEnumState.ALL, previous=None):
+        """ Takes a snapshot of the services of a ServiceControlManager, in a single sweep """
+        return cls.from_statuses(scm.enumerate_services(type, state), previous)
+
+    @classmethod
+    def from_statuses(cls, statuses, previous=None):
+        """ Builds a snapshot of EnumServiceStatus (or any objects with the same attributes) """
+        names = []
+        columns = [array("I") for name in SNAPSHOT_COLUMNS]
+        for status in statuses:
+            names.append(status.service_name)
+            for column, name in zip(columns, SNAPSHOT_COLUMNS):
+                column.append(getattr(status, name))
+        if previous is not None and len(previous.names) == len(names) and list(previous.names) == names:
+            names = previous.names
+        else:
+            names = tuple(cls._interned_names.setdefault(name, name) for name in names)
+        return cls(names, dict(zip(SNAPSHOT_COLUMNS, columns)))
+
+    def __len__(self):
+        return len(self.names)
+
+    def __iter__(self):
+        for index in range(len(self.names)):
+            yield self.row(index)
+
+    def __contains__(self, name):
+        return name.lower() in self._index()
+
+    def _index(self):
+        if self._rows_by_name is None:
+            self._rows_by_name = dict((name.lower(), index) for index, name in enumerate(self.names))
+        return self._rows_by_name
+
+    def row(self, index):
+        return SnapshotRow(self.names[index], *[self.columns[name][index] for name in SNAPSHOT_COLUMNS])
+
+    def get(self, name):
+        """ Returns the SnapshotRow of the service called name (case insensitive), or None """
+        index = self._index().get(name.lower())
+        return None if index is None else self.row(index)
+
+    def column(self, name):
+        """ Returns the array('I') of a column; it is shared with the snapshot, so do not change it """
+        return self.columns[name]
+
+    def memoryview(self, name):
+        """ Returns a read-only memoryview of a column, e.g. to hand it over to numpy or write it out as is """
+        view = memoryview(self.columns[name])
+        return view.toreadonly() if hasattr(view, "toreadonly") else view
+
+    def mask(self, **conditions):
+        """
+        Returns the indices of the rows where every column given equals its value, e.g. mask(current_state=4). A
+        value may also be a set or a frozenset, for any of its members.
+        """
+        indices = None
+        for name, value in conditions.items():
+            column = self.columns[name]
+            candidates = range(len(column)) if indices is None else indices
+            if isinstance(value, (set, frozenset)):
+                indices = [index for index in candidates if column[index] in value]
+            else:
+                indices = [index for index in candidates if column[index] == value]
+        return list(range(len(self.names))) if indices is None else indices
+
+    def select(self, indices):
+        """ Returns a snapshot of the rows at indices """
+        names = tuple(self.names[index] for index in indices)
+        columns = dict((name, array("I", [column[index] for index in indices]))
+                       for name, column in self.columns.items())
+        return StatusSnapshot(names, columns, self.timestamp)
+
+    def where(self, **conditions):
+        """ Returns a snapshot of the rows that match conditions (see mask) """
+        return self.select(self.mask(**conditions))
+
+    def diff(self, other):
+        """
+        Returns a SnapshotDiff of the services added, removed and changed from this snapshot to other (a later one).
+        Two snapshots of the same services in the same order, the common case, are compared a column at a time, and
+        only the columns that are not equal as a whole are compared row by row.
+        """
+        if self.names is other.names or self.names == other.names:
+            changed = dict()
+            for name in SNAPSHOT_COLUMNS:
+                before, after = self.columns[name], other.columns[name]
+                if before == after:
+                    continue
+                for index in range(len(before)):
+                    if before[index] != after[index]:
+                        changed.setdefault(index, []).append(name)
+            return SnapshotDiff([], [], [(self.names[index], changed[index]) for index in sorted(changed)])
+        ours, theirs = self._index(), other._index()
+        added = [name for name in other.names if name.lower() not in ours]
+        removed = [name for name in self.names if name.lower() not in theirs]
+        changed = []
+        for name in self.names:
+            index = ours[name.lower()]
+            other_index = theirs.get(name.lower())
+            if other_index is None:
+                continue
+            columns = [column for column in SNAPSHOT_COLUMNS
+                       if self.columns[column][index] != other.columns[column][other_index]]
+            if columns:
+                changed.append((name, columns))
+        return SnapshotDiff(added, removed, changed)
+
+    def nbytes(self):
+        """ Returns how many bytes the columns take """
+        return sum(column.itemsize * len(column) for column in self.columns.values())
+
+    def __repr__(self):
+        return "<StatusSnapshot of {} services>".format(len(self.names))
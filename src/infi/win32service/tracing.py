@@ -0,0 +1,169 @@
+from collections import namedtuple
+from threading import Lock
+from six.moves._thread import get_ident
+import datetime
+import struct
+import sys
+import time
+
+from .utils import enum
+
+# What a trace record is about, and what its arguments (a, b, c, d) hold
+TraceEvent = enum(
+    SERVICE_MAIN_ENTERED = 1,   # -
+    HANDLER_REGISTERED   = 2,   # -
+    MAIN_ENTERED         = 3,   # -
+    MAIN_RETURNED        = 4,   # -
+    CONTROL_RECEIVED     = 5,   # control, event type
+    CONTROL_HANDLED      = 6,   # control, result
+    STATUS_REPORTED      = 7,   # state, controls accepted, check point, wait hint
+    DRAIN_STARTED        = 8,   # drain index
+    DRAIN_FINISHED       = 9,   # drain index, 1 if it overran its budget
+    CRASHED              = 10,  # -
+    MAIN_RESTARTING      = 11,  # restarts so far, delay in milliseconds
+)
+
+EVENT_NAMES = dict((value, name) for name, value in vars(TraceEvent).items() if not name.startswith("_"))
+
+# timestamp (seconds on the trace clock), thread ID, event, flags (reserved), a, b, c, d: 32 bytes per record
+TRACE_RECORD = struct.Struct("<dIHHIIII")
+
+TraceRecord = namedtuple("TraceRecord", ["timestamp", "thread_id", "event", "a", "b", "c", "d"])
+
+_timer = getattr(time, "perf_counter", time.time)
+
+
+class TraceBuffer(object):
+    """
+    Fixed-size binary trace records in a ring buffer preallocated for capacity records, so recording costs a struct
+    pack into a bytearray under a lock, and no formatting or allocation. Once full, new records overwrite the
+    oldest ones.
+    """
+    def __init__(self, capacity=4096):
+        super(TraceBuffer, self).__init__()
+        self.capacity = capacity
+        self._buffer = bytearray(TRACE_RECORD.size * capacity)
+        self._written = 0
+        self._lock = Lock()
+        # the trace clock is monotonic; these map it to wall-clock time for dumps
+        self.started_at = time.time()
+        self._started = _timer()
+
+    def record(self, event, a=0, b=0, c=0, d=0):
+        timestamp = _timer() - self._started
+        thread_id = get_ident() & 0xFFFFFFFF
+        with self._lock:
+            offset = (self._written % self.capacity) * TRACE_RECORD.size
+            TRACE_RECORD.pack_into(self._buffer, offset, timestamp, thread_id, event, 0, a & 0xFFFFFFFF,
+                                   b & 0xFFFFFFFF, c & 0xFFFFFFFF, d & 0xFFFFFFFF)
+            self._written += 1
+
+    def __len__(self):
+        return min(self._written, self.capacity)
+
+    @property
+    def dropped(self):
+        """ How many records were overwritten """
+        return max(self._written - self.capacity, 0)
+
+    def clear(self):
+        with self._lock:
+            self._written = 0
+
+    def to_bytes(self):
+        """ Returns the records held, oldest first, as packed TRACE_RECORDs """
+        with self._lock:
+            count = min(self._written, self.capacity)
+            start = (self._written - count) % self.capacity * TRACE_RECORD.size
+            end = start + count * TRACE_RECORD.size
+            if end <= len(self._buffer):
+                return bytes(self._buffer[start:end])
+            return bytes(self._buffer[start:]) + bytes(self._buffer[:end - len(self._buffer)])
+
+    def records(self):
+        """ Returns the records held, oldest first, as TraceRecords """
+        data = self.to_bytes()
+        records = []
+        for offset in range(0, len(data), TRACE_RECORD.size):
+            timestamp, thread_id, event, flags, a, b, c, d = TRACE_RECORD.unpack_from(data, offset)
+            records.append(TraceRecord(timestamp, thread_id, event, a, b, c, d))
+        return records
+
+    def dump(self, stream):
+        """ Writes the records held to a text stream, one line per record """
+        if self.dropped:
+            stream.write("({} older records were overwritten)\n".format(self.dropped))
+        previous = None
+        for record in self.records():
+            when = datetime.datetime.fromtimestamp(self.started_at + record.timestamp)
+            delta = 0.0 if previous is None else record.timestamp - previous
+            stream.write("{} (+{:.6f}s) thread {:>5} {:<20} {:#x} {:#x} {:#x} {:#x}\n".format(
+                when.isoformat(), delta, record.thread_id, EVENT_NAMES.get(record.event, record.event),
+                record.a, record.b, record.c, record.d))
+            previous = record.timestamp
+
+
+_buffer = None
+_crash_path = None
+
+
+def enable(capacity=4096):
+    """ Starts tracing into a new TraceBuffer of capacity records, and returns it """
+    global _buffer
+    _buffer = TraceBuffer(capacity)
+    return _buffer
+
+
+def disable():
+    global _buffer
+    _buffer = None
+
+
+def get_buffer():
+    """ Returns the TraceBuffer we trace into, or None if tracing is not enabled """
+    return _buffer
+
+
+def record(event, a=0, b=0, c=0, d=0):
+    """ Records an event if tracing is enabled; costs next to nothing if it is not """
+    buffer = _buffer
+    if buffer is not None:
+        buffer.record(event, a, b, c, d)
+
+
+def dump(stream=None):
+    """ Writes the trace (if tracing is enabled) to stream, stderr by default """
+    buffer = _buffer
+    if buffer is not None:
+        buffer.dump(stream or sys.stderr)
+
+
+def dump_on_crash(path):
+    """
+    Makes crashed() append the trace to the file at path (None stops that). The service runner calls crashed() when
+    main() or a control handler raises; so do uncaught exceptions in the main thread.
+    """
+    global _crash_path
+    _crash_path = path
+    if path is not None and getattr(sys.excepthook, "dumps_trace", False) is False:
+        previous_hook = sys.excepthook
+
+        def excepthook(*args):
+            crashed()
+            previous_hook(*args)
+        excepthook.dumps_trace = True
+        sys.excepthook = excepthook
+
+
+def crashed():
+    buffer, path = _buffer, _crash_path
+    if buffer is None:
+        return
+    buffer.record(TraceEvent.CRASHED)
+    if path is None:
+        return
+    try:
+        with open(path, "a") as stream:
+            buffer.dump(stream)
+    except (IOError, OSError):
+        pass
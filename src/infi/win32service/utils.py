@@ -1,5 +1,25 @@
+import ctypes
+import time
+
 # From http://stackoverflow.com/questions/36932/whats-the-best-way-to-implement-an-enum-in-python
 def enum(*sequential, **named):
     enums = dict(zip(sequential, range(len(sequential))), **named)
     return type('Enum', (), enums)
 
+
+# time.monotonic does not exist on Python 2, where we settle for wall-clock time
+monotonic = getattr(time, "monotonic", time.time)
+
+
+def read_multi_sz(address):
+    """
+    Reads a double-null-terminated list of wide strings starting at address.
+    """
+    strings = []
+    while address:
+        string = ctypes.wstring_at(address)
+        if not string:
+            break
+        strings.append(string)
+        address += (len(string) + 1) * ctypes.sizeof(ctypes.c_wchar)
+    return strings
@@ -0,0 +1,329 @@
+from collections import namedtuple, OrderedDict
+from threading import Thread, Event, Lock
+from six.moves import queue
+from six.moves import BaseHTTPServer
+import logging
+import time
+
+from .utils import monotonic
+from .service import ServiceState
+from .catalog import ServiceCatalog, CatalogEvent
+from .notifier import get_notifier
+
+logger = logging.getLogger(__name__)
+
+# timestamp is wall-clock time (time.time()) of the last change folded into the transition, and coalesced is the
+# number of changes it stands for (more than one when the service flapped within the coalescing window)
+StateTransition = namedtuple("StateTransition", ["service_name", "previous_state", "state", "process_id",
+                                                 "timestamp", "coalesced"])
+
+# What stop() puts on the queue of every consumer, to end its watch() iterator
+_STOPPED = object()
+
+STATE_NAMES = dict((value, name.lower()) for name, value in vars(ServiceState).items() if not name.startswith("_"))
+
+
+class ServiceWatcher(object):
+    """
+    Watches the state of every service for any number of consumers, so they do not each poll the SCM: a
+    ServiceCatalog kept current by status change notifications, or, without notification support, refreshed every
+    poll_interval seconds. Consumers call watch(), and the exporter reads states() and transition_counts().
+    """
+    def __init__(self, machine=None, poll_interval=1.0, notifier=None):
+        super(ServiceWatcher, self).__init__()
+        self.machine = machine
+        self.poll_interval = poll_interval
+        self._notifier = notifier
+        self._catalog = None
+        self._lock = Lock()
+        self._states = dict()
+        self._transitions = dict()
+        self._consumers = []
+        self._poller = None
+        self._stopped = Event()
+
+    @property
+    def catalog(self):
+        return self._catalog
+
+    def start(self):
+        with self._lock:
+            if self._catalog is not None:
+                return self
+            notifier = self._notifier or get_notifier()
+            self._catalog = ServiceCatalog(self.machine, notifier=notifier)
+            self._catalog.add_listener(self._on_catalog_event)
+        self._catalog.start()
+        if notifier is None:
+            self._stopped.clear()
+            self._poller = Thread(target=self._poll, name="win32service-watcher")
+            self._poller.daemon = True
+            self._poller.start()
+        return self
+
+    def stop(self):
+        """ Stops watching; the iterators returned by watch() end """
+        with self._lock:
+            consumers, self._consumers = self._consumers, []
+        for accept, put in consumers:
+            put(_STOPPED)
+        if self._poller is not None:
+            self._stopped.set()
+            self._poller.join()
+            self._poller = None
+        catalog, self._catalog = self._catalog, None
+        if catalog is not None:
+            catalog.close()
+
+    def states(self):
+        """ Returns a dict of service name -> its current ServiceState """
+        with self._lock:
+            return dict(self._states)
+
+    def transition_counts(self):
+        """ Returns a dict of (service name, state) -> how many times the service entered that state """
+        with self._lock:
+            return dict(self._transitions)
+
+    def watch(self, names_or_filter=None, coalesce_in_seconds=0.25, timeout_in_seconds=None):
+        """
+        Returns an iterator that yields a StateTransition every time one of the watched services changes its state,
+        and nothing else.
+
+        names_or_filter is an iterable of service names, a callable that takes a CatalogEntry and tells whether to
+        watch the service, or None for all services. Changes of a service that follow each other within
+        coalesce_in_seconds are folded into one transition, and a service that flapped back to where it was yields
+        nothing. The iterator ends after timeout_in_seconds (if given) without transitions, or when the watcher is
+        stopped.
+
+        Changes are collected from the moment watch() returns, not from the first next(); close() the iterator (or
+        use it in a with statement, or run it to the end) to stop collecting them.
+        """
+        self.start()
+        accept = _make_filter(names_or_filter)
+        changes = queue.Queue()
+        consumer = (accept, changes.put)
+        with self._lock:
+            self._consumers.append(consumer)
+            emitted = dict(self._states)
+        return _Transitions(self, consumer, _coalesce(changes, emitted, coalesce_in_seconds, timeout_in_seconds))
+
+    def _remove_consumer(self, consumer):
+        with self._lock:
+            if consumer in self._consumers:
+                self._consumers.remove(consumer)
+
+    def _on_catalog_event(self, event, entry):
+        name = entry.service_name
+        with self._lock:
+            if event == CatalogEvent.DELETED:
+                self._states.pop(name, None)
+                return
+            previous = self._states.get(name)
+            if previous == entry.current_state:
+                return
+            self._states[name] = entry.current_state
+            if previous is not None:
+                key = (name, entry.current_state)
+                self._transitions[key] = self._transitions.get(key, 0) + 1
+            consumers = list(self._consumers)
+        change = StateTransition(name, previous, entry.current_state, entry.process_id, time.time(), 1)
+        for accept, put in consumers:
+            try:
+                if accept(entry):
+                    put(change)
+            except:
+                logger.exception("exception caught in watch filter")
+
+    def _poll(self):
+        while not self._stopped.wait(self.poll_interval):
+            try:
+                self._catalog.refresh()
+            except:
+                logger.exception("failed to refresh the service catalog")
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, type, value, traceback):
+        self.stop()
+
+
+class _Transitions(object):
+    """
+    What ServiceWatcher.watch() returns. Unlike a generator, which only runs its cleanup once it was started, closing
+    it stops the collection of changes whether or not it was ever iterated.
+    """
+    def __init__(self, watcher, consumer, transitions):
+        super(_Transitions, self).__init__()
+        self._watcher = watcher
+        self._consumer = consumer
+        self._transitions = transitions
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        try:
+            return next(self._transitions)
+        except StopIteration:
+            self.close()
+            raise
+
+    next = __next__
+
+    def close(self):
+        self._watcher._remove_consumer(self._consumer)
+        self._transitions.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+
+def _make_filter(names_or_filter):
+    if names_or_filter is None:
+        return lambda entry: True
+    if callable(names_or_filter):
+        return names_or_filter
+    names = set(name.lower() for name in names_or_filter)
+    return lambda entry: entry.service_name.lower() in names
+
+
+def _coalesce(changes, emitted, window, timeout):
+    # pending holds, per service, (when its first unreported change came, the changes folded so far)
+    pending = OrderedDict()
+    idle_since = monotonic()
+    while True:
+        now = monotonic()
+        deadlines = [first + window for first, change in pending.values()]
+        if timeout is not None:
+            deadlines.append(idle_since + timeout)
+        wait = max(min(deadlines) - now, 0) if deadlines else None
+        try:
+            change = changes.get(timeout=wait) if wait is None or wait > 0 else changes.get_nowait()
+        except queue.Empty:
+            change = None
+        if change is _STOPPED:
+            return
+        now = monotonic()
+        if change is not None:
+            folded = pending.get(change.service_name)
+            if folded is None:
+                pending[change.service_name] = (now, change)
+            else:
+                pending[change.service_name] = (folded[0], change._replace(previous_state=folded[1].previous_state,
+                                                                           coalesced=folded[1].coalesced + 1))
+        for name, (first, folded) in list(pending.items()):
+            if now < first + window:
+                continue
+            del pending[name]
+            last_state = emitted.get(name, folded.previous_state)
+            if last_state is None:
+                # a service created since we started watching; where it starts from is not a transition
+                emitted[name] = folded.state
+                continue
+            if folded.state == last_state:
+                continue
+            emitted[name] = folded.state
+            idle_since = now
+            yield folded._replace(previous_state=last_state)
+        if change is None and not pending and timeout is not None and now >= idle_since + timeout:
+            return
+
+
+_watcher = None
+_watcher_lock = Lock()
+
+
+def get_watcher():
+    """ Returns the process-wide ServiceWatcher of the local SCM, started on first use """
+    global _watcher
+    with _watcher_lock:
+        if _watcher is None:
+            _watcher = ServiceWatcher()
+    return _watcher.start()
+
+
+def watch(names_or_filter=None, coalesce_in_seconds=0.25, timeout_in_seconds=None):
+    """ Watches services of the local SCM through the process-wide ServiceWatcher (see ServiceWatcher.watch) """
+    return get_watcher().watch(names_or_filter, coalesce_in_seconds, timeout_in_seconds)
+
+
+def _escape_label(value):
+    return value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def format_metrics(watcher):
+    """ Returns the states and transition counters of watcher in the Prometheus text exposition format """
+    lines = ["# HELP win32service_state Whether the service is in the state (only the current one is listed).",
+             "# TYPE win32service_state gauge"]
+    for name, state in sorted(watcher.states().items()):
+        lines.append('win32service_state{{service="{}",state="{}"}} 1'.format(_escape_label(name),
+                                                                           STATE_NAMES.get(state, state)))
+    lines.extend(["# HELP win32service_transitions_total Times the service entered the state since watching began.",
+                  "# TYPE win32service_transitions_total counter"])
+    for (name, state), count in sorted(watcher.transition_counts().items()):
+        lines.append('win32service_transitions_total{{service="{}",state="{}"}} {}'.format(
+            _escape_label(name), STATE_NAMES.get(state, state), count))
+    return u"\n".join(lines) + u"\n"
+
+
+class _MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = format_metrics(self.server.watcher).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug("metrics exporter: " + format, *args)
+
+
+class MetricsExporter(object):
+    """
+    Serves the states and transition counters of a ServiceWatcher (the process-wide one by default) at
+    http://host:port/metrics, in the Prometheus text format. It listens on the loopback interface unless told
+    otherwise; port 0 picks a free port, see server_address.
+    """
+    def __init__(self, watcher=None, host="127.0.0.1", port=9479):
+        super(MetricsExporter, self).__init__()
+        self.watcher = watcher
+        self.host = host
+        self.port = port
+        self._server = None
+        self._thread = None
+
+    @property
+    def server_address(self):
+        return None if self._server is None else self._server.server_address
+
+    def start(self):
+        if self._server is None:
+            watcher = self.watcher.start() if self.watcher is not None else get_watcher()
+            self._server = BaseHTTPServer.HTTPServer((self.host, self.port), _MetricsHandler)
+            self._server.watcher = watcher
+            self._thread = Thread(target=self._server.serve_forever, name="win32service-metrics")
+            self._thread.daemon = True
+            self._thread.start()
+        return self
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._thread.join()
+            self._server = self._thread = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, type, value, traceback):
+        self.stop()
@@ -0,0 +1,107 @@
+from unittest import TestCase
+from infi.win32service import ServiceState, ERROR_SERVICE_NOTIFY_CLIENT_LAGGING
+from infi.win32service.async_service import AsyncServiceControlManager
+from infi.win32service.simulation import SimulatedAdvapi32, SimulatedService
+from infi.win32service.notifier import StatusNotifier
+from infi.win32service.utils import monotonic
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+
+SERVICES = 5
+
+
+class AsyncServiceTestCase(TestCase):
+    def setUp(self):
+        self.simulation = SimulatedAdvapi32().install()
+        for index in range(SERVICES):
+            self.simulation.add_service(SimulatedService(u"Web{}".format(index), start_delay=0.3, stop_delay=0.1))
+        self.notifier = StatusNotifier()
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.loop = asyncio.new_event_loop()
+
+    def tearDown(self):
+        self.loop.close()
+        self.executor.shutdown()
+        self.notifier.stop()
+        self.simulation.uninstall()
+
+    def _run(self, coroutine):
+        return self.loop.run_until_complete(coroutine)
+
+    def _manager(self):
+        return AsyncServiceControlManager(executor=self.executor, notifier=self.notifier)
+
+    def test_start_and_stop(self):
+        async def start_and_stop():
+            async with self._manager() as scm:
+                self.assertTrue(await scm.is_service_exist(u"Web0"))
+                service = await scm.open_service(u"Web0")
+                await service.safe_start()
+                self.assertEqual(await service.wait_for_status(ServiceState.RUNNING, 5), ServiceState.RUNNING)
+                self.assertTrue(await service.is_running())
+                await service.stop()
+                await service.wait_on_pending(5)
+                status = await service.query_status_ex()
+                await service.close()
+                return status
+        self.assertEqual(self._run(start_and_stop()).current_state, ServiceState.STOPPED)
+
+    def test_waits_do_not_hold_threads(self):
+        async def start_all():
+            async with self._manager() as scm:
+                services = [await scm.open_service(u"Web{}".format(index)) for index in range(SERVICES)]
+                for service in services:
+                    await service.start()
+                started = monotonic()
+                states = await asyncio.gather(*[service.wait_for_status(ServiceState.RUNNING, 5)
+                                                for service in services])
+                elapsed = monotonic() - started
+                for service in services:
+                    await service.close()
+                return states, elapsed
+        # the executor has a single thread, so waits holding it would take SERVICES times as long
+        states, elapsed = self._run(start_all())
+        self.assertEqual(states, [ServiceState.RUNNING] * SERVICES)
+        self.assertLess(elapsed, 1)
+
+    def test_timeout(self):
+        async def wait():
+            async with self._manager() as scm:
+                service = await scm.open_service(u"Web0")
+                try:
+                    await service.wait_for_status(ServiceState.RUNNING, 0.1)
+                finally:
+                    await service.close()
+        with self.assertRaises(RuntimeError):
+            self._run(wait())
+
+    def test_lagging_client_falls_back_to_polling(self):
+        self.simulation.inject_error("NotifyServiceStatusChange", ERROR_SERVICE_NOTIFY_CLIENT_LAGGING)
+
+        async def start():
+            async with self._manager() as scm:
+                service = await scm.open_service(u"Web0")
+                await service.start()
+                state = await service.wait_for_status(ServiceState.RUNNING, 5)
+                self.assertFalse(service.service._notifications_supported)
+                await service.close()
+                return state
+        self.assertEqual(self._run(start()), ServiceState.RUNNING)
+
+    def test_lagging_client_keeps_timeout(self):
+        # the SCM gives up on notifying only after a while
+        self.simulation.latencies["NotifyServiceStatusChange"] = (0.3, 0)
+        self.simulation.inject_error("NotifyServiceStatusChange", ERROR_SERVICE_NOTIFY_CLIENT_LAGGING)
+
+        async def wait():
+            async with self._manager() as scm:
+                service = await scm.open_service(u"Web0")
+                try:
+                    await service.wait_for_status(ServiceState.RUNNING, 0.5)
+                finally:
+                    await service.close()
+        started = monotonic()
+        with self.assertRaises(RuntimeError):
+            self._run(wait())
+        # polling for what was left of the timeout, rather than for all of it again
+        self.assertLess(monotonic() - started, 0.75)
@@ -0,0 +1,41 @@
+from unittest import TestCase
+from infi.win32service import bindings
+
+
+class FakeLibrary(object):
+    def __init__(self):
+        self.calls = []
+
+    def Beep(self, frequency, duration):
+        self.calls.append((frequency, duration))
+        return 1
+
+
+class FakeBackend(object):
+    def __init__(self):
+        self.kernel32 = FakeLibrary()
+
+
+class BindingsTestCase(TestCase):
+    def setUp(self):
+        self.backend = FakeBackend()
+        self.previous = bindings.set_backend(self.backend)
+
+    def tearDown(self):
+        bindings.set_backend(self.previous)
+
+    def test_resolved_on_first_call(self):
+        beep = bindings.bind("kernel32", "Beep", (), None)
+        self.assertEqual(self.backend.kernel32.calls, [])
+        self.assertEqual(beep(440, 100), 1)
+        self.assertEqual(self.backend.kernel32.calls, [(440, 100)])
+        other = FakeBackend()
+        bindings.set_backend(other)
+        beep(880, 50)
+        self.assertEqual(other.kernel32.calls, [(880, 50)])
+
+    def test_optional(self):
+        self.assertTrue(bindings.is_available(bindings.bind("kernel32", "Beep", (), None, optional=True)))
+        self.assertFalse(bindings.is_available(bindings.bind("kernel32", "Boop", (), None, optional=True)))
+        with self.assertRaises(AttributeError):
+            bindings.bind("kernel32", "Boop", (), None).available
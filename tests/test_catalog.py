@@ -0,0 +1,77 @@
+from unittest import TestCase
+from infi.win32service import ServiceCatalog, CatalogEvent, ServiceControlManagerContext, ServiceState
+from infi.win32service import ServiceType, ServiceStartType, ERROR_SERVICE_NOTIFY_CLIENT_LAGGING
+from infi.win32service.simulation import SimulatedAdvapi32, SimulatedService
+from infi.win32service.notifier import StatusNotifier
+from threading import Event
+
+
+class ServiceCatalogTestCase(TestCase):
+    def setUp(self):
+        self.simulation = SimulatedAdvapi32().install()
+        self.simulation.add_service(SimulatedService(u"Web", display_name=u"Web Server", dependencies=[u"DB"],
+                                                     start_type=ServiceStartType.AUTO))
+        self.simulation.add_service(SimulatedService(u"DB", start_type=ServiceStartType.AUTO))
+        self.simulation.add_service(SimulatedService(u"Spooler"))
+        self.notifier = StatusNotifier()
+        self.catalog = ServiceCatalog(notifier=self.notifier).start()
+
+    def tearDown(self):
+        self.catalog.close()
+        self.notifier.stop()
+        self.simulation.uninstall()
+
+    def _wait_for(self, predicate):
+        happened = Event()
+
+        def listener(event, entry):
+            if predicate(event, entry):
+                happened.set()
+        self.catalog.add_listener(listener)
+        return happened
+
+    def test_sweep(self):
+        self.assertEqual(len(self.catalog), 3)
+        self.assertEqual(self.catalog.find_by_display_name(u"web server").service_name, u"Web")
+        self.assertEqual([entry.service_name for entry in self.catalog.find_dependents(u"db")], [u"Web"])
+        self.assertEqual(sorted(entry.service_name for entry in self.catalog.find(ServiceState.STOPPED,
+                                                                                  ServiceStartType.AUTO)),
+                         [u"DB", u"Web"])
+
+    def test_state_changes(self):
+        running = self._wait_for(lambda event, entry: entry.current_state == ServiceState.RUNNING)
+        with ServiceControlManagerContext() as scm:
+            with scm.open_service(u"Web") as service:
+                service.start()
+                self.assertTrue(running.wait(5))
+                process_id = service.query_status_ex().process_id
+        self.assertEqual([entry.service_name for entry in self.catalog.find_by_pid(process_id)], [u"Web"])
+        self.assertEqual([entry.service_name for entry in self.catalog.find(ServiceState.STOPPED,
+                                                                            ServiceStartType.AUTO)], [u"DB"])
+
+    def test_created_and_deleted(self):
+        created = self._wait_for(lambda event, entry: event == CatalogEvent.CREATED)
+        deleted = self._wait_for(lambda event, entry: event == CatalogEvent.DELETED)
+        with ServiceControlManagerContext() as scm:
+            service = scm.create_service(u"New", u"New Service", ServiceType.WIN32_OWN_PROCESS,
+                                         ServiceStartType.DEMAND, u"C:\\new.exe")
+            self.assertTrue(created.wait(5))
+            self.assertEqual(self.catalog.get(u"new").display_name, u"New Service")
+            service.delete()
+            service.close()
+            self.assertTrue(deleted.wait(5))
+            self.assertNotIn(u"New", self.catalog)
+            # the catalog lets go of its handle on the notifier thread
+            self.notifier.flush(5)
+            self.assertFalse(scm.is_service_exist(u"New"))
+
+    def test_lagging_notifications(self):
+        # the SCM refuses the next registration, as it does with clients that fall behind
+        self.simulation.inject_error("NotifyServiceStatusChange", ERROR_SERVICE_NOTIFY_CLIENT_LAGGING)
+        running = self._wait_for(lambda event, entry: entry.current_state == ServiceState.RUNNING)
+        with ServiceControlManagerContext() as scm:
+            with scm.open_service(u"Spooler") as service:
+                service.start()
+                self.assertTrue(running.wait(5))
+        self.assertEqual(self.catalog.get(u"spooler").current_state, ServiceState.RUNNING)
+        self.assertEqual(len(self.catalog), 3)
@@ -0,0 +1,67 @@
+from unittest import TestCase
+import ctypes
+from ctypes import wintypes
+from infi.win32service import service_control_manager
+from infi.win32service.service_control_manager import ServiceControlManager, ENUM_SERVICE_STATUS_PROCESS
+from infi.win32service.common import ERROR_MORE_DATA
+from infi.win32service.bindings import SetLastError
+from infi.win32service.simulation import SimulatedAdvapi32
+
+SERVICE_NAMES = [u"Service{:03}".format(index) for index in range(300)]
+
+
+class FakeEnumServicesStatusEx(object):
+    """ Stands in for advapi32!EnumServicesStatusExW, returning as many services as fit in the caller's buffer """
+    def __init__(self, names):
+        self.names = names
+        self.calls = 0
+        self._strings = []
+
+    def __call__(self, hSCManager, InfoLevel, dwServiceType, dwServiceState, lpServices, cbBufSize,
+                 pcbBytesNeeded, lpServicesReturned, lpResumeHandle, pszGroupName):
+        self.calls += 1
+        resume = lpResumeHandle._obj
+        entry_size = ctypes.sizeof(ENUM_SERVICE_STATUS_PROCESS)
+        count = min(cbBufSize // entry_size, len(self.names) - resume.value)
+        entries = (ENUM_SERVICE_STATUS_PROCESS * count).from_buffer(lpServices)
+        for index in range(count):
+            name = ctypes.create_unicode_buffer(self.names[resume.value + index])
+            self._strings.append(name)
+            entries[index].lpServiceName = ctypes.cast(name, wintypes.LPWSTR)
+            entries[index].lpDisplayName = ctypes.cast(name, wintypes.LPWSTR)
+            entries[index].ServiceStatusProcess.dwCurrentState = 4
+            entries[index].ServiceStatusProcess.dwProcessId = resume.value + index
+        resume.value += count
+        lpServicesReturned._obj.value = count
+        remaining = len(self.names) - resume.value
+        pcbBytesNeeded._obj.value = remaining * entry_size
+        if remaining:
+            SetLastError(ERROR_MORE_DATA)
+            return False
+        return True
+
+
+class EnumerateServicesTestCase(TestCase):
+    def setUp(self):
+        # the simulation keeps the last error for us, so the test runs anywhere
+        self.simulation = SimulatedAdvapi32().install()
+        self.fake = FakeEnumServicesStatusEx(SERVICE_NAMES)
+        self._original = service_control_manager.EnumServicesStatusEx
+        service_control_manager.EnumServicesStatusEx = self.fake
+
+    def tearDown(self):
+        service_control_manager.EnumServicesStatusEx = self._original
+        self.simulation.uninstall()
+
+    def test_enumerate_all(self):
+        scm = ServiceControlManager(1)
+        services = list(scm.enumerate_services())
+        self.assertEqual([service.service_name for service in services], SERVICE_NAMES)
+        self.assertEqual([service.process_id for service in services], list(range(len(SERVICE_NAMES))))
+        self.assertLess(self.fake.calls, 10)
+
+    def test_enumerate_is_lazy(self):
+        scm = ServiceControlManager(1)
+        first = next(scm.enumerate_services())
+        self.assertEqual(first.service_name, SERVICE_NAMES[0])
+        self.assertEqual(self.fake.calls, 1)
@@ -0,0 +1,42 @@
+from unittest import TestCase
+import ctypes
+from infi.win32service.common import ServiceControl
+from infi.win32service.event_data import (EventData, PowerEventType, SessionChangeEventType, WTSSESSION_NOTIFICATION,
+                                          POWERBROADCAST_SETTING, SERVICE_TIMECHANGE_INFO)
+
+
+class EventDataTestCase(TestCase):
+    def test_session_change(self):
+        notification = WTSSESSION_NOTIFICATION(ctypes.sizeof(WTSSESSION_NOTIFICATION), 3)
+        event = EventData(ServiceControl.SESSIONCHANGE, SessionChangeEventType.SESSION_LOGON,
+                          ctypes.addressof(notification))
+        self.assertEqual(event.session_id, 3)
+        # a view, not a copy
+        notification.dwSessionId = 4
+        self.assertEqual(event.session_id, 4)
+
+    def test_power_setting_change(self):
+        buffer = ctypes.create_string_buffer(ctypes.sizeof(POWERBROADCAST_SETTING) + 3)
+        setting = POWERBROADCAST_SETTING.from_buffer(buffer)
+        setting.DataLength = 4
+        ctypes.c_uint32.from_address(setting.data_address()).value = 2
+        event = EventData(ServiceControl.POWEREVENT, PowerEventType.POWERSETTINGCHANGE, ctypes.addressof(buffer))
+        self.assertEqual(event.data.dword(), 2)
+        self.assertEqual(len(event.data.data()), 4)
+
+    def test_power_events_without_data(self):
+        self.assertIsNone(EventData(ServiceControl.POWEREVENT, PowerEventType.APMSUSPEND, None).data)
+
+    def test_time_change(self):
+        info = SERVICE_TIMECHANGE_INFO(2, 1)
+        event = EventData(ServiceControl.TIMECHANGE, 0, ctypes.addressof(info))
+        self.assertEqual((event.data.liNewTime, event.data.liOldTime), (2, 1))
+
+    def test_unknown_control(self):
+        self.assertIsNone(EventData(0x80, 0, 1234).data)
+
+    def test_session_id_without_session(self):
+        event = EventData(ServiceControl.SESSIONCHANGE, SessionChangeEventType.SESSION_LOGON, None)
+        self.assertIsNone(event.session_id)
+        info = SERVICE_TIMECHANGE_INFO(2, 1)
+        self.assertIsNone(EventData(ServiceControl.TIMECHANGE, 0, ctypes.addressof(info)).session_id)
@@ -0,0 +1,83 @@
+from unittest import TestCase
+from infi.win32service import ServiceState
+from infi.win32service.fleet import FleetExecutor, FleetTimeoutError
+from infi.win32service.simulation import SimulatedAdvapi32, SimulatedService
+from threading import Event, Thread
+
+HOSTS = [u"node{}".format(index) for index in range(8)]
+
+
+class FleetExecutorTestCase(TestCase):
+    def setUp(self):
+        self.simulation = SimulatedAdvapi32().install()
+        self.simulation.add_service(SimulatedService(u"VSS"))
+
+    def tearDown(self):
+        self.simulation.uninstall()
+
+    def test_query_status(self):
+        with FleetExecutor(HOSTS, max_workers=4) as fleet:
+            for sweep in range(2):
+                results = list(fleet.query_status(u"VSS"))
+                self.assertEqual(sorted(result.host for result in results), HOSTS)
+                self.assertEqual([result.error for result in results], [None] * len(HOSTS))
+                self.assertEqual(set(result.value.current_state for result in results), set([ServiceState.STOPPED]))
+            # one connection per host, kept for the second sweep
+            self.assertEqual(len(fleet._managers), len(HOSTS))
+
+    def test_hanging_open_does_not_block_host(self):
+        self.simulation.latencies["OpenSCManager"] = (1, 0)
+        with FleetExecutor(HOSTS[:1], timeout_in_seconds=0.2) as fleet:
+            [result] = fleet.query_status(u"VSS")
+            self.assertIsInstance(result.error, FleetTimeoutError)
+            # the host answers again, while the first connection attempt is still stuck
+            del self.simulation.latencies["OpenSCManager"]
+            [result] = fleet.query_status(u"VSS")
+            self.assertIsNone(result.error)
+
+    def test_abandoned_connection_closed_when_done(self):
+        entered, release, used = Event(), Event(), []
+
+        def stuck(scm):
+            entered.set()
+            release.wait(5)
+            used.append(scm)
+            return scm.is_service_exist(u"VSS")
+
+        with FleetExecutor(HOSTS[:1], timeout_in_seconds=0.2) as fleet:
+            [result] = fleet.run(stuck)
+            self.assertIsInstance(result.error, FleetTimeoutError)
+            self.assertTrue(entered.is_set())
+            [result] = fleet.query_status(u"VSS")
+            self.assertIsNone(result.error)
+            release.set()
+            fleet._executor.shutdown()
+            [scm] = used
+            self.assertIsNone(scm.handle)
+            self.assertEqual(len(fleet._managers), 1)
+
+    def test_close_waits_for_operations(self):
+        entered, release, found = Event(), Event(), []
+
+        def stuck(scm):
+            entered.set()
+            release.wait(5)
+            found.append(scm.is_service_exist(u"VSS"))
+            return scm
+
+        fleet = FleetExecutor(HOSTS[:1], timeout_in_seconds=None)
+        [result] = fleet.run(lambda scm: scm)
+        scm = result.value
+        results = []
+        sweep = Thread(target=lambda: results.extend(fleet.run(stuck)))
+        sweep.start()
+        self.assertTrue(entered.wait(5))
+        fleet.close()
+        # still in use by stuck, so it is not closed under its feet
+        self.assertIsNotNone(scm.handle)
+        release.set()
+        sweep.join(5)
+        [result] = results
+        self.assertIs(result.value, scm)
+        self.assertEqual(found, [True])
+        self.assertIsNone(scm.handle)
@@ -0,0 +1,89 @@
+from unittest import TestCase
+from infi.win32service import ServiceControlManagerContext, ServiceState, close_pooled_managers
+from infi.win32service.service_control_manager import ServiceAccess
+from infi.win32service.simulation import SimulatedAdvapi32, SimulatedService
+from infi.win32service.common import ERROR_INVALID_HANDLE
+
+
+class HandlePoolTestCase(TestCase):
+    def setUp(self):
+        self.simulation = SimulatedAdvapi32().install()
+        for name in (u"A", u"B", u"C"):
+            self.simulation.add_service(SimulatedService(name))
+
+    def tearDown(self):
+        close_pooled_managers()
+        self.simulation.uninstall()
+
+    def _handles(self, name):
+        return self.simulation.get_service(name).handles
+
+    def test_reuse(self):
+        with ServiceControlManagerContext(pool_size=2) as scm:
+            with scm.open_service(u"A") as service:
+                handle = service.handle.value
+            with scm.open_service(u"a", ServiceAccess.QUERY_STATUS) as service:
+                self.assertEqual(service.handle.value, handle)
+        self.assertEqual(self._handles(u"A"), 1)
+
+    def test_eviction_waits_for_release(self):
+        with ServiceControlManagerContext(pool_size=1) as scm:
+            held = scm.open_service(u"A")
+            twice = scm.open_service(u"A")
+            # evicts A's handle from the pool, but both of its users still have it
+            with scm.open_service(u"B"):
+                pass
+            self.assertEqual(len(scm.pool), 1)
+            self.assertEqual(self._handles(u"A"), 1)
+            self.assertEqual(held.get_status(), ServiceState.STOPPED)
+            held.close()
+            held.close()
+            self.assertEqual(self._handles(u"A"), 1)
+            twice.close()
+            self.assertEqual(self._handles(u"A"), 0)
+            # and the next user gets a handle of its own
+            with scm.open_service(u"A") as service:
+                self.assertEqual(service.get_status(), ServiceState.STOPPED)
+            self.assertEqual(self._handles(u"A"), 1)
+            self.assertEqual(self._handles(u"B"), 0)
+
+    def test_clear_waits_for_release(self):
+        scm = ServiceControlManagerContext(pool_size=4).__enter__()
+        with scm.open_service(u"A") as service:
+            close_pooled_managers()
+            self.assertEqual(self._handles(u"A"), 1)
+            self.assertEqual(service.get_status(), ServiceState.STOPPED)
+        self.assertEqual(self._handles(u"A"), 0)
+
+    def test_stale_handle_reopened(self):
+        with ServiceControlManagerContext(pool_size=4) as scm:
+            with scm.open_service(u"A") as service:
+                handle = service.handle.value
+                self.simulation.inject_error("QueryServiceStatusEx", ERROR_INVALID_HANDLE)
+                self.assertEqual(service.get_status(), ServiceState.STOPPED)
+                self.assertNotEqual(service.handle.value, handle)
+            self.assertEqual(self._handles(u"A"), 1)
+            self.assertEqual(len(scm.pool), 1)
+
+    def test_delete_while_held(self):
+        with ServiceControlManagerContext(pool_size=4) as scm:
+            other = scm.open_service(u"C")
+            with scm.open_service(u"C") as service:
+                service.delete()
+            # the service goes with the last handle
+            self.assertIsNotNone(self.simulation.get_service(u"C"))
+            other.close()
+            self.assertIsNone(self.simulation.get_service(u"C"))
+
+    def test_conflicting_pool_settings(self):
+        with ServiceControlManagerContext(pool_size=4):
+            pass
+        with self.assertRaises(ValueError):
+            with ServiceControlManagerContext(pool_size=8):
+                pass
+        with self.assertRaises(ValueError):
+            with ServiceControlManagerContext(pool_size=4, pool_ttl=10):
+                pass
+        close_pooled_managers()
+        with ServiceControlManagerContext(pool_size=8) as scm:
+            self.assertEqual(scm.pool.max_size, 8)
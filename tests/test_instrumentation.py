@@ -0,0 +1,48 @@
+from unittest import TestCase
+from infi.win32service import instrumentation, service, notifier
+
+
+class InstrumentationTestCase(TestCase):
+    def setUp(self):
+        self.original = service.QueryServiceStatusEx
+        self.fake = self.fake_query
+        service.QueryServiceStatusEx = self.fake
+        instrumentation.reset()
+        instrumentation.enable()
+
+    def tearDown(self):
+        instrumentation.disable()
+        service.QueryServiceStatusEx = self.original
+        instrumentation.reset()
+
+    def fake_query(self, handle, *args):
+        return True
+
+    def test_calls_are_counted(self):
+        self.assertTrue(instrumentation.is_enabled())
+        self.assertIsNot(service.QueryServiceStatusEx, self.fake)
+        service.QueryServiceStatusEx(1, 0, None, 0, None)
+        service.QueryServiceStatusEx(1, 0, None, 0, None)
+        stats = instrumentation.snapshot()["QueryServiceStatusEx"]
+        self.assertEqual(stats["calls"], 2)
+        self.assertEqual(stats["failures"], 0)
+        self.assertEqual(sum(count for _, count in stats["histogram"]), 2)
+
+    def test_modules_that_import_a_binding_are_patched_too(self):
+        self.assertIs(notifier.NotifyServiceStatusChange, service.NotifyServiceStatusChange)
+        self.assertTrue(hasattr(notifier.NotifyServiceStatusChange, "instrumented_function"))
+
+    def test_sinks(self):
+        calls = []
+        sink = lambda name, elapsed, error: calls.append(name)
+        instrumentation.add_sink(sink)
+        try:
+            service.QueryServiceStatusEx(1, 0, None, 0, None)
+        finally:
+            instrumentation.remove_sink(sink)
+        service.QueryServiceStatusEx(1, 0, None, 0, None)
+        self.assertEqual(calls, ["QueryServiceStatusEx"])
+
+    def test_disable_restores_the_bindings(self):
+        instrumentation.disable()
+        self.assertIs(service.QueryServiceStatusEx, self.fake)
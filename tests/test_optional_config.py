@@ -0,0 +1,118 @@
+from unittest import TestCase
+from infi.win32service import ServiceControlManagerContext
+from infi.win32service.optional_config import (ServiceConfigInfoLevel, QUERY_CONFIG2_INITIAL_BUFFER_SIZE,
+                                               ERROR_INVALID_LEVEL, _config2_buffer)
+from infi.win32service.simulation import SimulatedAdvapi32, SimulatedService
+from infi.win32service.bindings import WindowsError
+from infi.win32service.common import ERROR_INVALID_HANDLE
+from .threads import run_in_new_thread
+
+DESCRIPTION = u"A service that does a lot. " * 200
+
+
+class OptionalConfigTestCase(TestCase):
+    def setUp(self):
+        self.simulation = SimulatedAdvapi32().install()
+        service = self.simulation.add_service(SimulatedService(u"Web"))
+        service.description = DESCRIPTION
+        service.required_privileges = [u"SeBackupPrivilege", u"SeRestorePrivilege"]
+        service.preshutdown_timeout = 5000
+
+    def tearDown(self):
+        self.simulation.uninstall()
+
+    def test_buffer_grows(self):
+        def query():
+            with ServiceControlManagerContext() as scm:
+                with scm.open_service(u"Web") as service:
+                    self.assertEqual(_config2_buffer.size, QUERY_CONFIG2_INITIAL_BUFFER_SIZE)
+                    snapshot = service.query_optional_config()
+                    grown = _config2_buffer.buffer
+                    service.query_optional_config()
+                    # the grown buffer is kept for the following queries
+                    self.assertIs(_config2_buffer.buffer, grown)
+                    return snapshot, _config2_buffer.size
+        snapshot, size = run_in_new_thread(query)
+        self.assertGreater(size, QUERY_CONFIG2_INITIAL_BUFFER_SIZE)
+        self.assertEqual(snapshot.description, DESCRIPTION)
+        self.assertEqual(snapshot.required_privileges, [u"SeBackupPrivilege", u"SeRestorePrivilege"])
+        self.assertEqual(snapshot.preshutdown_timeout, 5000)
+        self.assertFalse(snapshot.delayed_auto_start)
+
+    def test_some_levels(self):
+        with ServiceControlManagerContext() as scm:
+            with scm.open_service(u"Web") as service:
+                snapshot = service.query_optional_config(ServiceConfigInfoLevel.PRESHUTDOWN_INFO)
+        self.assertEqual(snapshot.preshutdown_timeout, 5000)
+        self.assertIsNone(snapshot.description)
+
+    def test_unknown_level_skipped(self):
+        # as on systems older than the info level
+        self.simulation.inject_error("QueryServiceConfig2", ERROR_INVALID_LEVEL)
+        with ServiceControlManagerContext() as scm:
+            with scm.open_service(u"Web") as service:
+                snapshot = service.query_optional_config(ServiceConfigInfoLevel.DESCRIPTION,
+                                                         ServiceConfigInfoLevel.PRESHUTDOWN_INFO)
+        self.assertIsNone(snapshot.description)
+        self.assertEqual(snapshot.preshutdown_timeout, 5000)
+
+    def test_error(self):
+        self.simulation.inject_error("QueryServiceConfig2", ERROR_INVALID_HANDLE)
+        with ServiceControlManagerContext() as scm:
+            with scm.open_service(u"Web") as service:
+                with self.assertRaises(WindowsError) as context:
+                    service.query_optional_config()
+        self.assertEqual(context.exception.winerror, ERROR_INVALID_HANDLE)
+
+
+class OptionalConfigsTestCase(TestCase):
+    NAMES = [u"Alpha", u"Beta", u"Gamma", u"Delta"]
+
+    def setUp(self):
+        self.simulation = SimulatedAdvapi32().install()
+        for index, name in enumerate(self.NAMES):
+            service = self.simulation.add_service(SimulatedService(name))
+            service.description = u"{} service".format(name)
+            service.preshutdown_timeout = 1000 * (index + 1)
+
+    def tearDown(self):
+        self.simulation.uninstall()
+
+    def test_snapshots(self):
+        with ServiceControlManagerContext() as scm:
+            snapshots = dict(scm.query_optional_configs())
+        self.assertEqual(sorted(snapshots), sorted(self.NAMES))
+        for index, name in enumerate(self.NAMES):
+            self.assertEqual(snapshots[name].description, u"{} service".format(name))
+            self.assertEqual(snapshots[name].preshutdown_timeout, 1000 * (index + 1))
+
+    def test_some_levels(self):
+        with ServiceControlManagerContext() as scm:
+            snapshots = dict(scm.query_optional_configs([ServiceConfigInfoLevel.PRESHUTDOWN_INFO]))
+        self.assertEqual(snapshots[u"Beta"].preshutdown_timeout, 2000)
+        self.assertIsNone(snapshots[u"Beta"].description)
+
+    def test_unknown_level_skipped(self):
+        # the first level of the first service, as if the system did not know it
+        self.simulation.inject_error("QueryServiceConfig2", ERROR_INVALID_LEVEL)
+        with ServiceControlManagerContext() as scm:
+            snapshots = list(scm.query_optional_configs([ServiceConfigInfoLevel.DESCRIPTION,
+                                                         ServiceConfigInfoLevel.PRESHUTDOWN_INFO]))
+        self.assertEqual(len(snapshots), len(self.NAMES))
+        (first, snapshot), others = snapshots[0], snapshots[1:]
+        self.assertIsNone(snapshot.description)
+        self.assertIsNotNone(snapshot.preshutdown_timeout)
+        for name, snapshot in others:
+            self.assertEqual(snapshot.description, u"{} service".format(name))
+
+    def test_deleted_mid_sweep(self):
+        with ServiceControlManagerContext() as scm:
+            sweep = scm.query_optional_configs()
+            first, snapshot = next(sweep)
+            # one of those the sweep has not reached yet; it was already enumerated, but cannot be opened anymore
+            deleted = [name for name in sorted(self.NAMES, key=lambda name: name.lower()) if name != first][-1]
+            with scm.open_service(deleted) as service:
+                service.delete()
+            names = [first] + [name for name, snapshot in sweep]
+        self.assertIsNone(self.simulation.get_service(deleted))
+        self.assertEqual(sorted(names), sorted(name for name in self.NAMES if name != deleted))
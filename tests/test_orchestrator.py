@@ -0,0 +1,135 @@
+from unittest import TestCase
+from infi.win32service import ServiceControlManagerContext, ServiceState, ERROR_SERVICE_DISABLED
+from infi.win32service.orchestrator import (ServiceOrchestrator, OrchestrationError, dependency_waves,
+                                            DependencyCycleError)
+from infi.win32service.simulation import SimulatedAdvapi32, SimulatedService
+
+
+class FakeService(object):
+    def __init__(self, dependencies):
+        self.dependencies = dependencies
+
+    def query_dependencies(self):
+        return self.dependencies
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        pass
+
+
+class FakeServiceControlManager(object):
+    def __init__(self, dependencies):
+        self.dependencies = dependencies
+
+    def open_service(self, name, access=None):
+        return FakeService(self.dependencies[name])
+
+
+class DependencyWavesTestCase(TestCase):
+    def test_waves(self):
+        waves = dependency_waves(dict(web=set(["db", "cache"]), db=set(), cache=set(["db"]), worker=set(["db"])))
+        self.assertEqual(waves, [["db"], ["cache", "worker"], ["web"]])
+
+    def test_outside_dependencies_are_ignored(self):
+        self.assertEqual(dependency_waves(dict(web=set(["RpcSs"]))), [["web"]])
+
+    def test_cycle(self):
+        with self.assertRaises(DependencyCycleError):
+            dependency_waves(dict(a=set(["b"]), b=set(["a"])))
+
+    def test_dependency_graph(self):
+        scm = FakeServiceControlManager(dict(Web=[u"DB", u"+NetworkProvider", u"RpcSs"], db=[]))
+        graph = ServiceOrchestrator(scm).dependency_graph(["Web", "db"])
+        self.assertEqual(graph, dict(Web=set(["db"]), db=set()))
+
+
+class _RecordingLibrary(object):
+    """ Calls record(name) before every call of the functions in names, then passes the call on to library """
+    def __init__(self, library, names, record):
+        self._library = library
+        self._names = names
+        self._record = record
+
+    def __getattr__(self, name):
+        function = getattr(self._library, name)
+        if name not in self._names:
+            return function
+
+        def recorded(*args):
+            self._record(name)
+            return function(*args)
+        return recorded
+
+
+class ServiceOrchestratorTestCase(TestCase):
+    NAMES = [u"Web", u"Cache", u"Worker", u"DB"]
+
+    def setUp(self):
+        self.simulation = SimulatedAdvapi32()
+        self.calls = []
+        self.simulation.advapi32 = _RecordingLibrary(self.simulation.advapi32, ("StartServiceW", "ControlService"),
+                                                     self._record)
+        self.simulation.install()
+        for name, dependencies in ((u"DB", []), (u"Cache", [u"DB"]), (u"Worker", [u"DB", u"+Network"]),
+                                   (u"Web", [u"DB", u"Cache"])):
+            self.simulation.add_service(SimulatedService(name, dependencies=dependencies, start_delay=0.05,
+                                                         stop_delay=0.05))
+
+    def tearDown(self):
+        self.simulation.uninstall()
+
+    def _record(self, name):
+        # which of the services are RUNNING at the time of the call
+        self.calls.append(set(service_name for service_name in self.NAMES
+                              if self.simulation.get_service(service_name).state == ServiceState.RUNNING))
+
+    def _states(self):
+        return set(self.simulation.get_service(name).state for name in self.NAMES)
+
+    def test_start_dependencies_first(self):
+        with ServiceControlManagerContext() as scm:
+            ServiceOrchestrator(scm).start(self.NAMES)
+        self.assertEqual(self._states(), set([ServiceState.RUNNING]))
+        # DB alone, then Cache and Worker (in parallel) once DB runs, then Web once all of them do
+        self.assertEqual(self.calls[0], set())
+        for running in self.calls[1:3]:
+            self.assertIn(u"DB", running)
+        self.assertEqual(self.calls[3], set([u"DB", u"Cache", u"Worker"]))
+        self.assertEqual(len(self.calls), 4)
+
+    def test_stop_dependents_first(self):
+        with ServiceControlManagerContext() as scm:
+            orchestrator = ServiceOrchestrator(scm)
+            orchestrator.start(self.NAMES)
+            del self.calls[:]
+            orchestrator.stop(self.NAMES)
+        self.assertEqual(self._states(), set([ServiceState.STOPPED]))
+        # Web first, then Cache and Worker (in parallel) once Web stopped, then DB once all of them did
+        self.assertEqual(self.calls[0], set(self.NAMES))
+        for running in self.calls[1:3]:
+            self.assertNotIn(u"Web", running)
+            self.assertIn(u"DB", running)
+        self.assertEqual(self.calls[3], set([u"DB"]))
+        self.assertEqual(len(self.calls), 4)
+
+    def test_start_failure(self):
+        self.simulation.inject_error("StartService", ERROR_SERVICE_DISABLED)
+        with ServiceControlManagerContext() as scm:
+            with self.assertRaises(OrchestrationError) as context:
+                ServiceOrchestrator(scm).start(self.NAMES)
+        self.assertEqual(list(context.exception.failures), [u"DB"])
+        self.assertEqual(context.exception.failures[u"DB"].winerror, ERROR_SERVICE_DISABLED)
+        # the services that depend on it were not touched
+        self.assertEqual(self._states(), set([ServiceState.STOPPED]))
+        self.assertEqual(len(self.calls), 1)
+
+    def test_one_timeout_per_service(self):
+        self.simulation.add_service(SimulatedService(u"Slow", start_delay=0.3, stop_delay=0.3))
+        with ServiceControlManagerContext() as scm:
+            with scm.open_service(u"Slow") as service:
+                service.start()
+            # 0.3 seconds to leave START_PENDING and 0.3 more to stop do not fit in 0.5 seconds
+            with self.assertRaises(OrchestrationError):
+                ServiceOrchestrator(scm, timeout_in_seconds=0.5).stop([u"Slow"])
@@ -0,0 +1,75 @@
+from unittest import TestCase
+from infi.win32service import ServiceControlManagerContext
+from infi.win32service.provisioning import ServiceProvisioner, ServiceSpec, ProvisionTimeoutError
+from infi.win32service import ServiceType, ServiceStartType, ServiceState
+from infi.win32service import ERROR_SERVICE_DATABASE_LOCKED, ERROR_SERVICE_DOES_NOT_EXIST
+from infi.win32service.simulation import SimulatedAdvapi32, SimulatedService
+from infi.win32service.notifier import StatusNotifier
+from threading import Timer
+
+WORKERS = 50
+
+
+def _spec(name, path=u"C:\\worker.exe"):
+    return ServiceSpec(name, None, ServiceType.WIN32_OWN_PROCESS, ServiceStartType.DEMAND, path)
+
+
+class ServiceProvisionerTestCase(TestCase):
+    def setUp(self):
+        self.simulation = SimulatedAdvapi32(latencies={"CreateService": (0.01, 0), "DeleteService": (0.01, 0)})
+        self.simulation.install()
+        self.notifier = StatusNotifier()
+        self.provisioner = ServiceProvisioner(max_workers=16, timeout_in_seconds=10, notifier=self.notifier).start()
+
+    def tearDown(self):
+        self.provisioner.close()
+        self.notifier.stop()
+        self.simulation.uninstall()
+
+    def test_reprovision(self):
+        names = [u"Worker{}".format(index) for index in range(WORKERS)]
+        for index, name in enumerate(names):
+            service = self.simulation.add_service(SimulatedService(name, stop_delay=0.05))
+            if index % 5 == 0:
+                service.state = ServiceState.RUNNING
+        results = self.provisioner.create_services([_spec(name, u"C:\\worker2.exe") for name in names], replace=True)
+        self.assertEqual([result.name for result in results], names)
+        self.assertEqual([result.error for result in results], [None] * WORKERS)
+        for name in names:
+            self.assertEqual(self.simulation.get_service(name).binary_path, u"C:\\worker2.exe")
+        results = self.provisioner.delete_services(names)
+        self.assertEqual([result.error for result in results], [None] * WORKERS)
+        with ServiceControlManagerContext() as scm:
+            self.assertFalse(any(scm.is_service_exist(name) for name in names))
+
+    def test_create_waits_for_pending_delete(self):
+        self.simulation.add_service(SimulatedService(u"Worker"))
+        with ServiceControlManagerContext() as scm:
+            service = scm.open_service(u"Worker")
+            service.delete()
+        # the deletion completes when the last handle is closed
+        Timer(0.2, service.close).start()
+        [result] = self.provisioner.create_services([_spec(u"Worker", u"C:\\new.exe")])
+        self.assertIsNone(result.error)
+        self.assertEqual(result.attempts, 2)
+        self.assertEqual(self.simulation.get_service(u"Worker").binary_path, u"C:\\new.exe")
+
+    def test_transient_errors_retried(self):
+        self.simulation.inject_error("CreateService", ERROR_SERVICE_DATABASE_LOCKED, times=2)
+        [result] = self.provisioner.create_services([_spec(u"Worker")])
+        self.assertIsNone(result.error)
+        self.assertEqual(result.attempts, 3)
+
+    def test_per_item_errors(self):
+        self.simulation.add_service(SimulatedService(u"Worker"))
+        results = self.provisioner.delete_services([u"Worker", u"Missing"], missing_ok=False)
+        self.assertIsNone(results[0].error)
+        self.assertEqual(results[1].error.winerror, ERROR_SERVICE_DOES_NOT_EXIST)
+
+    def test_deletion_timeout(self):
+        self.simulation.add_service(SimulatedService(u"Worker"))
+        self.provisioner.timeout_in_seconds = 0.3
+        with ServiceControlManagerContext() as scm:
+            with scm.open_service(u"Worker"):
+                [result] = self.provisioner.delete_services([u"Worker"])
+        self.assertIsInstance(result.error, ProvisionTimeoutError)
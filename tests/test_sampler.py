@@ -0,0 +1,86 @@
+from unittest import TestCase
+from infi.win32service import ServiceControlManagerContext, ServiceState
+from infi.win32service.sampler import ProcessSampler, RingBuffer
+from infi.win32service.simulation import SimulatedAdvapi32, SimulatedService
+
+
+class RingBufferTestCase(TestCase):
+    def test_wraps_around(self):
+        buffer = RingBuffer(3, "L")
+        for value in range(5):
+            buffer.append(value)
+        self.assertEqual(len(buffer), 3)
+        self.assertEqual(buffer.tolist(), [2, 3, 4])
+        self.assertEqual((buffer[0], buffer[-1]), (2, 4))
+
+
+class ProcessSamplerTestCase(TestCase):
+    def setUp(self):
+        self.simulation = SimulatedAdvapi32().install()
+        for name in (u"Web", u"DB"):
+            self.simulation.add_service(SimulatedService(name))
+        with ServiceControlManagerContext() as scm:
+            with scm.open_service(u"Web") as service:
+                service.start()
+                service.wait_for_status(ServiceState.RUNNING, 5)
+
+    def tearDown(self):
+        self.simulation.uninstall()
+
+    def test_sample(self):
+        web = self.simulation.get_service(u"Web")
+        sampler = ProcessSampler(capacity=4)
+        try:
+            for index in range(6):
+                web.cpu_time += 0.5
+                web.working_set = 1000 * (index + 1)
+                web.handle_count = 100 + index
+                sampler.sample()
+        finally:
+            sampler.stop()
+        self.assertEqual(sampler.sampled_services(), [u"Web"])
+        history = sampler.history(u"web")
+        self.assertEqual(len(history), 4)
+        self.assertEqual(history.column("handle_count"), [102, 103, 104, 105])
+        aggregate = sampler.aggregate(u"Web")
+        self.assertEqual(aggregate.samples, 4)
+        self.assertEqual(aggregate.working_set_last, 6000)
+        self.assertTrue(aggregate.working_set_growth > 0)
+        self.assertTrue(aggregate.cpu_percent_max > 0)
+        self.assertEqual(aggregate.process_ids, [web.process_id])
+        self.assertIsNone(sampler.aggregate(u"DB"))
+
+    def test_first_sample_left_out(self):
+        web = self.simulation.get_service(u"Web")
+        sampler = ProcessSampler(capacity=8)
+        try:
+            web.working_set = 10 ** 6
+            sampler.sample()
+            # a single sample has no CPU figure, so there is nothing to aggregate yet
+            self.assertIsNone(sampler.aggregate(u"Web"))
+            for index in range(2):
+                web.cpu_time += 0.5
+                web.working_set = 1000 * (index + 1)
+                sampler.sample()
+        finally:
+            sampler.stop()
+        self.assertEqual(len(sampler.history(u"Web")), 3)
+        aggregate = sampler.aggregate(u"Web")
+        self.assertEqual(aggregate.samples, 2)
+        self.assertEqual(aggregate.working_set_max, 2000)
+        self.assertTrue(aggregate.working_set_growth > 0)
+
+    def test_stopped_service_dropped(self):
+        sampler = ProcessSampler()
+        try:
+            sampler.sample()
+            self.assertEqual(sampler.sampled_services(), [u"Web"])
+            with ServiceControlManagerContext() as scm:
+                with scm.open_service(u"Web") as service:
+                    service.stop()
+                    service.wait_for_status(ServiceState.STOPPED, 5)
+            sampler.sample()
+        finally:
+            sampler.stop()
+        self.assertEqual(sampler.sampled_services(), [])
+        self.assertIsNone(sampler.history(u"Web"))
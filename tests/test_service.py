@@ -0,0 +1,210 @@
+from unittest import TestCase
+from infi.win32service import ServiceControlManagerContext, ServiceState, ERROR_SERVICE_NOTIFY_CLIENT_LAGGING
+from infi.win32service.service import (PollBackoff, POLL_MIN_INTERVAL, QUERY_CONFIG_INITIAL_BUFFER_SIZE,
+                                       QUERY_SERVICE_CONFIG, QueryServiceConfig, _query_buffers)
+from infi.win32service.simulation import SimulatedAdvapi32, SimulatedService
+from .threads import run_in_new_thread
+from collections import defaultdict
+from ctypes import wintypes
+import ctypes
+
+
+class _CountingLibrary(object):
+    """ Counts the calls made to the functions of a library, optionally pretending some are not there """
+    def __init__(self, library, missing=()):
+        self._library = library
+        self._missing = missing
+        self.calls = defaultdict(int)
+
+    def __getattr__(self, name):
+        if name in self._missing:
+            raise AttributeError(name)
+        function = getattr(self._library, name)
+
+        def counted(*args):
+            self.calls[name] += 1
+            return function(*args)
+        return counted
+
+
+class WaitForStatusTestCase(TestCase):
+    missing = ()
+
+    def setUp(self):
+        self.simulation = SimulatedAdvapi32()
+        self.advapi32 = self.simulation.advapi32 = _CountingLibrary(self.simulation.advapi32, self.missing)
+        self.simulation.install()
+        self.simulation.add_service(SimulatedService(u"Web", start_delay=0.3, stop_delay=0.3))
+
+    def tearDown(self):
+        self.simulation.uninstall()
+
+    def _start(self, service):
+        sleeps = []
+        sleep = service._sleep
+
+        def recorded_sleep(seconds):
+            sleeps.append(seconds)
+            sleep(seconds)
+        service._sleep = recorded_sleep
+        service.start()
+        self.assertEqual(service.get_status(), ServiceState.START_PENDING)
+        return sleeps
+
+    def test_notification(self):
+        with ServiceControlManagerContext() as scm:
+            with scm.open_service(u"Web") as service:
+                sleeps = self._start(service)
+                self.assertEqual(service.wait_for_status(ServiceState.RUNNING, 5), ServiceState.RUNNING)
+                # woken up by the SCM, rather than polling on the way
+                self.assertEqual(sleeps, [])
+                self.assertGreaterEqual(self.advapi32.calls["NotifyServiceStatusChangeW"], 1)
+                self.assertLessEqual(self.advapi32.calls["QueryServiceStatusEx"], 4)
+
+    def test_timeout(self):
+        with ServiceControlManagerContext() as scm:
+            with scm.open_service(u"Web") as service:
+                with self.assertRaises(RuntimeError):
+                    service.wait_for_status(ServiceState.RUNNING, 0.1)
+                self.assertEqual(service.wait_for_status([ServiceState.RUNNING, ServiceState.STOPPED], 0),
+                                 ServiceState.STOPPED)
+
+    def test_wait_on_pending(self):
+        with ServiceControlManagerContext() as scm:
+            with scm.open_service(u"Web") as service:
+                self._start(service)
+                service.wait_on_pending(5)
+                self.assertEqual(service.get_status(), ServiceState.RUNNING)
+                service.stop()
+                service.wait_on_pending(5)
+                self.assertEqual(service.get_status(), ServiceState.STOPPED)
+
+    def test_notification_after_timeout(self):
+        with ServiceControlManagerContext() as scm:
+            with scm.open_service(u"Web") as service:
+                with self.assertRaises(RuntimeError):
+                    service.wait_for_status(ServiceState.RUNNING, 0.1)
+                # the registration of the wait that timed out is still pending, so this one polls
+                sleeps = self._start(service)
+                self.assertEqual(service.wait_for_status(ServiceState.RUNNING, 5), ServiceState.RUNNING)
+                self.assertNotEqual(sleeps, [])
+                # but it fired while polling, so the next wait is notified again
+                del sleeps[:]
+                registrations = self.advapi32.calls["NotifyServiceStatusChangeW"]
+                service.stop()
+                self.assertEqual(service.wait_for_status(ServiceState.STOPPED, 5), ServiceState.STOPPED)
+                self.assertEqual(sleeps, [])
+                self.assertGreater(self.advapi32.calls["NotifyServiceStatusChangeW"], registrations)
+
+    def test_lagging_client_falls_back_to_polling(self):
+        self.simulation.inject_error("NotifyServiceStatusChange", ERROR_SERVICE_NOTIFY_CLIENT_LAGGING)
+        with ServiceControlManagerContext() as scm:
+            with scm.open_service(u"Web") as service:
+                sleeps = self._start(service)
+                self.assertEqual(service.wait_for_status(ServiceState.RUNNING, 5), ServiceState.RUNNING)
+                self.assertFalse(service._notifications_supported)
+                self.assertNotEqual(sleeps, [])
+
+
+class PollingWaitForStatusTestCase(WaitForStatusTestCase):
+    """ The same waits, on a system that has no NotifyServiceStatusChange (before Vista) """
+    missing = ("NotifyServiceStatusChangeW", )
+
+    def test_notification(self):
+        with ServiceControlManagerContext() as scm:
+            with scm.open_service(u"Web") as service:
+                self.assertFalse(service._notifications_supported)
+                service.start()
+                self.assertEqual(service.wait_for_status(ServiceState.RUNNING, 5), ServiceState.RUNNING)
+                self.assertEqual(self.advapi32.calls["NotifyServiceStatusChangeW"], 0)
+                # backing off, rather than spinning
+                self.assertLess(self.advapi32.calls["QueryServiceStatusEx"], 30)
+
+
+    def test_notification_after_timeout(self):
+        with ServiceControlManagerContext() as scm:
+            with scm.open_service(u"Web") as service:
+                with self.assertRaises(RuntimeError):
+                    service.wait_for_status(ServiceState.RUNNING, 0.1)
+                self.assertIsNone(service._pending_notify)
+                service.start()
+                self.assertEqual(service.wait_for_status(ServiceState.RUNNING, 5), ServiceState.RUNNING)
+
+class PollBackoffTestCase(TestCase):
+    def test_backoff(self):
+        backoff = PollBackoff()
+        intervals = [backoff.next_interval(1, 1000) for index in range(6)]
+        self.assertEqual(intervals[0], POLL_MIN_INTERVAL * 2)
+        self.assertEqual(intervals[:3], sorted(intervals[:3]))
+        # no more than a tenth of the wait hint
+        self.assertEqual(max(intervals), 0.1)
+        # progress starts over
+        self.assertEqual(backoff.next_interval(2, 1000), POLL_MIN_INTERVAL * 2)
+        # and a tiny wait hint still polls every POLL_MIN_INTERVAL
+        self.assertEqual(PollBackoff().next_interval(0, 0), POLL_MIN_INTERVAL)
+
+
+class QueryBuffersTestCase(TestCase):
+    def setUp(self):
+        self.simulation = SimulatedAdvapi32().install()
+        self.simulation.add_service(SimulatedService(u"Web", dependencies=[u"DB", u"+Network"], start_delay=0.05))
+        self.simulation.add_service(SimulatedService(u"DB"))
+        # long enough not to fit in the initial config buffer
+        self.simulation.add_service(SimulatedService(u"Long", binary_path=u"C:\\long.exe " + u"x" * 2000))
+
+    def tearDown(self):
+        self.simulation.uninstall()
+
+    def test_status(self):
+        with ServiceControlManagerContext() as scm:
+            with scm.open_service(u"Web") as service:
+                stopped = service.query_status_ex()
+                service.start()
+                service.wait_for_status(ServiceState.RUNNING, 5)
+                running = service.query_status_ex()
+                self.assertEqual(stopped.current_state, ServiceState.STOPPED)
+                self.assertEqual(stopped.process_id, 0)
+                self.assertEqual(running.current_state, ServiceState.RUNNING)
+                self.assertNotEqual(running.process_id, 0)
+                # the raw status lives in a buffer of this thread, reused by every query
+                self.assertIs(service._query_status_process(), service._query_status_process())
+                self.assertIsNot(run_in_new_thread(service._query_status_process),
+                                 service._query_status_process())
+
+    def _legacy_config(self, service):
+        # what query_config() returned before it read into a reused buffer
+        buffer = ctypes.create_string_buffer(8192)
+        self.assertTrue(QueryServiceConfig(service.handle, ctypes.cast(buffer, ctypes.POINTER(QUERY_SERVICE_CONFIG)),
+                                           8192, ctypes.byref(wintypes.DWORD())))
+        return QUERY_SERVICE_CONFIG.from_buffer(buffer).to_dict()
+
+    def test_query_config_shape(self):
+        with ServiceControlManagerContext() as scm:
+            with scm.open_service(u"Web") as service:
+                config = service.query_config()
+                self.assertEqual(config, self._legacy_config(service))
+                self.assertEqual(config["dependencies"], u"DB")
+                self.assertEqual(service.query_config_record().dependencies, [u"DB", u"+Network"])
+                self.assertFalse(service.is_disabled())
+            with scm.open_service(u"DB") as service:
+                config = service.query_config()
+                self.assertEqual(config, self._legacy_config(service))
+                self.assertEqual(config["dependencies"], u"")
+                self.assertEqual(service.query_config_record().dependencies, [])
+
+    def test_config_buffer_grows(self):
+        def query():
+            with ServiceControlManagerContext() as scm:
+                with scm.open_service(u"Long") as service:
+                    self.assertEqual(_query_buffers.config_size, QUERY_CONFIG_INITIAL_BUFFER_SIZE)
+                    path = service.query_config_record().binary_path_name
+                    grown = _query_buffers.config
+                    service.query_config_record()
+                    with scm.open_service(u"Web") as other:
+                        other.query_config_record()
+                    # the grown buffer is kept for the following queries
+                    self.assertIs(_query_buffers.config, grown)
+                    return path, _query_buffers.config_size
+        path, size = run_in_new_thread(query)
+        self.assertEqual(path, u"C:\\long.exe " + u"x" * 2000)
+        self.assertGreater(size, QUERY_CONFIG_INITIAL_BUFFER_SIZE)
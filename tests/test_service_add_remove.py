@@ -3,6 +3,7 @@ from threading import Event
 import os
 import time
 from infi.win32service import ServiceControlManagerContext, ServiceRunner, ServiceType, ServiceStartType, ServiceControl
+from infi.win32service.provisioning import delete_services
 import logging
 import tempfile
 
@@ -39,13 +40,9 @@ class TestWin32Service(TestCase):
                 time.sleep(6)
 
     def _delete(self):
-        with ServiceControlManagerContext() as scm:
-            infi_service = scm.open_service(INFI_SERVICE_NAME)
-            infi_service.delete()
-            infi_service.close()
-
-        # sleep to let the service db refresh or something; otherwise the open succeeds, somehow, sometimes
-        time.sleep(3)
+        # waits until the SCM is done with the service, instead of guessing how long that takes
+        [result] = delete_services([INFI_SERVICE_NAME], stop=False, missing_ok=False)
+        self.assertIsNone(result.error)
 
         with ServiceControlManagerContext() as scm:
             with self.assertRaisesRegexp(WindowsError, "The specified service does not exist as an installed service."):
@@ -88,7 +85,7 @@ class TestWin32Service(TestCase):
 
 class MyServiceRunner(ServiceRunner):
     def __init__(self):
-        super(MyServiceRunner, self).__init__(INFI_SERVICE_NAME)
+        super(MyServiceRunner, self).__init__(INFI_SERVICE_NAME, control_queue=True)
         self._stop_event = Event()
 
     def main(self):
@@ -98,11 +95,9 @@ class MyServiceRunner(ServiceRunner):
             test_file.write(b"stopped\n")
 
     def control(self, control):
+        # with the control queue, STOPPED is only reported once main() returns, so there is no need to give it time
         if control == ServiceControl.STOP:
             self._stop_event.set()
-        # sleep before returning control to service runner and notifying that we are stopped - gives the main
-        # thread time to exit gracefully before it will be killed by the Windows service manager after notification
-        time.sleep(3)
 
 if __name__ == "__main__":
     MyServiceRunner().run()
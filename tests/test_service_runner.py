@@ -0,0 +1,283 @@
+from unittest import TestCase
+from infi.win32service import ServiceControlManagerContext, ServiceRunner, ServiceState, ServiceControl, ServiceCtrl
+from infi.win32service import STARTUP_MILESTONES, RestartPolicy, ServiceHost, ServiceType
+from infi.win32service.common import ERROR_SERVICE_SPECIFIC_ERROR
+from infi.win32service.utils import monotonic
+from infi.win32service.service import ControlService, SERVICE_STATUS
+from infi.win32service.simulation import SimulatedAdvapi32, SimulatedService
+from threading import Event, Thread
+import ctypes
+
+
+class EchoService(ServiceRunner):
+    def __init__(self, *args, **kwargs):
+        super(EchoService, self).__init__(*args, **kwargs)
+        self.stopped = Event()
+        self.returned = Event()
+        self.controls = []
+
+    def main(self):
+        self.stopped.wait(5)
+        self.returned.set()
+
+    def control(self, service_control):
+        self.controls.append(service_control)
+        if service_control == ServiceControl.STOP:
+            self.stopped.set()
+
+
+class FlakyService(EchoService):
+    def __init__(self, failures, *args, **kwargs):
+        super(FlakyService, self).__init__(*args, **kwargs)
+        self.failures = failures
+        self.calls = 0
+
+    def main(self):
+        self.calls += 1
+        if self.calls <= self.failures:
+            raise RuntimeError("failure {}".format(self.calls))
+        super(FlakyService, self).main()
+
+
+class WarmingService(EchoService):
+    def __init__(self, *args, **kwargs):
+        super(WarmingService, self).__init__(*args, auto_ready=False, progress_interval=0.01, **kwargs)
+        self.warm = Event()
+        self.readied = Event()
+        self.release = Event()
+
+    def main(self):
+        self.warm.wait(5)
+        self.ready()
+        self.readied.set()
+        self.release.wait(5)
+        super(WarmingService, self).main()
+
+
+class SlowStopService(EchoService):
+    def __init__(self, *args, **kwargs):
+        super(SlowStopService, self).__init__(*args, **kwargs)
+        self.release = Event()
+
+    def control(self, service_control):
+        super(SlowStopService, self).control(service_control)
+        if service_control == ServiceControl.STOP:
+            self.release.wait(5)
+
+
+class ServiceRunnerTestCase(TestCase):
+    def setUp(self):
+        self.simulation = SimulatedAdvapi32().install()
+
+    def tearDown(self):
+        self.simulation.uninstall()
+
+    def _start_and_stop(self, runner):
+        self.simulation.add_service(SimulatedService(runner.service_name, main=runner.run))
+        with ServiceControlManagerContext() as scm:
+            with scm.open_service(runner.service_name) as service:
+                service.start()
+                self.assertEqual(service.wait_for_status(ServiceState.RUNNING, 5), ServiceState.RUNNING)
+                service.stop()
+                self.assertEqual(service.wait_for_status(ServiceState.STOPPED, 5), ServiceState.STOPPED)
+        # without a control queue, STOPPED does not wait for main() (see ServiceRunner), nor does its timeline
+        self.assertTrue(runner.returned.wait(5))
+
+    def _send_control(self, service, control):
+        # Service has no method for controls other than STOP; the simulated SCM delivers any accepted one
+        self.assertTrue(ControlService(service.handle, control, ctypes.byref(SERVICE_STATUS())))
+
+    def _shut_down(self, runner, control):
+        self.simulation.add_service(SimulatedService(runner.service_name, main=runner.run))
+        with ServiceControlManagerContext() as scm:
+            with scm.open_service(runner.service_name) as service:
+                service.start()
+                self.assertEqual(service.wait_for_status(ServiceState.RUNNING, 5), ServiceState.RUNNING)
+                self._send_control(service, control)
+                self.assertEqual(service.wait_for_status(ServiceState.STOPPED, 5), ServiceState.STOPPED)
+        self.assertTrue(runner.returned.wait(5))
+
+    def test_preshutdown_without_drains(self):
+        runner = EchoService(u"Echo", accept_preshutdown=True)
+        self._shut_down(runner, ServiceControl.PRESHUTDOWN)
+        self.assertEqual(runner.controls, [ServiceControl.STOP])
+
+    def test_shutdown_drains(self):
+        runner = EchoService(u"Echo", accept_preshutdown=True)
+        drained = []
+        runner.register_drain(lambda: drained.append(1), 1)
+        runner.register_drain(lambda: drained.append(2), 1)
+        self._shut_down(runner, ServiceControl.SHUTDOWN)
+        self.assertEqual(drained, [1, 2])
+        self.assertEqual(runner.controls, [ServiceControl.STOP])
+
+    def _assert_progress(self, service, state):
+        # the checkpoint of a pending state has to keep advancing, or the SCM gives up on the service
+        check_points = set()
+        deadline = monotonic() + 5
+        while len(check_points) < 3 and monotonic() < deadline:
+            status = service.query_status_ex()
+            self.assertEqual(status.current_state, state)
+            check_points.add(status.check_point)
+            Event().wait(0.01)
+        self.assertEqual(len(check_points), 3)
+
+    def test_start_progress(self):
+        runner = WarmingService(u"Echo")
+        self.simulation.add_service(SimulatedService(u"Echo", main=runner.run))
+        with ServiceControlManagerContext() as scm:
+            with scm.open_service(u"Echo") as service:
+                service.start()
+                self._assert_progress(service, ServiceState.START_PENDING)
+                runner.warm.set()
+                runner.release.set()
+                self.assertEqual(service.wait_for_status(ServiceState.RUNNING, 5), ServiceState.RUNNING)
+                service.stop()
+                self.assertEqual(service.wait_for_status(ServiceState.STOPPED, 5), ServiceState.STOPPED)
+
+    def test_stop_while_warming_up(self):
+        runner = WarmingService(u"Echo", control_queue=True)
+        simulated = self.simulation.add_service(SimulatedService(u"Echo", main=runner.run))
+        with ServiceControlManagerContext() as scm:
+            with scm.open_service(u"Echo") as service:
+                service.start()
+                self._assert_progress(service, ServiceState.START_PENDING)
+                # the SCM refuses STOP while START_PENDING, so we call the handler the way it would
+                simulated.handler(ServiceControl.STOP, 0, None, simulated.handler_context)
+                runner.warm.set()
+                self.assertTrue(runner.readied.wait(5))
+                self._assert_progress(service, ServiceState.STOP_PENDING)
+                runner.release.set()
+                self.assertEqual(service.wait_for_status(ServiceState.STOPPED, 5), ServiceState.STOPPED)
+        self.assertEqual(runner.controls, [ServiceControl.STOP])
+
+    def _wait_for_state(self, service, state):
+        deadline = monotonic() + 5
+        while service.get_status() != state and monotonic() < deadline:
+            Event().wait(0.01)
+        self.assertEqual(service.get_status(), state)
+
+    def test_second_stop(self):
+        runner = SlowStopService(u"Echo")
+        simulated = self.simulation.add_service(SimulatedService(u"Echo", main=runner.run))
+        with ServiceControlManagerContext() as scm:
+            with scm.open_service(u"Echo") as service:
+                service.start()
+                self.assertEqual(service.wait_for_status(ServiceState.RUNNING, 5), ServiceState.RUNNING)
+                handler, context = simulated.handler, simulated.handler_context
+                first = Thread(target=handler, args=(ServiceControl.STOP, 0, None, context))
+                first.start()
+                self._wait_for_state(service, ServiceState.STOP_PENDING)
+                # the SCM may send STOP again to a service that is stopping; it must not get to control() twice
+                handler(ServiceControl.STOP, 0, None, context)
+                runner.release.set()
+                first.join()
+                self.assertEqual(service.wait_for_status(ServiceState.STOPPED, 5), ServiceState.STOPPED)
+        self.assertEqual(runner.controls, [ServiceControl.STOP])
+
+    def test_control_queue(self):
+        runner = SlowStopService(u"Echo", control_queue=True)
+        self.simulation.add_service(SimulatedService(u"Echo", main=runner.run))
+        with ServiceControlManagerContext() as scm:
+            with scm.open_service(u"Echo") as service:
+                service.start()
+                self.assertEqual(service.wait_for_status(ServiceState.RUNNING, 5), ServiceState.RUNNING)
+                # acknowledged right away, while control() is still at it on the worker thread
+                service.stop()
+                self.assertTrue(runner.stopped.wait(5))
+                self.assertEqual(service.get_status(), ServiceState.STOP_PENDING)
+                runner.release.set()
+                self.assertEqual(service.wait_for_status(ServiceState.STOPPED, 5), ServiceState.STOPPED)
+        self.assertTrue(runner.returned.is_set())
+        self.assertEqual(runner.controls, [ServiceControl.STOP])
+
+    def test_startup_timeline(self):
+        runner = EchoService(u"Echo")
+        self._start_and_stop(runner)
+        timeline = runner.startup_timeline
+        self.assertEqual(list(timeline.to_dict()), list(STARTUP_MILESTONES))
+        self.assertEqual(timeline.elapsed("dispatcher_started"), 0)
+        self.assertTrue(timeline.elapsed("main_entered", since="handler_registered") >= 0)
+
+    def test_fast_startup(self):
+        runner = EchoService(u"Echo", fast_startup=True, preshutdown_timeout=30000)
+        self._start_and_stop(runner)
+        self.assertEqual(list(runner.startup_timeline.to_dict()), list(STARTUP_MILESTONES))
+        self.assertEqual(self.simulation.get_service(u"Echo").preshutdown_timeout, 30000)
+
+    def test_supervised_restarts(self):
+        runner = FlakyService(2, u"Echo", restart_policy=RestartPolicy(initial_delay=0.01))
+        self.simulation.add_service(SimulatedService(u"Echo", main=runner.run))
+        with ServiceControlManagerContext() as scm:
+            with scm.open_service(u"Echo") as service:
+                service.start()
+                self.assertEqual(service.wait_for_status(ServiceState.RUNNING, 5), ServiceState.RUNNING)
+                while runner.calls < 3:
+                    runner.stopped.wait(0.01)
+                status = service.query_status_ex()
+                self.assertEqual(status.win32_exit_code, ERROR_SERVICE_SPECIFIC_ERROR)
+                self.assertEqual(status.service_specific_exit_code, 2)
+                service.stop()
+                self.assertEqual(service.wait_for_status(ServiceState.STOPPED, 5), ServiceState.STOPPED)
+        self.assertEqual(runner.restart_count, 2)
+
+    def test_clean_stop_after_restart(self):
+        runner = FlakyService(1, u"Echo", restart_policy=RestartPolicy(initial_delay=0.01))
+        self.simulation.add_service(SimulatedService(u"Echo", main=runner.run))
+        with ServiceControlManagerContext() as scm:
+            with scm.open_service(u"Echo") as service:
+                service.start()
+                self.assertEqual(service.wait_for_status(ServiceState.RUNNING, 5), ServiceState.RUNNING)
+                while runner.calls < 2:
+                    runner.stopped.wait(0.01)
+                service.stop()
+                self.assertEqual(service.wait_for_status(ServiceState.STOPPED, 5), ServiceState.STOPPED)
+                status = service.query_status_ex()
+        self.assertEqual(runner.restart_count, 1)
+        self.assertEqual((status.win32_exit_code, status.service_specific_exit_code), (0, 0))
+
+    def test_crash_loop(self):
+        runner = FlakyService(100, u"Echo", restart_policy=RestartPolicy(max_restarts=3, initial_delay=0.001,
+                                                                         exit_code=7))
+        self.simulation.add_service(SimulatedService(u"Echo", main=runner.run))
+        with ServiceControlManagerContext() as scm:
+            with scm.open_service(u"Echo") as service:
+                service.start()
+                self.assertEqual(service.wait_for_status(ServiceState.STOPPED, 5), ServiceState.STOPPED)
+                status = service.query_status_ex()
+        self.assertEqual(runner.calls, 4)
+        self.assertEqual((status.win32_exit_code, status.service_specific_exit_code),
+                         (ERROR_SERVICE_SPECIFIC_ERROR, 7))
+
+    def test_handlers_released(self):
+        for index in range(20):
+            runner = EchoService(u"Echo{}".format(index))
+            self._start_and_stop(runner)
+            self.assertEqual(len(ServiceCtrl), 0)
+        self.assertTrue(len(ServiceCtrl._retired_thunks) <= ServiceCtrl.RETIRED_THUNKS)
+
+    def test_service_host(self):
+        collector, uploader = EchoService(u"Collector"), EchoService(u"Uploader")
+        host = ServiceHost(collector, uploader)
+        self.assertEqual([collector.service_type, uploader.service_type], [ServiceType.WIN32_SHARE_PROCESS] * 2)
+        # the simulated dispatcher runs every ServiceMain of the table at once, so starting Collector's process
+        # brings up Uploader as well
+        self.simulation.add_service(SimulatedService(u"Collector", service_type=ServiceType.WIN32_SHARE_PROCESS,
+                                                     main=host.run))
+        self.simulation.add_service(SimulatedService(u"Uploader", service_type=ServiceType.WIN32_SHARE_PROCESS))
+        with ServiceControlManagerContext() as scm:
+            with scm.open_service(u"Collector") as first, scm.open_service(u"Uploader") as second:
+                first.start()
+                self.assertEqual(first.wait_for_status(ServiceState.RUNNING, 5), ServiceState.RUNNING)
+                self.assertEqual(second.wait_for_status(ServiceState.RUNNING, 5), ServiceState.RUNNING)
+                self.assertEqual(len(ServiceCtrl), 2)
+                # each service has a handler and status of its own
+                second.stop()
+                self.assertEqual(second.wait_for_status(ServiceState.STOPPED, 5), ServiceState.STOPPED)
+                self.assertTrue(uploader.returned.wait(5))
+                self.assertEqual(first.get_status(), ServiceState.RUNNING)
+                self.assertEqual(collector.controls, [])
+                first.stop()
+                self.assertEqual(first.wait_for_status(ServiceState.STOPPED, 5), ServiceState.STOPPED)
+        self.assertTrue(collector.returned.wait(5))
+        self.assertEqual(uploader.controls, [ServiceControl.STOP])
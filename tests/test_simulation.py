@@ -0,0 +1,86 @@
+from unittest import TestCase
+from infi.win32service import ServiceControlManagerContext, ServiceState, ServiceType, ServiceStartType
+from infi.win32service import ERROR_SERVICE_DOES_NOT_EXIST, ERROR_SERVICE_MARKED_FOR_DELETE
+from infi.win32service.simulation import SimulatedAdvapi32, SimulatedService
+from infi.win32service.notifier import StatusNotifier
+from infi.win32service.benchmark import run_benchmarks, compare
+from infi.win32service.bindings import WindowsError
+from threading import Event
+
+
+class SimulationTestCase(TestCase):
+    def setUp(self):
+        self.simulation = SimulatedAdvapi32().install()
+        self.simulation.add_service(SimulatedService(u"Web", dependencies=[u"DB", u"+Network"], start_delay=0.05,
+                                                     stop_delay=0.05))
+        self.simulation.add_service(SimulatedService(u"DB"))
+
+    def tearDown(self):
+        self.simulation.uninstall()
+
+    def test_start_and_stop(self):
+        with ServiceControlManagerContext() as scm:
+            with scm.open_service(u"web") as service:
+                service.start()
+                self.assertEqual(service.get_status(), ServiceState.START_PENDING)
+                self.assertEqual(service.wait_for_status(ServiceState.RUNNING, 5), ServiceState.RUNNING)
+                self.assertNotEqual(service.query_status_ex().process_id, 0)
+                service.stop()
+                self.assertEqual(service.wait_for_status(ServiceState.STOPPED, 5), ServiceState.STOPPED)
+
+    def test_config(self):
+        with ServiceControlManagerContext() as scm:
+            with scm.open_service(u"Web") as service:
+                self.assertEqual(service.query_dependencies(), [u"DB", u"+Network"])
+                service.set_preshutdown_timeout(5000)
+                self.assertEqual(service.query_optional_config().preshutdown_timeout, 5000)
+
+    def test_enumerate_in_chunks(self):
+        for index in range(300):
+            self.simulation.add_service(SimulatedService(u"Extra{:03d}".format(index)))
+        with ServiceControlManagerContext() as scm:
+            names = [entry.service_name for entry in scm.enumerate_services()]
+        self.assertEqual(len(names), 302)
+        self.assertEqual(len(set(names)), 302)
+
+    def test_create_and_delete(self):
+        with ServiceControlManagerContext() as scm:
+            service = scm.create_service(u"New", u"New", ServiceType.WIN32_OWN_PROCESS,
+                                         ServiceStartType.DEMAND, u"C:\\new.exe")
+            service.delete()
+            with self.assertRaises(WindowsError) as context:
+                scm.create_service(u"New", u"New", ServiceType.WIN32_OWN_PROCESS, ServiceStartType.DEMAND, u"x")
+            self.assertEqual(context.exception.winerror, ERROR_SERVICE_MARKED_FOR_DELETE)
+            service.close()
+            self.assertFalse(scm.is_service_exist(u"New"))
+
+    def test_injected_errors(self):
+        self.simulation.inject_error("OpenService", ERROR_SERVICE_DOES_NOT_EXIST)
+        with ServiceControlManagerContext() as scm:
+            with self.assertRaises(WindowsError) as context:
+                scm.open_service(u"DB")
+            self.assertEqual(context.exception.winerror, ERROR_SERVICE_DOES_NOT_EXIST)
+            scm.open_service(u"DB").close()
+
+    def test_notifier(self):
+        notifier = StatusNotifier()
+        running = Event()
+        try:
+            with ServiceControlManagerContext() as scm:
+                service = scm.open_service(u"Web")
+                notifier.subscribe(service.handle, lambda notification: notification.state == ServiceState.RUNNING
+                                   and running.set())
+                service.start()
+                self.assertTrue(running.wait(5))
+                notifier.close(service).wait(5)
+        finally:
+            notifier.stop()
+
+
+class BenchmarkTestCase(TestCase):
+    def test_report(self):
+        report = run_benchmarks(iterations=20, services=10, transition_delay=0.001)
+        self.assertEqual(set(report["results"]), set(["open_close", "query_status", "query_config",
+                                                      "query_optional_config", "enumerate", "start_stop", "wait"]))
+        self.assertEqual(report["results"]["open_close"]["operations"], 20)
+        self.assertEqual(compare(report, report), [])
@@ -0,0 +1,53 @@
+from unittest import TestCase
+from infi.win32service import StatusSnapshot, ServiceControlManagerContext, ServiceState
+from infi.win32service.simulation import SimulatedAdvapi32, SimulatedService
+
+
+class StatusSnapshotTestCase(TestCase):
+    def setUp(self):
+        self.simulation = SimulatedAdvapi32().install()
+        for index in range(50):
+            self.simulation.add_service(SimulatedService(u"Service{:02d}".format(index)))
+
+    def tearDown(self):
+        self.simulation.uninstall()
+
+    def test_take_and_filter(self):
+        with ServiceControlManagerContext() as scm:
+            with scm.open_service(u"Service07") as service:
+                service.start()
+                service.wait_for_status(ServiceState.RUNNING, 5)
+            snapshot = StatusSnapshot.take(scm)
+        self.assertEqual(len(snapshot), 50)
+        self.assertEqual(snapshot.column("current_state").typecode, "I")
+        self.assertEqual(len(snapshot.memoryview("process_id")), 50)
+        running = snapshot.where(current_state=ServiceState.RUNNING)
+        self.assertEqual(running.names, (u"Service07", ))
+        self.assertNotEqual(running.get(u"service07").process_id, 0)
+        self.assertEqual(len(snapshot.where(current_state=set([ServiceState.STOPPED, ServiceState.RUNNING]))), 50)
+
+    def test_diff(self):
+        with ServiceControlManagerContext() as scm:
+            before = StatusSnapshot.take(scm)
+            unchanged = StatusSnapshot.take(scm, previous=before)
+            self.assertIs(unchanged.names, before.names)
+            self.assertEqual(before.diff(unchanged), ([], [], []))
+            with scm.open_service(u"Service03") as service:
+                service.start()
+                service.wait_for_status(ServiceState.RUNNING, 5)
+            after = StatusSnapshot.take(scm, previous=before)
+            diff = before.diff(after)
+            self.assertEqual(diff.changed, [(u"Service03", ["current_state", "controls_accepted", "process_id"])])
+            self.simulation.add_service(SimulatedService(u"Extra"))
+            diff = before.diff(StatusSnapshot.take(scm))
+        self.assertEqual(diff.added, [u"Extra"])
+        self.assertEqual([name for name, columns in diff.changed], [u"Service03"])
+
+    def test_names_interned(self):
+        with ServiceControlManagerContext() as scm:
+            first = StatusSnapshot.take(scm)
+            # not taken with previous=, so only interning makes the names the same objects
+            second = StatusSnapshot.take(scm)
+        self.assertIsNot(first.names, second.names)
+        for name, other in zip(first.names, second.names):
+            self.assertIs(name, other)
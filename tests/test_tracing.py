@@ -0,0 +1,40 @@
+from unittest import TestCase
+from infi.win32service import tracing, ServiceControl, ServiceState
+from infi.win32service.tracing import TraceBuffer, TraceEvent
+from six import StringIO
+from . import test_service_runner
+
+
+class TraceBufferTestCase(TestCase):
+    def test_wraps_around(self):
+        buffer = TraceBuffer(capacity=4)
+        for index in range(6):
+            buffer.record(TraceEvent.CONTROL_RECEIVED, index)
+        self.assertEqual(len(buffer), 4)
+        self.assertEqual(buffer.dropped, 2)
+        self.assertEqual([record.a for record in buffer.records()], [2, 3, 4, 5])
+        self.assertEqual(len(buffer.to_bytes()), 4 * tracing.TRACE_RECORD.size)
+        stream = StringIO()
+        buffer.dump(stream)
+        self.assertIn("CONTROL_RECEIVED", stream.getvalue())
+
+
+class TracedServiceRunnerTestCase(test_service_runner.ServiceRunnerTestCase):
+    def setUp(self):
+        super(TracedServiceRunnerTestCase, self).setUp()
+        self.buffer = tracing.enable()
+
+    def tearDown(self):
+        tracing.disable()
+        super(TracedServiceRunnerTestCase, self).tearDown()
+
+    def test_control_trace(self):
+        self._start_and_stop(test_service_runner.EchoService(u"Echo"))
+        records = self.buffer.records()
+        events = [record.event for record in records]
+        self.assertEqual(events[:2], [TraceEvent.SERVICE_MAIN_ENTERED, TraceEvent.HANDLER_REGISTERED])
+        received = events.index(TraceEvent.CONTROL_RECEIVED)
+        self.assertEqual(records[received].a, ServiceControl.STOP)
+        self.assertIn(TraceEvent.CONTROL_HANDLED, events[received:])
+        reported = [record.a for record in records if record.event == TraceEvent.STATUS_REPORTED]
+        self.assertEqual(reported[-1], ServiceState.STOPPED)
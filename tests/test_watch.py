@@ -0,0 +1,89 @@
+from unittest import TestCase
+from infi.win32service import ServiceControlManagerContext, ServiceState
+from infi.win32service.watch import ServiceWatcher, MetricsExporter
+from infi.win32service.simulation import SimulatedAdvapi32, SimulatedService
+from infi.win32service.notifier import StatusNotifier
+from six.moves.urllib.request import urlopen
+from threading import Thread
+import time
+
+
+class ServiceWatcherTestCase(TestCase):
+    def setUp(self):
+        self.simulation = SimulatedAdvapi32().install()
+        self.simulation.add_service(SimulatedService(u"Web", start_delay=0.01, stop_delay=0.01))
+        self.simulation.add_service(SimulatedService(u"DB"))
+        self.notifier = StatusNotifier()
+
+    def tearDown(self):
+        self.notifier.stop()
+        self.simulation.uninstall()
+
+    def _start_and_stop(self, name):
+        with ServiceControlManagerContext() as scm:
+            with scm.open_service(name) as service:
+                service.start()
+                service.wait_for_status(ServiceState.RUNNING, 5)
+                service.stop()
+                service.wait_for_status(ServiceState.STOPPED, 5)
+                service.start()
+                service.wait_for_status(ServiceState.RUNNING, 5)
+
+    def test_transitions(self):
+        with ServiceWatcher(notifier=self.notifier) as watcher:
+            transitions = watcher.watch([u"web"], coalesce_in_seconds=0, timeout_in_seconds=0.5)
+            self._start_and_stop(u"Web")
+            states = [(transition.previous_state, transition.state) for transition in transitions]
+        # a notification may skip a pending state the service was only in for a moment, but never a transition
+        self.assertEqual(states[0][0], ServiceState.STOPPED)
+        self.assertEqual(states[-1][1], ServiceState.RUNNING)
+        for before, after in zip(states, states[1:]):
+            self.assertEqual(before[1], after[0])
+
+    def test_coalescing(self):
+        with ServiceWatcher(notifier=self.notifier) as watcher:
+            transitions = watcher.watch(lambda entry: entry.service_name == u"Web", coalesce_in_seconds=1,
+                                        timeout_in_seconds=0.5)
+            self._start_and_stop(u"Web")
+            folded = list(transitions)
+        self.assertEqual(len(folded), 1)
+        self.assertEqual((folded[0].previous_state, folded[0].state), (ServiceState.STOPPED, ServiceState.RUNNING))
+        self.assertTrue(folded[0].coalesced > 1)
+
+    def test_close(self):
+        with ServiceWatcher(notifier=self.notifier) as watcher:
+            watcher.watch().close()
+            with watcher.watch([u"web"]):
+                self.assertEqual(len(watcher._consumers), 1)
+            list(watcher.watch(timeout_in_seconds=0))
+            self.assertEqual(watcher._consumers, [])
+
+    def test_stop_ends_watch(self):
+        watcher = ServiceWatcher(notifier=self.notifier)
+        changes = watcher.watch([u"web"], coalesce_in_seconds=0)
+        transitions = []
+
+        def consume():
+            for transition in changes:
+                transitions.append(transition)
+        consumer = Thread(target=consume)
+        consumer.daemon = True
+        consumer.start()
+        self._start_and_stop(u"Web")
+        watcher.stop()
+        consumer.join(5)
+        self.assertFalse(consumer.is_alive())
+        self.assertEqual(watcher._consumers, [])
+
+    def test_metrics(self):
+        with ServiceWatcher(notifier=self.notifier) as watcher:
+            with MetricsExporter(watcher, port=0) as exporter:
+                self._start_and_stop(u"Web")
+                # the notification of the last change may still be on its way to the watcher
+                deadline = time.time() + 5
+                while watcher.transition_counts().get((u"Web", ServiceState.RUNNING)) != 2 and time.time() < deadline:
+                    time.sleep(0.01)
+                text = urlopen("http://{}:{}/metrics".format(*exporter.server_address)).read().decode("utf-8")
+        self.assertIn(u'win32service_state{service="Web",state="running"} 1', text)
+        self.assertIn(u'win32service_state{service="DB",state="stopped"} 1', text)
+        self.assertIn(u'win32service_transitions_total{service="Web",state="running"} 2', text)
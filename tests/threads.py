@@ -0,0 +1,11 @@
+from threading import Thread
+
+
+def run_in_new_thread(function):
+    # the query buffers are per thread, so a new thread starts with fresh ones
+    results = []
+    thread = Thread(target=lambda: results.append(function()))
+    thread.start()
+    thread.join(5)
+    [result] = results
+    return result